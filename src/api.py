@@ -1,25 +1,82 @@
+import atexit
+import contextvars
+import cProfile
+import copy
+import glob
+import io
 import json
+import locale
 import logging
 import os
+import queue
+import re
 import shutil
+import signal
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import uuid
-from zipfile import ZipFile
-
-import pdfkit
-from pdf2image import pdf2image
-from win32com import client
+import zlib
+from zipfile import ZIP_DEFLATED, ZipFile
 
 from contextlib import contextmanager
 from typing import List, Optional, Dict
 
-# import docx2pdf
-import lxml.etree as ET
-from docx import Document
-
 import hashlib
+import importlib
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+
+class LazyModule:
+    """
+    imports the module on first attribute access, so a backend is only loaded by the stages which use it
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def load(self):
+        if self.module is None:
+            logging.getLogger(__name__).debug("loading {}".format(self.name))
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+
+# asyncio (with it ssl) and concurrent.futures are imported by the functions using them
+pdfkit = LazyModule("pdfkit")
+psutil = LazyModule("psutil")
+pdf2image = LazyModule("pdf2image.pdf2image")
+client = LazyModule("win32com.client")
+
+# import docx2pdf
+ET = LazyModule("lxml.etree")
+
+# dsr2xml options which change the xml layout, the native converter always writes the default layout
+DSR2XML_LAYOUT_OPTIONS = ("+Ea", "--attr-all", "+Ec", "--attr-code", "+Er", "--attr-relationship", "+Ev",
+                          "--attr-value-type", "+Et", "--attr-template-id", "+Ee", "--template-envelope", "+Xs",
+                          "--add-schema-reference", "+Xn", "--use-xml-namespace", "+We", "--write-empty-tags", "+Wi",
+                          "--write-item-id", "+Wt", "--write-template-id")
+# dsr2xml options for reading, error handling and charsets, the native converter behaves like they are set
+DSR2XML_NATIVE_OPTIONS = ("-q", "--quiet", "-v", "--verbose", "-d", "--debug", "+f", "--read-file", "+fo",
+                          "--read-file-only", "-f", "--read-dataset", "-t=", "--read-xfer-auto", "-td",
+                          "--read-xfer-detect", "-te", "--read-xfer-little", "-tb", "--read-xfer-big", "-ti",
+                          "--read-xfer-implicit", "-Er", "--unknown-relationship", "-Ev", "--invalid-item-value",
+                          "-Ec", "--ignore-constraints", "-Ee", "--ignore-item-errors", "-Ei", "--skip-invalid-items",
+                          "-Dv", "--disable-vr-checker", "+Cr", "--charset-require", "+Cc", "--charset-check-all",
+                          "+U8", "--convert-to-utf8")
+# dsr2xml options followed by a value
+DSR2XML_VALUE_OPTIONS = ("-ll", "--log-level", "-lc", "--log-config", "+Ca", "--charset-assume")
 
 
 class DataObject:
@@ -62,6 +119,9 @@ class Rule(DataObject):
             error = "this values may not be empty: name, concat_string, xpath_expressions"
         return error
 
+    def compile(self):
+        return CompiledRule(self)
+
 
 class Config(DataObject):
     @staticmethod
@@ -75,18 +135,48 @@ class Config(DataObject):
         self.additional_paths = []  # type List[str]
         self.temp_dir = None
         self.dsr2xml_exe_additional_options = ["-Ee", "-Ec"]  # type: Optional[List[str]]
+        self.sr_xml_converter = "dsr2xml"  # one of "dsr2xml", "native"
+        self.streaming_extraction = False
+        self.in_memory = False  # the stages pass their results in memory, intermediate files only if temp_dir is set
         self.target = "dcm_images"  # one of "xml", "template", "dcm_pdf", "dcm_images"
         self.output_dir = None
         self.output_file_name = None
         self.rules = []  # type: List[Rule]
         self.template_path = None  # type: Optional[str]
         self.img2dcm_exe_additional_options = ["--no-checks"]
+        self.raster_pages_per_chunk = 1
+        self.raster_thread_count = 1
+        self.raster_dpi = 200
+        self.raster_color = "color"  # one of "color", "gray", "mono" (black and white pixels, needs a lossless syntax)
+        self.raster_jpeg_quality = None  # 1 - 100, None keeps the pdftoppm default (75)
+        self.dcm_image_transfer_syntax = "jpeg"  # one of "jpeg" (baseline), "jpeg-ls" (lossless), "rle" (lossless)
+        self.dcm_image_workers = 2
+        self.dcm_image_multiframe = False  # dcm_images: one multi-frame object with all pages instead of one per page
         self.pdf2dcm_exe_additional_options = []
+        self.dcm_encoder = "dcmtk"  # one of "dcmtk", "native"
         self.dcm_send_ip = None
         self.dcm_send_port = None
         self.dcm_send_dcm_sr = False
         self.dcmsend_exe_additional_options = []
+        self.dcm_sender = "dcmsend"  # one of "dcmsend", "native", "fake"
+        self.dcm_send_ae_title = "REPORTGEN"
+        self.dcm_send_called_ae_title = "ANY-SCP"
+        self.dcm_send_associations = 1
+        self.dcm_send_retries = 3
+        self.dcm_send_retry_delay = 1.0
         self.oid_root = None
+        self.cache_dir = None
+        self.cache_max_size_mb = 1024
+        self.metrics_file = None  # JSON lines file, one line of stage and command metrics per report
+        self.metrics_prometheus_file = None  # prometheus textfile with the totals of all reports of this run
+        self.renderer = "auto"  # one of "auto", "word", "wkhtmltopdf", "fake"
+        self.renderer_pool_size = 1
+        self.renderer_max_jobs = 100
+        self.renderer_job_timeout = 300.0
+        self.render_batch_size = 1  # > 1 renders the filled templates of up to this many reports in one invocation
+        self.render_batch_wait = 0.2  # seconds a batch waits for more reports after its first one
+        self.stage_concurrency = {}  # stage scheduler: stage name -> reports in the stage at the same time
+        self.stage_queue_size = 4  # stage scheduler: reports waiting in front of each stage
 
     def add_paths(self):
         for additional_path in self.additional_paths:
@@ -98,6 +188,42 @@ class Config(DataObject):
         error = ""
         if not self.template_path or not self.rules:
             error = "this values may not be empty: template_path, rules"
+        if self.sr_xml_converter not in ("dsr2xml", "native"):
+            if error:
+                error = error + "\n"
+            error = error + "sr_xml_converter must be one of: dsr2xml, native"
+        elif self.sr_xml_converter == "native":
+            layout_options = [option for option in self.dsr2xml_exe_additional_options or []
+                              if option in DSR2XML_LAYOUT_OPTIONS]
+            if layout_options:
+                if error:
+                    error = error + "\n"
+                error = error + "the native sr_xml_converter cannot change the xml layout, remove these " \
+                                "dsr2xml_exe_additional_options: " + " ".join(layout_options)
+        if self.renderer not in ("auto", "word", "wkhtmltopdf", "fake"):
+            if error:
+                error = error + "\n"
+            error = error + "renderer must be one of: auto, word, wkhtmltopdf, fake"
+        if self.dcm_encoder not in ("dcmtk", "native"):
+            if error:
+                error = error + "\n"
+            error = error + "dcm_encoder must be one of: dcmtk, native"
+        if self.dcm_sender not in ("dcmsend", "native", "fake"):
+            if error:
+                error = error + "\n"
+            error = error + "dcm_sender must be one of: dcmsend, native, fake"
+        if self.raster_color not in ("color", "gray", "mono"):
+            if error:
+                error = error + "\n"
+            error = error + "raster_color must be one of: color, gray, mono"
+        if self.dcm_image_transfer_syntax not in RASTER_FORMATS:
+            if error:
+                error = error + "\n"
+            error = error + "dcm_image_transfer_syntax must be one of: jpeg, jpeg-ls, rle"
+        elif self.raster_color == "mono" and self.dcm_image_transfer_syntax == "jpeg":
+            if error:
+                error = error + "\n"
+            error = error + "raster_color mono needs a lossless dcm_image_transfer_syntax: jpeg-ls, rle"
         for idx, rule in enumerate(self.rules):
             rule_error = rule.validate()
             if rule_error:
@@ -107,6 +233,9 @@ class Config(DataObject):
 
         return "config error: " + error if error else None
 
+    def compile_rules(self):
+        return RuleProgram(self.rules)
+
     def from_dict(self, data: Dict):
         if "rules" in data.keys():
             rules = []
@@ -122,6 +251,341 @@ class Config(DataObject):
         return data
 
 
+class ReportGeneratorError(Exception):
+    pass
+
+
+CONCEPT_SELECTOR_PREFIX = "concept:"
+_CONCEPT_CONDITION = re.compile(r"^\s*(meaning|code|scheme|path)\s*(=|~)\s*(.*?)\s*$", re.DOTALL)
+CONCEPT_STREAM_PATH = ("report", "document", "content")
+
+
+def is_concept_selector(expression):
+    return expression.lstrip().startswith(CONCEPT_SELECTOR_PREFIX)
+
+
+class ConceptSelector:
+    """
+    a rule expression selecting the values of content items by their concept name instead of an xpath, answered from
+    the ConceptIndex of the SR. the conditions are separated by ";" and all have to match:
+    meaning=<meaning>, meaning~<part of the meaning>, code=<code value>, scheme=<coding scheme designator> and
+    path=<tags of the item and its parent items below content>, e.g. "concept:meaning~Finding; path=container/text"
+    selects the same texts as /report/document/content/container/text[concept/meaning[contains(text(), "Finding")]]
+    /value/text()
+    """
+
+    __slots__ = ("expression", "meaning", "meaning_part", "code", "scheme", "path")
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.meaning = self.meaning_part = self.code = self.scheme = self.path = None
+        conditions = expression.lstrip()[len(CONCEPT_SELECTOR_PREFIX):].split(";")
+        for condition in conditions:
+            if not condition.strip():
+                continue
+            match = _CONCEPT_CONDITION.match(condition)
+            if not match or (match.group(2) == "~" and match.group(1) != "meaning"):
+                raise ValueError("invalid condition \"{}\"".format(condition.strip()))
+            name, operator, value = match.groups()
+            if name == "meaning" and operator == "~":
+                self.meaning_part = value
+            elif name == "path":
+                self.path = tuple(tag.strip() for tag in value.strip("/").split("/"))
+            else:
+                setattr(self, name, value)
+        if all(value is None for value in (self.meaning, self.meaning_part, self.code, self.scheme, self.path)):
+            raise ValueError("no condition")
+
+    def __call__(self, index):
+        return index.select(self)
+
+
+class ConceptIndex:
+    """
+    the content items of a parsed SR by concept meaning, code and path. it is built with one pass over the content
+    tree, so a ConceptSelector costs O(matches) instead of a scan of the whole tree per expression
+    """
+
+    __slots__ = ("items", "by_meaning", "by_code", "by_path")
+
+    def __init__(self, root):
+        self.items = []  # (path, meaning, scheme, code, item element) in document order
+        self.by_meaning = {}  # meaning -> indices into items, as are the other maps
+        self.by_code = {}
+        self.by_path = {}
+        root_element = root.getroot() if hasattr(root, "getroot") else root
+        content = root_element.find("document/content")
+        if content is None:
+            return
+        paths = {content: ()}
+
+        def get_path(element):
+            path = paths.get(element)
+            if path is None:
+                path = get_path(element.getparent()) + (element.tag,)
+                paths[element] = path
+            return path
+
+        for concept in content.iter("concept"):
+            item = concept.getparent()
+            path = get_path(item)
+            meaning = code = scheme = None
+            for child in concept:
+                if child.tag == "meaning":
+                    meaning = child.text
+                elif child.tag == "value":
+                    code = child.text
+                elif child.tag == "scheme":
+                    scheme = child.findtext("designator")
+            idx = len(self.items)
+            self.items.append((path, meaning, scheme, code, item))
+            self.by_meaning.setdefault(meaning, []).append(idx)
+            self.by_code.setdefault(code, []).append(idx)
+            self.by_path.setdefault(path, []).append(idx)
+
+    def select(self, selector: ConceptSelector) -> List[str]:
+        """ :return the value texts of the items matching selector in document order """
+        candidates = []
+        if selector.meaning is not None:
+            candidates.append(self.by_meaning.get(selector.meaning, []))
+        if selector.code is not None:
+            candidates.append(self.by_code.get(selector.code, []))
+        if selector.path is not None:
+            candidates.append(self.by_path.get(selector.path, []))
+        if selector.meaning_part is not None:
+            # the distinct meanings are few compared to the items
+            candidates.append(sorted(idx for meaning, indices in self.by_meaning.items()
+                                     if meaning is not None and selector.meaning_part in meaning for idx in indices))
+        indices = min(candidates, key=len) if candidates else range(len(self.items))
+        texts = []
+        for idx in indices:
+            path, meaning, scheme, code, item = self.items[idx]
+            if (selector.meaning is not None and meaning != selector.meaning) or \
+                    (selector.meaning_part is not None and (meaning is None or selector.meaning_part not in meaning)) \
+                    or (selector.code is not None and code != selector.code) or \
+                    (selector.scheme is not None and scheme != selector.scheme) or \
+                    (selector.path is not None and path != selector.path):
+                continue
+            for value in item.iterfind("value"):
+                if value.text:
+                    texts.append(value.text)
+        return texts
+
+
+class CompiledRule:
+    """
+    a rule with precompiled xpath expressions (or concept selectors) and a single regex matching all replacement search
+    strings
+    """
+
+    __slots__ = ("name", "concat_string", "xpath_expressions", "xpaths", "replacements", "replacement_pattern")
+
+    def __init__(self, rule: Rule):
+        self.name = rule.name
+        self.concat_string = rule.concat_string
+        self.xpath_expressions = tuple(rule.xpath_expressions)
+        xpaths = []
+        for rule_idx, xpath_expression in enumerate(self.xpath_expressions):
+            try:
+                if is_concept_selector(xpath_expression):
+                    xpaths.append(ConceptSelector(xpath_expression))
+                else:
+                    xpaths.append(ET.XPath(xpath_expression, smart_strings=False))
+            except ValueError as error:
+                raise ReportGeneratorError(
+                    "invalid concept selector \"{}\" in rule {}, index {}: {}".format(xpath_expression, rule.name,
+                                                                                       str(rule_idx), error))
+            except ET.XPathSyntaxError as error:
+                raise ReportGeneratorError(
+                    "invalid xpath \"{}\" in rule {}, index {}: {}".format(xpath_expression, rule.name,
+                                                                            str(rule_idx), error))
+        self.xpaths = tuple(xpaths)
+        self.replacements = dict(rule.replacements)
+        self.replacement_pattern = None
+        if self.replacements:
+            # longest search strings first, so overlapping search strings prefer the longest match
+            searches = sorted(self.replacements.keys(), key=len, reverse=True)
+            self.replacement_pattern = re.compile("|".join(re.escape(search) for search in searches if search))
+
+    def extract(self, root, concept_index=None):
+        """
+        evaluates all xpath expressions on root and returns the concatenated and replaced text
+        :param concept_index the ConceptIndex of root for the concept selectors, built if not given
+        """
+        logger = logging.getLogger(__name__)
+        texts = []
+        for rule_idx, xpath in enumerate(self.xpaths):
+            if isinstance(xpath, ConceptSelector):
+                if concept_index is None:
+                    concept_index = ConceptIndex(root)
+                xpath_result = xpath(concept_index)
+            else:
+                xpath_result = xpath(root)
+            if isinstance(xpath_result, List):
+                xpath_result = self.concat_string.join(xpath_result)
+
+            if not isinstance(xpath_result, str):
+                raise ReportGeneratorError(
+                    "xpath did not produce text: \"{}\" in rule {}, index {}".format(self.xpath_expressions[rule_idx],
+                                                                                      self.name, str(rule_idx)))
+            elif len(xpath_result) == 0:
+                logger.warning(
+                    "empty text for xpath \"{}\" in rule {}, index {}".format(self.xpath_expressions[rule_idx],
+                                                                              self.name, str(rule_idx)))
+            else:
+                logger.info("result for xpath {}: {}".format(self.xpath_expressions[rule_idx], xpath_result))
+                texts.append(xpath_result)
+
+        text = self.concat_string.join(texts)
+        # one pass over the complete text instead of re-replacing it after every expression
+        if self.replacement_pattern is not None:
+            text = self.replacement_pattern.sub(lambda match: self.replacements[match.group(0)], text)
+        return text
+
+
+class RuleProgram:
+    """
+    the compiled rules of a config. compile once with Config.compile_rules() and reuse it for any number of SRs
+    """
+
+    __slots__ = ("rules", "stream_paths", "uses_concepts")
+
+    def __init__(self, rules: List[Rule]):
+        self.rules = tuple(rule.compile() for rule in rules)
+        self.uses_concepts = any(isinstance(xpath, ConceptSelector) for rule in self.rules for xpath in rule.xpaths)
+        # the element paths whose subtrees are needed by the rules, None if any expression cannot be streamed
+        stream_paths = set()
+        for rule in self.rules:
+            for xpath_expression in rule.xpath_expressions:
+                if is_concept_selector(xpath_expression):
+                    stream_paths.add(CONCEPT_STREAM_PATH)
+                    continue
+                paths = get_xpath_stream_paths(xpath_expression)
+                if paths is None:
+                    logging.getLogger(__name__).debug(
+                        "xpath \"{}\" in rule {} cannot be streamed".format(xpath_expression, rule.name))
+                    stream_paths = None
+                    break
+                stream_paths.update(paths)
+            if stream_paths is None:
+                break
+        self.stream_paths = frozenset(stream_paths) if stream_paths is not None else None
+
+    def extract(self, root):
+        """
+        :return the template data, i.e. the extracted text for each rule name
+        """
+        template_data = {}
+        # one index per SR, shared by all concept selectors
+        concept_index = ConceptIndex(root) if self.uses_concepts else None
+        for rule in self.rules:
+            template_data[rule.name] = rule.extract(root, concept_index)
+        return template_data
+
+
+_XPATH_NAME_STEP = re.compile(r"^([A-Za-z_][\w.-]*)((?:\[.*\])?)$", re.DOTALL)
+_XPATH_ABSOLUTE_PATH_IN_PREDICATE = re.compile(r"(^|[\[(,=<>!|+*\s])/")
+
+
+def _split_xpath_top_level(xpath_expression, separator):
+    """ splits at separator characters outside of predicates, function calls and string literals """
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    for idx, char in enumerate(xpath_expression):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char in "[(":
+            depth += 1
+        elif char in "])":
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(xpath_expression[start:idx])
+            start = idx + 1
+    parts.append(xpath_expression[start:])
+    return parts
+
+
+def get_xpath_stream_paths(xpath_expression):
+    """
+    analyses an xpath expression for streaming extraction: if the expression only walks down child steps from the
+    document root to some element and everything after that element stays inside its subtree, the element's tag path
+    is returned (one path per union member).
+    e.g. /report/document/content/container/text[concept/meaning[contains(text(), "Finding")]]/value/text()
+    yields ("report", "document", "content", "container", "text")
+    :return a list of tag path tuples or None if the expression cannot be streamed
+    """
+    paths = []
+    for union_member in _split_xpath_top_level(xpath_expression, "|"):
+        union_member = union_member.strip()
+        if not union_member.startswith("/") or union_member.startswith("//"):
+            return None
+        steps = _split_xpath_top_level(union_member[1:], "/")
+        path = []
+        remainder = []
+        for idx, step in enumerate(steps):
+            step = step.strip()
+            match = _XPATH_NAME_STEP.match(step)
+            if not match:
+                # text(), @attribute, node() etc. end the element path
+                remainder = steps[idx:]
+                break
+            path.append(match.group(1))
+            if match.group(2) or (idx + 1 < len(steps) and steps[idx + 1] == ""):
+                # a predicate or a following descendant step ("//") needs the complete subtree of this element
+                remainder = steps[idx:]
+                break
+        if not path:
+            return None
+        # the remainder may not leave the subtree of the path's last element
+        remainder = "/".join(remainder)
+        remainder_without_literals = re.sub(r"\"[^\"]*\"|'[^']*'", "\"\"", remainder)
+        if ".." in remainder_without_literals or "::" in remainder_without_literals or "$" in remainder_without_literals:
+            return None
+        for predicate in re.findall(r"\[(.*)\]", remainder_without_literals, re.DOTALL):
+            if _XPATH_ABSOLUTE_PATH_IN_PREDICATE.search(predicate):
+                return None
+        paths.append(tuple(path))
+    return paths
+
+
+def parse_xml_pruned(xml_file, stream_paths):
+    """
+    parses xml_file with iterparse and drops every element that is neither inside the subtree of one of the
+    stream_paths nor an ancestor of one, so the tree only holds what the rules can match
+    :param stream_paths tag path tuples as returned by get_xpath_stream_paths()
+    :return an lxml ElementTree
+    """
+    ancestor_paths = {path[:idx] for path in stream_paths for idx in range(1, len(path))}
+    path = []
+    kept_depth = None
+    root = None
+    for event, element in ET.iterparse(xml_file, events=("start", "end"), remove_comments=True):
+        if event == "start":
+            if root is None:
+                root = element
+            path.append(element.tag)
+            if kept_depth is None and tuple(path) in stream_paths:
+                kept_depth = len(path)
+            continue
+
+        depth = len(path)
+        if kept_depth is not None:
+            if depth == kept_depth:
+                kept_depth = None
+            path.pop()
+            continue
+        if tuple(path) not in ancestor_paths and element is not root:
+            element.clear()
+            element.getparent().remove(element)
+        path.pop()
+    return ET.ElementTree(root)
+
+
 def sha256sum(filename):
     h = hashlib.sha256()
     b = bytearray(128 * 1024)
@@ -149,13 +613,15 @@ def generate_dcm_uid(oid_root, unique_string, max_length=56):
     return dcm_uid
 
 
-def doc2pdf(doc_name, pdf_name):
+def doc2pdf(doc_name, pdf_name, word=None):
     """
     :word to pdf
     :param doc_name word file name
     :param pdf_name to_pdf file name
+    :param word a running Word.Application, a new one is dispatched if None
     """
-    word = client.DispatchEx("Word.Application")
+    if word is None:
+        word = client.DispatchEx("Word.Application")
     if os.path.exists(pdf_name):
         os.remove(pdf_name)
     worddoc = word.Documents.Open(os.path.realpath(doc_name), ReadOnly=1)
@@ -164,6 +630,389 @@ def doc2pdf(doc_name, pdf_name):
     # return pdf_name
 
 
+class Renderer:
+    """
+    converts a filled template into a pdf file. a renderer is started, used and closed by one pool worker thread
+    """
+
+    def start(self):
+        pass
+
+    def render(self, input_path, pdf_path):
+        raise NotImplementedError()
+
+    def render_batch(self, documents):
+        """
+        renders several filled templates with as few renderer invocations as possible
+        :param documents list of (input_path, pdf_path)
+        """
+        for input_path, pdf_path in documents:
+            self.render(input_path, pdf_path)
+
+    def render_data(self, data, extension):
+        """
+        :return the pdf bytes for the filled template bytes. renderers which can only read files get them in a temp dir
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = os.path.join(temp_dir, "document" + extension)
+            pdf_path = os.path.join(temp_dir, "document.pdf")
+            with open(input_path, "wb") as input_file:
+                input_file.write(data)
+            self.render(input_path, pdf_path)
+            with open(pdf_path, "rb") as pdf_file:
+                return pdf_file.read()
+
+    def is_healthy(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class WordRenderer(Renderer):
+    """
+    keeps one Word instance alive for all documents it renders. there is no batch render, a batch is rendered document
+    by document, which costs the same as single jobs since the instance is not restarted between them
+    """
+
+    def __init__(self):
+        self.word = None
+
+    def start(self):
+        import pythoncom
+        # COM objects must be created and used in the same thread
+        pythoncom.CoInitialize()
+        self.word = client.DispatchEx("Word.Application")
+        self.word.Visible = False
+        self.word.DisplayAlerts = 0
+
+    def render(self, input_path, pdf_path):
+        doc2pdf(input_path, pdf_path, self.word)
+
+    def is_healthy(self):
+        try:
+            return self.word is not None and self.word.Documents.Count == 0
+        except Exception:
+            return False
+
+    def close(self):
+        import pythoncom
+        try:
+            if self.word is not None:
+                self.word.Quit()
+        except Exception as error:
+            logging.getLogger(__name__).warning("could not quit Word: {}".format(error))
+        self.word = None
+        pythoncom.CoUninitialize()
+
+
+class WkhtmltopdfRenderer(Renderer):
+    """
+    wkhtmltopdf has no server mode, so every job still runs one wkhtmltopdf process, a batch of jobs shares one. the
+    worker only keeps the resolved configuration
+    """
+
+    def __init__(self):
+        self.configuration = None
+        self.wkhtmltopdf = None
+
+    def start(self):
+        self.wkhtmltopdf = "wkhtmltopdf"
+        if sys.platform == 'win32':
+            self.wkhtmltopdf += ".exe"
+        self.configuration = pdfkit.pdfkit.Configuration(wkhtmltopdf=self.wkhtmltopdf)
+
+    def render(self, input_path, pdf_path):
+        pdfkit.from_file(input_path, pdf_path, configuration=self.configuration)
+
+    def render_data(self, data, extension):
+        # the same call pdfkit makes, but reading stdin and writing stdout
+        return run_cmd_bytes(self.wkhtmltopdf, "--quiet", "-", "-", input_data=data)
+
+    def render_batch(self, documents):
+        """
+        renders all documents with one wkhtmltopdf process. every input starts on a new page, a separator page
+        between two documents marks where the combined pdf is split again
+        """
+        if len(documents) == 1:
+            self.render(*documents[0])
+            return
+        logger = logging.getLogger(__name__)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            separator = "reportgenerator-separator-" + uuid.uuid4().hex
+            separator_path = os.path.join(temp_dir, "separator.html")
+            with open(separator_path, "w") as separator_file:
+                separator_file.write("<html><body><p>{}</p></body></html>".format(separator))
+            input_paths = [separator_path] * (2 * len(documents) - 1)
+            input_paths[0::2] = [input_path for input_path, _ in documents]
+            combined_path = os.path.join(temp_dir, "combined.pdf")
+            pdfkit.from_file(input_paths, combined_path, configuration=self.configuration)
+            try:
+                split_pdf(combined_path, [pdf_path for _, pdf_path in documents], separator, temp_dir)
+            except ReportGeneratorError as error:
+                logger.warning("{}, rendering the {} documents one by one".format(error, len(documents)))
+                super().render_batch(documents)
+
+
+def create_pdf(page_count=1, width=595, height=842):
+    """
+    :return the bytes of a valid pdf with page_count empty pages
+    """
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+                   " ".join("{} 0 R".format(idx + 3) for idx in range(page_count)), page_count)]
+    for _ in range(page_count):
+        objects.append("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {} {}] >>".format(width, height))
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for idx, obj in enumerate(objects):
+        offsets.append(len(pdf))
+        pdf += "{} 0 obj\n{}\nendobj\n".format(idx + 1, obj).encode("ascii")
+    xref_offset = len(pdf)
+    pdf += "xref\n0 {}\n0000000000 65535 f \n".format(len(objects) + 1).encode("ascii")
+    for offset in offsets:
+        pdf += "{:010d} 00000 n \n".format(offset).encode("ascii")
+    pdf += "trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n".format(len(objects) + 1,
+                                                                                   xref_offset).encode("ascii")
+    return pdf
+
+
+def split_pdf(combined_path, pdf_paths, separator, temp_dir):
+    """
+    splits a pdf at the pages containing the separator text into len(pdf_paths) pdf files, the separator pages are
+    dropped. uses pdftotext, pdfseparate and pdfunite of poppler
+    """
+    # pdftotext ends every page with a form feed
+    page_texts = run_cmd_bytes("pdftotext", "-enc", "UTF-8", combined_path, "-").decode("utf-8", "replace")
+    page_texts = page_texts.split("\f")[:-1]
+    ranges = []
+    first_page = 1
+    for page, text in enumerate(page_texts, 1):
+        if separator in text:
+            ranges.append((first_page, page - 1))
+            first_page = page + 1
+    ranges.append((first_page, len(page_texts)))
+    if len(ranges) != len(pdf_paths) or any(first > last for first, last in ranges):
+        raise ReportGeneratorError("could not split {} at the separator pages into {} documents".format(
+            combined_path, len(pdf_paths)))
+    page_pattern = os.path.join(temp_dir, "split-page-%d.pdf")
+    run_cmd("pdfseparate", combined_path, page_pattern)
+    for (first, last), pdf_path in zip(ranges, pdf_paths):
+        pages = [page_pattern.replace("%d", str(page)) for page in range(first, last + 1)]
+        if len(pages) == 1:
+            shutil.move(pages[0], pdf_path)
+        else:
+            run_cmd("pdfunite", *pages, pdf_path)
+
+
+class FakeRenderer(Renderer):
+    """
+    renders empty pages without any external tool (one page per bytes_per_page bytes of input), for testing and
+    benchmarking on machines without Word or wkhtmltopdf
+    """
+
+    def __init__(self, render_time=0.0, bytes_per_page=4000):
+        self.render_time = render_time
+        self.bytes_per_page = bytes_per_page
+
+    def _create_pdf(self, input_size):
+        return create_pdf(max(1, -(-input_size // self.bytes_per_page)))
+
+    def render(self, input_path, pdf_path):
+        time.sleep(self.render_time)
+        with open(pdf_path, "wb") as pdf_file:
+            pdf_file.write(self._create_pdf(os.path.getsize(input_path)))
+
+    def render_data(self, data, extension):
+        time.sleep(self.render_time)
+        return self._create_pdf(len(data))
+
+    def render_batch(self, documents):
+        # one simulated startup for the whole batch
+        time.sleep(self.render_time)
+        for input_path, pdf_path in documents:
+            with open(pdf_path, "wb") as pdf_file:
+                pdf_file.write(self._create_pdf(os.path.getsize(input_path)))
+
+
+RENDERERS = {"word": WordRenderer, "wkhtmltopdf": WkhtmltopdfRenderer, "fake": FakeRenderer}
+
+
+class RendererPool:
+    """
+    a pool of long-lived renderers, each one owned by a worker thread. renderers are started lazily, replaced if a
+    health check fails or the render raised, and recycled after max_jobs_per_renderer jobs. if batch_size > 1, a
+    worker collects up to batch_size file jobs arriving within batch_wait seconds and renders them in one batch
+    """
+
+    def __init__(self, renderer_factory, size=1, max_jobs_per_renderer=100, job_timeout=300.0, batch_size=1,
+                 batch_wait=0.2):
+        self.renderer_factory = renderer_factory
+        self.size = size
+        self.max_jobs_per_renderer = max_jobs_per_renderer
+        self.job_timeout = job_timeout
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._jobs = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        for _ in range(size):
+            self._start_worker()
+
+    def _start_worker(self):
+        worker = threading.Thread(target=self._work, name="renderer", daemon=True)
+        with self._lock:
+            self._workers.append(worker)
+        worker.start()
+
+    def _collect_batch(self, job):
+        """
+        :return the batch started by job and the next job which does not fit into it or None
+        """
+        batch = [job]
+        if self.batch_size <= 1 or job[1] != "render":
+            return batch, None
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                next_job = self._jobs.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if next_job is None or next_job[1] != "render":
+                return batch, next_job
+            batch.append(next_job)
+        return batch, None
+
+    def _work(self):
+        logger = logging.getLogger(__name__)
+        renderer = None
+        jobs_done = 0
+        next_job = None
+        try:
+            while True:
+                job = next_job if next_job is not None else self._jobs.get()
+                if job is None:
+                    break
+                batch, next_job = self._collect_batch(job)
+                batch = [(future, method, args) for future, method, args in batch if
+                         future.set_running_or_notify_cancel()]
+                if not batch:
+                    continue
+                for future, _, _ in batch:
+                    future.taken.set()
+                try:
+                    if renderer is not None and (jobs_done >= self.max_jobs_per_renderer or not renderer.is_healthy()):
+                        logger.debug("recycling renderer after {} jobs".format(jobs_done))
+                        renderer.close()
+                        renderer = None
+                    if renderer is None:
+                        renderer = self.renderer_factory()
+                        renderer.start()
+                        jobs_done = 0
+                    if len(batch) == 1:
+                        future, method, args = batch[0]
+                        results = [getattr(renderer, method)(*args)]
+                    else:
+                        logger.debug("rendering a batch of {} documents".format(len(batch)))
+                        renderer.render_batch([args for _, _, args in batch])
+                        results = [None] * len(batch)
+                    jobs_done += len(batch)
+                    for (future, _, _), result in zip(batch, results):
+                        future.set_result(result)
+                except Exception as error:
+                    for future, _, _ in batch:
+                        future.set_exception(error)
+                    if renderer is not None:
+                        # do not reuse a renderer in an unknown state
+                        renderer.close()
+                        renderer = None
+                with self._lock:
+                    abandoned = any(future.abandoned for future, _, _ in batch)
+                if abandoned:
+                    # a job timed out and a replacement worker took over, so this one leaves
+                    if next_job is not None:
+                        self._jobs.put(next_job)
+                    break
+        finally:
+            if renderer is not None:
+                renderer.close()
+            with self._lock:
+                self._workers.remove(threading.current_thread())
+
+    def render(self, input_path, pdf_path):
+        self._run_job(input_path, "render", input_path, pdf_path)
+        return pdf_path
+
+    def render_data(self, data, extension):
+        """ :return the pdf bytes for the filled template bytes """
+        return self._run_job("document in memory", "render_data", data, extension)
+
+    def _run_job(self, name, method, *args):
+        from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+        future = Future()
+        future.abandoned = False
+        future.taken = threading.Event()
+        self._jobs.put((future, method, args))
+        # the timeout starts when a worker takes the job, not while it waits behind the jobs of other reports
+        future.taken.wait()
+        try:
+            return future.result(timeout=self.job_timeout)
+        except FutureTimeoutError:
+            with self._lock:
+                if future.done():
+                    # finished just in time
+                    return future.result()
+                # the worker is stuck inside the renderer: abandon it and start a replacement
+                future.abandoned = True
+            self._start_worker()
+            raise ReportGeneratorError("rendering {} timed out after {}s".format(name, self.job_timeout))
+
+    def close(self):
+        with self._lock:
+            workers = list(self._workers)
+        for _ in workers:
+            self._jobs.put(None)
+        for worker in workers:
+            worker.join(self.job_timeout)
+
+
+_renderer_pools = {}
+_renderer_pools_lock = threading.Lock()
+
+
+def resolve_renderer_name(config, template_is_word):
+    if config.renderer == "auto":
+        return "word" if template_is_word else "wkhtmltopdf"
+    return config.renderer
+
+
+def get_renderer_pool(config, template_is_word) -> RendererPool:
+    """
+    returns the process wide renderer pool for the configured renderer, it is created on first use
+    """
+    renderer_name = resolve_renderer_name(config, template_is_word)
+    key = (renderer_name, config.renderer_pool_size, config.renderer_max_jobs, config.renderer_job_timeout,
+           config.render_batch_size, config.render_batch_wait)
+    # report threads ask for the pool concurrently, all of them have to get the same one
+    with _renderer_pools_lock:
+        pool = _renderer_pools.get(key)
+        if pool is None:
+            pool = RendererPool(RENDERERS[renderer_name], config.renderer_pool_size, config.renderer_max_jobs,
+                                config.renderer_job_timeout, config.render_batch_size, config.render_batch_wait)
+            _renderer_pools[key] = pool
+    return pool
+
+
+@atexit.register
+def close_renderer_pools():
+    with _renderer_pools_lock:
+        pools = list(_renderer_pools.values())
+        _renderer_pools.clear()
+    for pool in pools:
+        pool.close()
+
+
 def setup_logging(log_level=logging.INFO, log_file=None):
     class InfoFilter(logging.Filter):
         def filter(self, rec):
@@ -196,6 +1045,264 @@ def quit(error):
     sys.exit(-1)
 
 
+class StageMetrics(DataObject):
+
+    def __init__(self, name=None):
+        super().__init__()
+        self.name = name
+        self.wall_time = 0.0
+        self.wait_time = 0.0  # for a free slot of the stage concurrency limit, not part of wall_time
+        self.cpu_time = 0.0  # of this process including all its threads
+        self.child_cpu_time = 0.0  # of the child processes which finished during the stage (always 0 on windows)
+        self.bytes_read = 0  # size of the stage input, files or in memory
+        self.bytes_written = 0  # size of the stage output, files or in memory
+        self.bytes_uncompressed = 0  # of the pixel data of the written page images (dcm_images stage)
+        self.pages = 0
+        self.peak_rss = None  # of this process in bytes at the end of the stage
+        self.cached = False  # the stage result was loaded from the artifact cache
+
+
+class CommandMetrics(DataObject):
+
+    def __init__(self, command=None, stage=None):
+        super().__init__()
+        self.command = command
+        self.stage = stage
+        self.wall_time = 0.0
+        self.child_cpu_time = 0.0  # exact only if no other command finished at the same time (always 0 on windows)
+        self.return_code = 0
+
+
+class ReportMetrics(DataObject):
+    """
+    the StageMetrics and CommandMetrics of one report, collected by process_report() while it is the current report
+    """
+
+    def __init__(self, dcm_sr_path=None):
+        super().__init__()
+        self.dcm_sr_path = dcm_sr_path
+        self.timestamp = time.time()
+        self.success = False
+        self.error = None  # type: Optional[str]
+        self.wall_time = 0.0
+        self.peak_rss = None
+        self.child_peak_rss = None
+        self.stages = []  # type: List[StageMetrics]
+        self.commands = []  # type: List[CommandMetrics]
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def to_dict(self):
+        data = super().to_dict()
+        data["stages"] = [stage.to_dict() for stage in self.stages]
+        data["commands"] = [command.to_dict() for command in self.commands]
+        return data
+
+
+# the metrics of the report being processed and its current stage, copied into the threads of run_pipeline()
+current_metrics = contextvars.ContextVar("current_metrics", default=None)
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+# stage name -> threading.Semaphore limiting how many reports run the stage at the same time
+stage_limits = contextvars.ContextVar("stage_limits", default=None)
+# called with the stage name after every completed or cached stage, e.g. to record it in the JobStore
+stage_done_callback = contextvars.ContextVar("stage_done_callback", default=None)
+# runs the external commands of run_cmd() and run_cmd_bytes() instead of subprocess.run(): called with the arguments
+# and the stdin bytes, returns the return code, stdout and stderr. the StageScheduler runs them in its event loop
+command_runner = contextvars.ContextVar("command_runner", default=None)
+_metrics_lock = threading.Lock()
+
+
+def get_child_cpu_time():
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+def get_peak_rss():
+    """ :return the peak resident set size in bytes of this process and of its finished child processes or None """
+    if resource is not None:
+        # kilobytes on linux, bytes on mac os
+        factor = 1 if sys.platform == "darwin" else 1024
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * factor,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * factor)
+    try:
+        return psutil.Process().memory_info().peak_wset, None
+    except (ImportError, AttributeError):
+        return None, None
+
+
+def get_file_sizes(*paths):
+    """ :return the total size of the files, items which are bytes count with their length """
+    size = 0
+    for path in paths:
+        if isinstance(path, bytes):
+            size += len(path)
+        elif path and os.path.isfile(path):
+            size += os.path.getsize(path)
+    return size
+
+
+@contextmanager
+def measure_stage(name):
+    """
+    measures the enclosed stage of the current report, the commands run by run_cmd() are attributed to it.
+    yields the StageMetrics so the stage can add bytes and pages
+    """
+    stage = StageMetrics(name)
+    metrics = current_metrics.get()
+    limits = stage_limits.get()
+    semaphore = limits.get(name) if limits else None
+    if semaphore is not None:
+        wait_start = time.perf_counter()
+        semaphore.acquire()
+        stage.wait_time = time.perf_counter() - wait_start
+    token = _current_stage.set(name)
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    child_cpu_start = get_child_cpu_time()
+    try:
+        yield stage
+    finally:
+        stage.wall_time = time.perf_counter() - start
+        stage.cpu_time = time.process_time() - cpu_start
+        stage.child_cpu_time = get_child_cpu_time() - child_cpu_start
+        stage.peak_rss = get_peak_rss()[0]
+        _current_stage.reset(token)
+        if semaphore is not None:
+            semaphore.release()
+        logging.getLogger(__name__).debug(
+            "stage {}: {:.3f}s wall, {:.3f}s cpu, {:.3f}s child cpu, {} bytes read, {} bytes written".format(
+                name, stage.wall_time, stage.cpu_time, stage.child_cpu_time, stage.bytes_read, stage.bytes_written))
+        if metrics is not None:
+            with _metrics_lock:
+                metrics.stages.append(stage)
+    done_callback = stage_done_callback.get()
+    if done_callback is not None:
+        done_callback(name)
+
+
+def record_command(command, wall_time, child_cpu_time=0.0, return_code=0):
+    """ adds an external command run to the metrics of the current report """
+    metrics = current_metrics.get()
+    if metrics is None:
+        return
+    command_metrics = CommandMetrics(os.path.splitext(os.path.basename(command))[0], _current_stage.get())
+    command_metrics.wall_time = wall_time
+    command_metrics.child_cpu_time = child_cpu_time
+    command_metrics.return_code = return_code
+    with _metrics_lock:
+        metrics.commands.append(command_metrics)
+
+
+# name: (type, help) of the metrics in the prometheus textfile
+PROMETHEUS_METRICS = {
+    "reportgen_reports_total": ("counter", "reports processed"),
+    "reportgen_report_seconds_total": ("counter", "wall time spent processing reports"),
+    "reportgen_stage_runs_total": ("counter", "stage runs"),
+    "reportgen_stage_cache_hits_total": ("counter", "stage results loaded from the artifact cache"),
+    "reportgen_stage_seconds_total": ("counter", "wall time spent in the stage"),
+    "reportgen_stage_cpu_seconds_total": ("counter", "cpu time of the report process spent in the stage"),
+    "reportgen_stage_child_cpu_seconds_total": ("counter", "cpu time of child processes spent in the stage"),
+    "reportgen_stage_read_bytes_total": ("counter", "size of the stage input files"),
+    "reportgen_stage_written_bytes_total": ("counter", "size of the stage output files"),
+    "reportgen_stage_pages_total": ("counter", "pages processed by the stage"),
+    "reportgen_stage_uncompressed_bytes_total": ("counter", "size of the uncompressed pixel data of the page images"),
+    "reportgen_command_runs_total": ("counter", "external command runs"),
+    "reportgen_command_failures_total": ("counter", "external command runs with a non zero return code"),
+    "reportgen_command_seconds_total": ("counter", "wall time of external commands"),
+    "reportgen_command_child_cpu_seconds_total": ("counter", "cpu time of external commands"),
+    "reportgen_peak_rss_bytes": ("gauge", "highest peak resident set size of a report process"),
+    "reportgen_child_peak_rss_bytes": ("gauge", "highest peak resident set size of a child process"),
+}
+
+
+class MetricsExporter:
+    """
+    appends the metrics of every report to a JSON lines file and keeps the totals of all reports exported by this
+    process in a prometheus textfile (e.g. for the node exporter textfile collector)
+    """
+
+    def __init__(self, json_lines_file=None, prometheus_file=None):
+        self.json_lines_file = json_lines_file
+        self.prometheus_file = prometheus_file
+        self.totals = {name: {} for name in PROMETHEUS_METRICS.keys()}  # name: {labels: value}
+        self._lock = threading.Lock()
+
+    def _add(self, name, value, **labels):
+        if value is None:
+            return
+        values = self.totals[name]
+        key = tuple(sorted(labels.items()))
+        if PROMETHEUS_METRICS[name][0] == "gauge":
+            values[key] = max(values.get(key, 0), value)
+        else:
+            values[key] = values.get(key, 0) + value
+
+    def add(self, metrics: Dict):
+        self._add("reportgen_reports_total", 1, status="success" if metrics["success"] else "failure")
+        self._add("reportgen_report_seconds_total", metrics["wall_time"])
+        self._add("reportgen_peak_rss_bytes", metrics["peak_rss"])
+        self._add("reportgen_child_peak_rss_bytes", metrics["child_peak_rss"])
+        for stage in metrics["stages"]:
+            if stage["cached"]:
+                self._add("reportgen_stage_cache_hits_total", 1, stage=stage["name"])
+                continue
+            self._add("reportgen_stage_runs_total", 1, stage=stage["name"])
+            self._add("reportgen_stage_seconds_total", stage["wall_time"], stage=stage["name"])
+            self._add("reportgen_stage_cpu_seconds_total", stage["cpu_time"], stage=stage["name"])
+            self._add("reportgen_stage_child_cpu_seconds_total", stage["child_cpu_time"], stage=stage["name"])
+            self._add("reportgen_stage_read_bytes_total", stage["bytes_read"], stage=stage["name"])
+            self._add("reportgen_stage_written_bytes_total", stage["bytes_written"], stage=stage["name"])
+            self._add("reportgen_stage_pages_total", stage["pages"], stage=stage["name"])
+            self._add("reportgen_stage_uncompressed_bytes_total", stage["bytes_uncompressed"], stage=stage["name"])
+        for command in metrics["commands"]:
+            self._add("reportgen_command_runs_total", 1, command=command["command"])
+            self._add("reportgen_command_failures_total", 1 if command["return_code"] else 0,
+                      command=command["command"])
+            self._add("reportgen_command_seconds_total", command["wall_time"], command=command["command"])
+            self._add("reportgen_command_child_cpu_seconds_total", command["child_cpu_time"],
+                      command=command["command"])
+
+    def format_prometheus(self):
+        lines = []
+        for name, (metric_type, help_text) in PROMETHEUS_METRICS.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for labels, value in sorted(self.totals[name].items()):
+                label_str = ",".join("{}=\"{}\"".format(key, label_value) for key, label_value in labels)
+                lines.append("{}{} {}".format(name, "{" + label_str + "}" if label_str else "", value))
+        return "\n".join(lines) + "\n"
+
+    def export(self, metrics: Optional[Dict]):
+        """ :param metrics a ReportMetrics.to_dict(), ignored if None """
+        if metrics is None:
+            return
+        with self._lock:
+            if self.json_lines_file:
+                with open(self.json_lines_file, "a") as out_file:
+                    out_file.write(json.dumps(metrics) + "\n")
+            if self.prometheus_file:
+                self.add(metrics)
+                # the textfile collector must never see a partially written file
+                with open(self.prometheus_file + ".tmp", "w") as out_file:
+                    out_file.write(self.format_prometheus())
+                os.replace(self.prometheus_file + ".tmp", self.prometheus_file)
+
+
+def create_metrics_exporter(config) -> Optional[MetricsExporter]:
+    if not config.metrics_file and not config.metrics_prometheus_file:
+        return None
+    return MetricsExporter(config.metrics_file, config.metrics_prometheus_file)
+
+
+def _run_process(args, input_data=None):
+    """ :return the return code, stdout and stderr of the command, run by the command_runner if one is set """
+    runner = command_runner.get()
+    if runner is not None:
+        return runner(args, input_data)
+    result = subprocess.run(args, input=input_data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return result.returncode, result.stdout, result.stderr
+
+
 def run_cmd(*args, print_stdout=False, exit_on_error=True):
     logger = logging.getLogger(__name__)
     cmd = ' '.join(args)
@@ -207,38 +1314,534 @@ def run_cmd(*args, print_stdout=False, exit_on_error=True):
         stderr = subprocess.PIPE
         stdout = stderr
 
-    result = subprocess.run(args, stdout=stdout, stderr=stderr)
-    if result.returncode != 0 and exit_on_error:
-        quit(
-            "cmd \"{}\" failed with code {} the following output: {}. aborting.".format(cmd, str(result.returncode),
-                                                                                        result.stdout))
-    return result.stdout.decode("utf-8").strip() if result.stdout else None
+    start = time.perf_counter()
+    child_cpu_start = get_child_cpu_time()
+    if print_stdout:
+        return_code = subprocess.run(args, stdout=stdout, stderr=stderr).returncode
+        output = None
+    else:
+        return_code, output, _ = _run_process(args)
+    record_command(args[0], time.perf_counter() - start, get_child_cpu_time() - child_cpu_start, return_code)
+    if return_code != 0 and exit_on_error:
+        raise ReportGeneratorError(
+            "cmd \"{}\" failed with code {} the following output: {}. aborting.".format(cmd, str(return_code),
+                                                                                        output))
+    return output.decode("utf-8").strip() if output else None
 
 
-def replace_in_docx(docx_path, data, output_docx_path):
-    doc = Document(docx_path)
-    for i in data:
-        for p in doc.paragraphs:
-            if p.text.find(i) >= 0:
-                p.text = p.text.replace(i, data[i])
-    # save changed document
-    doc.save(output_docx_path)
+def run_cmd_bytes(*args, input_data=None):
+    """
+    like run_cmd, but passes input_data to stdin and returns stdout as bytes, for tools used as filters
+    """
+    logger = logging.getLogger(__name__)
+    cmd = ' '.join(args)
+    logger.debug("running the following command: {}".format(cmd))
+    start = time.perf_counter()
+    child_cpu_start = get_child_cpu_time()
+    return_code, output, error_output = _run_process(args, input_data)
+    record_command(args[0], time.perf_counter() - start, get_child_cpu_time() - child_cpu_start, return_code)
+    if return_code != 0:
+        raise ReportGeneratorError(
+            "cmd \"{}\" failed with code {} the following output: {}. aborting.".format(cmd, str(return_code),
+                                                                                        error_output))
+    return output
+
+
+SR_DOCUMENT_TYPES = {
+    "1.2.840.10008.5.1.4.1.1.88.11": "Basic Text SR",
+    "1.2.840.10008.5.1.4.1.1.88.22": "Enhanced SR",
+    "1.2.840.10008.5.1.4.1.1.88.33": "Comprehensive SR",
+    "1.2.840.10008.5.1.4.1.1.88.34": "Comprehensive 3D SR",
+    "1.2.840.10008.5.1.4.1.1.88.40": "Procedure Log",
+    "1.2.840.10008.5.1.4.1.1.88.50": "Mammography CAD SR",
+    "1.2.840.10008.5.1.4.1.1.88.59": "Key Object Selection Document",
+    "1.2.840.10008.5.1.4.1.1.88.65": "Chest CAD SR",
+    "1.2.840.10008.5.1.4.1.1.88.67": "X-Ray Radiation Dose SR",
+    "1.2.840.10008.5.1.4.1.1.88.68": "Radiopharmaceutical Radiation Dose SR",
+    "1.2.840.10008.5.1.4.1.1.88.69": "Colon CAD SR",
+    "1.2.840.10008.5.1.4.1.1.88.70": "Implantation Plan SR Document",
+    "1.2.840.10008.5.1.4.1.1.88.71": "Acquisition Context SR",
+    "1.2.840.10008.5.1.4.1.1.88.72": "Simplified Adult Echo SR",
+    "1.2.840.10008.5.1.4.1.1.88.73": "Patient Radiation Dose SR",
+}
+
+
+def _xml_date(value):
+    value = str(value) if value else ""
+    return "{}-{}-{}".format(value[0:4], value[4:6], value[6:8]) if len(value) >= 8 else value
+
+
+def _xml_time(value):
+    value = str(value).split(".")[0] if value else ""
+    return "{}:{}:{}".format(value[0:2], value[2:4], value[4:6]) if len(value) >= 6 else value
+
+
+def _xml_datetime(value):
+    value = str(value) if value else ""
+    return _xml_date(value[0:8]) + ("T" + _xml_time(value[8:]) if len(value) > 8 else "")
+
+
+def _dicom_multi_value_string(value, separator="\\"):
+    if value is None or isinstance(value, (str, bytes)) or not hasattr(value, "__iter__"):
+        return value
+    return separator.join(str(item) for item in value)
+
+
+def _add_xml_value(parent, tag, value):
+    """ adds <tag>value</tag> to parent like dsr2xml does, i.e. empty values are omitted """
+    value = str(value) if value is not None else ""
+    if not value:
+        return None
+    element = ET.SubElement(parent, tag)
+    element.text = value
+    return element
 
 
-def replace_in_text_file(in_file, data: Dict, out_file):
-    # Read in the file
-    with open(in_file, mode='r') as file:
-        file_data = file.read()
+def _add_xml_person_name(parent, tag, value):
+    if not value:
+        return None
+    element = ET.SubElement(parent, tag)
+    components = str(value).split("=")[0].split("^") + [""] * 5
+    last, first, middle, prefix, suffix = components[0:5]
+    for component_tag, component in (("prefix", prefix), ("first", first), ("middle", middle), ("last", last),
+                                     ("suffix", suffix)):
+        _add_xml_value(element, component_tag, component)
+    return element
+
+
+def _add_xml_code(parent, item):
+    _add_xml_value(parent, "value", item.get("CodeValue") or item.get("LongCodeValue") or item.get("URNCodeValue"))
+    scheme = ET.SubElement(parent, "scheme")
+    _add_xml_value(scheme, "designator", item.get("CodingSchemeDesignator"))
+    _add_xml_value(scheme, "version", item.get("CodingSchemeVersion"))
+    _add_xml_value(parent, "meaning", item.get("CodeMeaning"))
+
+
+def _add_xml_composite_reference(parent, item):
+    for referenced_sop in item.get("ReferencedSOPSequence", []):
+        sop_class_uid = str(referenced_sop.get("ReferencedSOPClassUID", ""))
+        sop_class = ET.SubElement(parent, "sopclass", uid=sop_class_uid)
+        sop_class.text = referenced_sop.ReferencedSOPClassUID.name if sop_class_uid else None
+        ET.SubElement(parent, "instance", uid=str(referenced_sop.get("ReferencedSOPInstanceUID", "")))
+        frames = referenced_sop.get("ReferencedFrameNumber")
+        if frames:
+            _add_xml_value(parent, "frames", _dicom_multi_value_string(frames, ","))
+
+
+def _add_xml_content_item(parent, item):
+    value_type = str(item.get("ValueType", "")).lower()
+    if "ReferencedContentItemIdentifier" in item:
+        element = ET.SubElement(parent, "reference")
+    elif value_type == "container":
+        element = ET.SubElement(parent, "container", flag=str(item.get("ContinuityOfContent", "SEPARATE")))
+    else:
+        element = ET.SubElement(parent, value_type)
+    _add_xml_value(element, "relationship", item.get("RelationshipType"))
+    for concept_item in item.get("ConceptNameCodeSequence", []):
+        concept = ET.SubElement(element, "concept")
+        _add_xml_code(concept, concept_item)
+    if item.get("ObservationDateTime"):
+        observation = ET.SubElement(element, "observation")
+        _add_xml_value(observation, "datetime", _xml_datetime(item.ObservationDateTime))
+
+    if "ReferencedContentItemIdentifier" in item:
+        _add_xml_value(element, "value", ".".join(str(i) for i in item.ReferencedContentItemIdentifier))
+    elif value_type == "text":
+        _add_xml_value(element, "value", item.get("TextValue"))
+    elif value_type == "code":
+        for code_item in item.get("ConceptCodeSequence", []):
+            _add_xml_code(ET.SubElement(element, "value"), code_item)
+    elif value_type == "num":
+        for measured_value in item.get("MeasuredValueSequence", []):
+            _add_xml_value(element, "value", measured_value.get("NumericValue"))
+            for unit_item in measured_value.get("MeasurementUnitsCodeSequence", []):
+                _add_xml_code(ET.SubElement(element, "unit"), unit_item)
+    elif value_type == "pname":
+        _add_xml_person_name(element, "value", item.get("PersonName"))
+    elif value_type == "date":
+        _add_xml_value(element, "value", _xml_date(item.get("Date")))
+    elif value_type == "time":
+        _add_xml_value(element, "value", _xml_time(item.get("Time")))
+    elif value_type == "datetime":
+        _add_xml_value(element, "value", _xml_datetime(item.get("DateTime")))
+    elif value_type == "uidref":
+        _add_xml_value(element, "value", item.get("UID"))
+    elif value_type in ("image", "composite", "waveform"):
+        _add_xml_composite_reference(ET.SubElement(element, "value"), item)
+    elif value_type in ("scoord", "scoord3d"):
+        element.set("type", str(item.get("GraphicType", "")))
+        graphic_data = item.get("GraphicData", [])
+        dimensions = 3 if value_type == "scoord3d" else 2
+        _add_xml_value(element, "data", ",".join(
+            "/".join(str(value) for value in graphic_data[i:i + dimensions])
+            for i in range(0, len(graphic_data), dimensions)))
+
+    for child_item in item.get("ContentSequence", []):
+        _add_xml_content_item(element, child_item)
+    return element
+
+
+def load_sr_xml(sr_xml_file, config, rule_program):
+    """ :return the tree of the xml file, only with the parts the rules need if streaming extraction is on """
+    logger = logging.getLogger(__name__)
+    if config.streaming_extraction and rule_program.stream_paths is not None:
+        logger.info("retrieving contents from XML file {} (streaming)".format(sr_xml_file))
+        return parse_xml_pruned(sr_xml_file, rule_program.stream_paths)
+    logger.info("retrieving contents from XML file {}".format(sr_xml_file))
+    return ET.parse(sr_xml_file)
+
+
+def get_native_ignored_options(dsr2xml_options):
+    """
+    :return the dsr2xml options the native converter does not apply, apart from the layout options which
+    Config.validate() rejects
+    """
+    ignored_options = []
+    options = iter(dsr2xml_options)
+    for option in options:
+        if option in DSR2XML_VALUE_OPTIONS:
+            next(options, None)
+        elif option not in DSR2XML_NATIVE_OPTIONS and option not in DSR2XML_LAYOUT_OPTIONS:
+            ignored_options.append(option)
+    return ignored_options
+
 
-    # Replace the target string
-    for placeholder, new_text in data.items():
-        file_data = file_data.replace(placeholder, new_text)
+def sr_to_xml_tree(dcm_sr_path):
+    """
+    native replacement for "dsr2xml -Ee -Ec": reads the DICOM SR with pydicom and builds the xml tree in memory
+    using the same element layout dsr2xml writes by default (no +Ea/+Ec/... attribute encodings), so xpath
+    expressions like /report/document/content/container/text/value/text() work on both.
+    coding scheme and evidence sections are not generated.
+    :return an lxml ElementTree
+    """
+    import pydicom
+
+    dataset = pydicom.dcmread(dcm_sr_path)
+    sop_class_uid = str(dataset.get("SOPClassUID", ""))
+    report = ET.Element("report", type=SR_DOCUMENT_TYPES.get(sop_class_uid, "unknown"))
+    sop_class = ET.SubElement(report, "sopclass", uid=sop_class_uid)
+    sop_class.text = dataset.SOPClassUID.name if sop_class_uid else None
+    _add_xml_value(report, "charset", _dicom_multi_value_string(dataset.get("SpecificCharacterSet")))
+    _add_xml_value(report, "timezone", dataset.get("TimezoneOffsetFromUTC"))
+    _add_xml_value(report, "modality", dataset.get("Modality"))
+    if dataset.get("ManufacturerModelName"):
+        device = ET.SubElement(report, "device")
+        _add_xml_value(device, "manufacturer", dataset.get("Manufacturer"))
+        _add_xml_value(device, "model", dataset.get("ManufacturerModelName"))
+        _add_xml_value(device, "serial", dataset.get("DeviceSerialNumber"))
+        _add_xml_value(device, "version", dataset.get("SoftwareVersions"))
+    else:
+        _add_xml_value(report, "manufacturer", dataset.get("Manufacturer"))
+    if dataset.get("ReferringPhysicianName"):
+        _add_xml_person_name(ET.SubElement(report, "referringphysician"), "name", dataset.ReferringPhysicianName)
+
+    patient = ET.SubElement(report, "patient")
+    _add_xml_value(patient, "id", dataset.get("PatientID"))
+    _add_xml_person_name(patient, "name", dataset.get("PatientName"))
+    if dataset.get("PatientBirthDate"):
+        _add_xml_value(ET.SubElement(patient, "birthday"), "date", _xml_date(dataset.PatientBirthDate))
+    _add_xml_value(patient, "sex", dataset.get("PatientSex"))
+
+    study = ET.SubElement(report, "study", uid=str(dataset.get("StudyInstanceUID", "")))
+    _add_xml_value(study, "id", dataset.get("StudyID"))
+    _add_xml_value(study, "date", _xml_date(dataset.get("StudyDate")))
+    _add_xml_value(study, "time", _xml_time(dataset.get("StudyTime")))
+    _add_xml_value(study, "accession", dataset.get("AccessionNumber"))
+    _add_xml_value(study, "description", dataset.get("StudyDescription"))
+
+    series = ET.SubElement(report, "series", uid=str(dataset.get("SeriesInstanceUID", "")))
+    _add_xml_value(series, "number", dataset.get("SeriesNumber"))
+    _add_xml_value(series, "description", dataset.get("SeriesDescription"))
+
+    instance = ET.SubElement(report, "instance", uid=str(dataset.get("SOPInstanceUID", "")))
+    _add_xml_value(instance, "number", dataset.get("InstanceNumber"))
+    if dataset.get("InstanceCreationDate") or dataset.get("InstanceCreatorUID"):
+        creation = ET.SubElement(instance, "creation")
+        if dataset.get("InstanceCreatorUID"):
+            creation.set("uid", str(dataset.InstanceCreatorUID))
+        _add_xml_value(creation, "date", _xml_date(dataset.get("InstanceCreationDate")))
+        _add_xml_value(creation, "time", _xml_time(dataset.get("InstanceCreationTime")))
+
+    document = ET.SubElement(report, "document")
+    if dataset.get("PreliminaryFlag"):
+        ET.SubElement(document, "preliminary", flag=str(dataset.PreliminaryFlag))
+    if dataset.get("CompletionFlag"):
+        completion = ET.SubElement(document, "completion", flag=str(dataset.CompletionFlag))
+        _add_xml_value(completion, "description", dataset.get("CompletionFlagDescription"))
+    if dataset.get("VerificationFlag"):
+        verification = ET.SubElement(document, "verification", flag=str(dataset.VerificationFlag))
+        for idx, observer in enumerate(dataset.get("VerifyingObserverSequence", [])):
+            observer_element = ET.SubElement(verification, "observer", pos=str(idx + 1))
+            _add_xml_value(observer_element, "datetime", _xml_datetime(observer.get("VerificationDateTime")))
+            _add_xml_person_name(observer_element, "name", observer.get("VerifyingObserverName"))
+            _add_xml_value(observer_element, "organization", observer.get("VerifyingOrganization"))
+    content = ET.SubElement(document, "content")
+    _add_xml_value(content, "date", _xml_date(dataset.get("ContentDate")))
+    _add_xml_value(content, "time", _xml_time(dataset.get("ContentTime")))
+    _add_xml_content_item(content, dataset)
+    return ET.ElementTree(report)
+
+
+class TextTemplate:
+    """
+    a text (e.g. html) template compiled into static chunks and placeholder slots, filling it is a single join
+    """
+
+    __slots__ = ("segments", "slots")
+
+    def __init__(self, text, placeholders):
+        placeholders = sorted((placeholder for placeholder in placeholders if placeholder), key=len, reverse=True)
+        self.segments = []  # static text at even, placeholder names at odd indices
+        self.slots = []  # (index in segments, placeholder)
+        if not placeholders:
+            self.segments.append(text)
+            return
+        pattern = re.compile("|".join(re.escape(placeholder) for placeholder in placeholders))
+        position = 0
+        for match in pattern.finditer(text):
+            self.segments.append(text[position:match.start()])
+            self.slots.append((len(self.segments), match.group(0)))
+            self.segments.append(match.group(0))
+            position = match.end()
+        self.segments.append(text[position:])
+
+    @classmethod
+    def from_segments(cls, segments, slots):
+        template = cls.__new__(cls)
+        template.segments = segments
+        template.slots = slots
+        return template
+
+    def fill(self, data: Dict):
+        segments = list(self.segments)
+        for idx, placeholder in self.slots:
+            if placeholder in data:
+                segments[idx] = data[placeholder]
+        return "".join(segments)
+
+
+_text_template_cache = {}  # path -> (mtime, placeholders, TextTemplate)
+
+
+def load_text_template(path, placeholders) -> TextTemplate:
+    """
+    returns the compiled template for path, reading and compiling it only if it is not cached or changed on disk
+    """
+    path = os.path.realpath(path)
+    mtime = os.stat(path).st_mtime_ns
+    placeholders = frozenset(placeholders)
+    cached = _text_template_cache.get(path)
+    if cached is not None and cached[0] == mtime and cached[1] == placeholders:
+        return cached[2]
+    logging.getLogger(__name__).debug("compiling text template {}".format(path))
+    with open(path, mode='r') as file:
+        template = TextTemplate(file.read(), placeholders)
+    _text_template_cache[path] = (mtime, placeholders, template)
+    return template
+
+
+def fill_text_template(in_file, data: Dict):
+    """ :return the bytes replace_in_text_file() writes """
+    file_data = load_text_template(in_file, data.keys()).fill(data).replace("\n", os.linesep)
+    return file_data.encode(locale.getpreferredencoding(False), errors="xmlcharrefreplace")
+
+
+def replace_in_text_file(in_file, data: Dict, out_file):
+    file_data = load_text_template(in_file, data.keys()).fill(data)
 
     # Write the file out again
     with open(out_file, 'w', errors='xmlcharrefreplace') as file:
         file.write(file_data)
 
 
+DOCX_TEXT_PARTS = re.compile(r"word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml")
+# a run text node (group 1: start tag, group 2: text) or the start or end of a paragraph, a tab or a line break, which
+# end the text a placeholder can span
+DOCX_TEXT_TOKENS = re.compile(r"(<w:t(?:\s[^>]*)?>)([^<]*)</w:t>|<w:p[\s>]|</w:p>|<w:(?:tab|br|cr)\b")
+DOCX_BREAKS = {"\n": '</w:t><w:br/><w:t xml:space="preserve">', "\t": '</w:t><w:tab/><w:t xml:space="preserve">'}
+
+
+def escape_docx_text(text):
+    """ :return text as the content of a w:t element, line breaks and tabs become w:br and w:tab elements """
+    text = str(text).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    for char, element in DOCX_BREAKS.items():
+        text = text.replace(char, element)
+    return text
+
+
+def compile_docx_part(xml, placeholders) -> Optional[TextTemplate]:
+    """
+    compiles a word xml part into a TextTemplate over its raw xml, or returns None if no placeholder occurs in it.
+    a placeholder may be split across the runs of a paragraph: the replacement goes into the text node where the
+    placeholder starts, keeping the formatting of that run, and the rest of the placeholder is cut from the following
+    text nodes
+    """
+    escaped = {escape_docx_text(placeholder): placeholder for placeholder in placeholders if placeholder}
+    if not escaped:
+        return None
+    pattern = re.compile("|".join(re.escape(placeholder) for placeholder in sorted(escaped, key=len, reverse=True)))
+    edits = []  # (start, end, replacement): static xml or a placeholder from slot_edits
+
+    def add_matches(nodes):
+        text = "".join(xml[start:end] for _, start, end in nodes)
+        if not pattern.search(text):
+            return
+        node_ends = []
+        position = 0
+        for _, start, end in nodes:
+            position += end - start
+            node_ends.append(position)
+        touched = set()
+        for match in pattern.finditer(text):
+            first = True
+            node_start = 0
+            for idx, (_, start, end) in enumerate(nodes):
+                node_end = node_ends[idx]
+                cut_start, cut_end = max(match.start(), node_start), min(match.end(), node_end)
+                if cut_start < cut_end:
+                    if first:
+                        first = False
+                        edits.append((start + cut_start - node_start, start + cut_start - node_start,
+                                      (escaped[match.group(0)],)))
+                    edits.append((start + cut_start - node_start, start + cut_end - node_start, ""))
+                    touched.add(idx)
+                node_start = node_end
+        for idx in touched:
+            tag_start, start, _ = nodes[idx]
+            if "xml:space" not in xml[tag_start:start]:
+                edits.append((tag_start + len("<w:t"), tag_start + len("<w:t"), ' xml:space="preserve"'))
+
+    nodes = []  # (start of the start tag, start, end of the text) of the text nodes of the current paragraph
+    for token in DOCX_TEXT_TOKENS.finditer(xml):
+        if token.group(1) is not None:
+            nodes.append((token.start(1), token.start(2), token.end(2)))
+        elif nodes:
+            add_matches(nodes)
+            nodes = []
+    if nodes:
+        add_matches(nodes)
+    if not edits:
+        return None
+
+    segments = []
+    slots = []
+    position = 0
+    static = []
+    # insertions at a position go before the cut starting there, both sort before any later edit
+    for start, end, replacement in sorted(edits, key=lambda edit: (edit[0], edit[1] - edit[0])):
+        static.append(xml[position:start])
+        if isinstance(replacement, tuple):
+            segments.append("".join(static))
+            slots.append((len(segments), replacement[0]))
+            segments.append(replacement[0])
+            static = []
+        else:
+            static.append(replacement)
+        position = max(position, end)
+    static.append(xml[position:])
+    segments.append("".join(static))
+    return TextTemplate.from_segments(segments, slots)
+
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+class DocxTemplate:
+    """
+    a docx template with the placeholders of its text parts (document, headers, footers, foot- and endnotes) located
+    once. filling it copies the other zip members byte-for-byte from the template and only rewrites the parts that
+    contain placeholders, without loading the document into python-docx
+    """
+
+    def __init__(self, path, placeholders):
+        self.members = []  # (name bytes, flags, date, time, external attributes, local entry bytes or None, info)
+        self.parts = {}  # name -> TextTemplate of the parts with placeholders
+        with ZipFile(path) as template, open(path, mode="rb") as file:
+            for info in template.infolist():
+                if DOCX_TEXT_PARTS.fullmatch(info.filename):
+                    part = compile_docx_part(template.read(info).decode("utf-8"), placeholders)
+                    if part is not None:
+                        self.parts[info.filename] = part
+                        self.members.append(self._member(info, None, 0, 0, 0))
+                        continue
+                file.seek(info.header_offset)
+                header = file.read(30)
+                name_length, extra_length = struct.unpack("<HH", header[26:30])
+                file.seek(info.header_offset + 30 + name_length + extra_length)
+                self.members.append(self._member(info, file.read(info.compress_size), info.CRC, info.compress_size,
+                                                 info.file_size))
+
+    @staticmethod
+    def _member(info, data, crc, compress_size, file_size):
+        name = info.filename.encode("utf-8" if info.flag_bits & 0x800 else "cp437")
+        flags = info.flag_bits & 0x800  # no data descriptor: the sizes are known when writing the local header
+        dos_time, dos_date = _dos_date_time(info.date_time)
+        member = [name, flags, info.compress_type, dos_time, dos_date, crc, compress_size, file_size,
+                  info.external_attr, None]
+        if data is not None:
+            member[9] = DocxTemplate._local_header(member) + data
+        return member
+
+    @staticmethod
+    def _local_header(member):
+        name, flags, compress_type, dos_time, dos_date, crc, compress_size, file_size = member[:8]
+        return struct.pack("<IHHHHHIIIHH", 0x04034b50, 20, flags, compress_type, dos_time, dos_date, crc,
+                           compress_size, file_size, len(name), 0) + name
+
+    def fill(self, data: Dict, out_file):
+        """ writes the filled docx to out_file, a path or a binary file object """
+        if isinstance(out_file, (str, bytes, os.PathLike)):
+            with open(out_file, mode="wb") as file:
+                return self.fill(data, file)
+        values = {placeholder: escape_docx_text(value) for placeholder, value in data.items()}
+        offset = 0
+        central_directory = []
+        for member in self.members:
+            name, flags, compress_type, dos_time, dos_date, crc, compress_size, file_size, attributes, entry = member
+            if entry is None:
+                content = self.parts[name.decode("utf-8" if flags & 0x800 else "cp437")].fill(values).encode("utf-8")
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                compressed = compressor.compress(content) + compressor.flush()
+                compress_type, crc, compress_size, file_size = ZIP_DEFLATED, zlib.crc32(content), len(compressed), \
+                    len(content)
+                entry = self._local_header([name, flags, compress_type, dos_time, dos_date, crc, compress_size,
+                                            file_size]) + compressed
+            out_file.write(entry)
+            central_directory.append(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 20, 20, flags, compress_type,
+                                                 dos_time, dos_date, crc, compress_size, file_size, len(name), 0, 0, 0,
+                                                 0, attributes, offset) + name)
+            offset += len(entry)
+        central_directory = b"".join(central_directory)
+        out_file.write(central_directory)
+        out_file.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, len(self.members), len(self.members),
+                                   len(central_directory), offset, 0))
+
+
+_docx_template_cache = {}  # path -> (mtime, placeholders, DocxTemplate)
+
+
+def load_docx_template(path, placeholders) -> DocxTemplate:
+    """
+    returns the compiled docx template for path, reading and compiling it only if it is not cached or changed on disk
+    """
+    path = os.path.realpath(path)
+    mtime = os.stat(path).st_mtime_ns
+    placeholders = frozenset(placeholders)
+    cached = _docx_template_cache.get(path)
+    if cached is not None and cached[0] == mtime and cached[1] == placeholders:
+        return cached[2]
+    logging.getLogger(__name__).debug("compiling docx template {}".format(path))
+    template = DocxTemplate(path, placeholders)
+    _docx_template_cache[path] = (mtime, placeholders, template)
+    return template
+
+
+def replace_in_docx(docx_path, data, output_docx_path):
+    load_docx_template(docx_path, data.keys()).fill(data, output_docx_path)
+
+
 def create_default_config(target_dir):
     # create default config
     config = Config()
@@ -403,140 +2006,1668 @@ def create_installer(log_level=logging.INFO, log_file=None):
     shutil.rmtree("../tmp")
 
 
-def generate_report(dcm_sr_path, config_file, log_level, log_file):
-    # logging
-    setup_logging(log_level, log_file)
+# attributes img2dcm/pdf2dcm copy with --series-from
+SERIES_FROM_KEYWORDS = ("SpecificCharacterSet", "PatientName", "PatientID", "IssuerOfPatientID", "PatientBirthDate",
+                        "PatientSex", "StudyInstanceUID", "StudyDate", "StudyTime", "ReferringPhysicianName", "StudyID",
+                        "AccessionNumber", "StudyDescription", "SeriesInstanceUID", "SeriesNumber")
+
+SECONDARY_CAPTURE_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.7"
+MULTIFRAME_GRAYSCALE_BYTE_SECONDARY_CAPTURE_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.7.2"
+MULTIFRAME_TRUE_COLOR_SECONDARY_CAPTURE_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.7.4"
+ENCAPSULATED_PDF_STORAGE = "1.2.840.10008.5.1.4.1.1.104.1"
+JPEG_BASELINE_TRANSFER_SYNTAX = "1.2.840.10008.1.2.4.50"
+EXPLICIT_VR_LITTLE_ENDIAN_TRANSFER_SYNTAX = "1.2.840.10008.1.2.1"
+
+
+def parse_dcmtk_key_options(options: List[str]):
+    """
+    extracts the "--key"/"-k" "tag=value" pairs from dcmtk command line options
+    :return a list of (tag, value) and the list of the other options
+    """
+    keys = []
+    other_options = []
+    idx = 0
+    while idx < len(options):
+        option = options[idx]
+        if option in ("--key", "-k") and idx + 1 < len(options):
+            tag, _, value = options[idx + 1].partition("=")
+            keys.append((tag.strip(), value))
+            idx += 2
+        else:
+            other_options.append(option)
+            idx += 1
+    return keys, other_options
+
+
+class DicomEncoder:
+    """
+    in-process replacement for img2dcm and pdf2dcm: reads the patient, study and series attributes of the DICOM SR
+    once and writes Secondary Capture and Encapsulated PDF objects in the same series
+    """
+
+    def __init__(self, dcm_sr_path, additional_keys=None):
+        import pydicom
+
+        sr_dataset = pydicom.dcmread(dcm_sr_path, stop_before_pixels=True)
+        self.series_dataset = pydicom.Dataset()
+        for keyword in SERIES_FROM_KEYWORDS:
+            if keyword in sr_dataset:
+                self.series_dataset[keyword] = sr_dataset[keyword]
+        self.additional_keys = additional_keys if additional_keys else []
+
+    def _create_dataset(self, sop_class_uid, sop_instance_uid, transfer_syntax_uid):
+        import pydicom
+
+        dataset = copy.deepcopy(self.series_dataset)
+        dataset.file_meta = pydicom.dataset.FileMetaDataset()
+        dataset.file_meta.MediaStorageSOPClassUID = sop_class_uid
+        dataset.file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+        dataset.file_meta.TransferSyntaxUID = transfer_syntax_uid
+        now = time.localtime()
+        dataset.InstanceCreationDate = time.strftime("%Y%m%d", now)
+        dataset.InstanceCreationTime = time.strftime("%H%M%S", now)
+        dataset.SOPClassUID = sop_class_uid
+        dataset.SOPInstanceUID = sop_instance_uid
+        dataset.ContentDate = dataset.InstanceCreationDate
+        dataset.ContentTime = dataset.InstanceCreationTime
+        dataset.Modality = "OT"
+        dataset.ConversionType = "WSD"
+        dataset.setdefault("SeriesNumber", None)
+        dataset.InstanceNumber = 1
+        return dataset
+
+    def _write(self, dataset, dcm_file, keys):
+        import pydicom
+
+        for tag, value in list(self.additional_keys) + list(keys):
+            self.set_key(dataset, tag, value)
+        dataset.file_meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+        pydicom.dcmwrite(dcm_file, dataset, enforce_file_format=True)
+
+    @staticmethod
+    def set_key(dataset, tag, value):
+        """ sets a "gggg,eeee" or keyword tag like the dcmtk --key option """
+        import pydicom
+
+        if "," in tag:
+            group, element = tag.strip("()").split(",")
+            tag = pydicom.tag.Tag(int(group, 16), int(element, 16))
+        else:
+            tag = pydicom.tag.Tag(tag)
+        vr = pydicom.datadict.dictionary_VR(tag)
+        dataset[tag] = pydicom.DataElement(tag, vr, value if value != "" else None)
+
+    def write_secondary_capture(self, image_file, dcm_file, instance_number, sop_instance_uid, keys=(),
+                                bitonal=False):
+        """
+        wraps the jpeg file (or jpeg bytes) as-is (JPEG Baseline transfer syntax) like img2dcm does. other images
+        (png) are stored uncompressed, with black and white pixels only if bitonal
+        """
+        from PIL import Image
+
+        if isinstance(image_file, bytes):
+            image_data = image_file
+        else:
+            with open(image_file, "rb") as input_file:
+                image_data = input_file.read()
+        is_jpeg = image_data.startswith(JPEG_START_OF_IMAGE)
+        with Image.open(io.BytesIO(image_data)) as image:
+            if bitonal:
+                image = image.convert("L").point(lambda value: 255 if value >= 128 else 0)
+            elif not is_jpeg and image.mode not in ("L", "RGB"):
+                image = image.convert("L" if len(image.getbands()) < 3 else "RGB")
+            columns, rows = image.size
+            samples_per_pixel = len(image.getbands())
+            pixel_data = image.tobytes() if not is_jpeg else None
+
+        dataset = self._create_dataset(SECONDARY_CAPTURE_IMAGE_STORAGE, sop_instance_uid,
+                                       JPEG_BASELINE_TRANSFER_SYNTAX if is_jpeg else
+                                       EXPLICIT_VR_LITTLE_ENDIAN_TRANSFER_SYNTAX)
+        dataset.InstanceNumber = instance_number
+        self._set_pixel_data(dataset, [image_data] if is_jpeg else [pixel_data], rows, columns, samples_per_pixel,
+                             is_jpeg)
+        self._write(dataset, dcm_file, keys)
+        return dcm_file
+
+    def write_multiframe_secondary_capture(self, image_files, dcm_file, sop_instance_uid, keys=(), bitonal=False,
+                                           jpeg_quality=None):
+        """
+        writes the page image files (or bytes) as the frames of one Multi-frame Grayscale Byte or True Color Secondary
+        Capture object. jpeg pages are encapsulated as-is, one fragment per frame, other images are stored
+        uncompressed like write_secondary_capture() does. pages smaller than the largest one are padded with white,
+        jpeg pages only then are encoded again (with jpeg_quality)
+        """
+        from PIL import Image
+        import pydicom
+
+        images_data = []
+        for image_file in image_files:
+            if isinstance(image_file, bytes):
+                images_data.append(image_file)
+            else:
+                with open(image_file, "rb") as input_file:
+                    images_data.append(input_file.read())
+        is_jpeg = all(image_data.startswith(JPEG_START_OF_IMAGE) for image_data in images_data)
+        sizes = []
+        bands = set()
+        for image_data in images_data:
+            # opening reads the header only
+            with Image.open(io.BytesIO(image_data)) as image:
+                sizes.append(image.size)
+                bands.add(len(image.getbands()))
+        columns = max(size[0] for size in sizes)
+        rows = max(size[1] for size in sizes)
+        samples_per_pixel = 3 if 3 in bands and not bitonal else 1
+        mode = "RGB" if samples_per_pixel == 3 else "L"
+
+        frames = []
+        for image_data, size in zip(images_data, sizes):
+            if is_jpeg and size == (columns, rows) and bands == {samples_per_pixel}:
+                frames.append(image_data)
+                continue
+            with Image.open(io.BytesIO(image_data)) as image:
+                image = image.convert(mode)
+                if bitonal:
+                    image = image.point(lambda value: 255 if value >= 128 else 0)
+                if size != (columns, rows):
+                    page = Image.new(mode, (columns, rows), "white")
+                    page.paste(image)
+                    image = page
+                if is_jpeg:
+                    output = io.BytesIO()
+                    image.save(output, format="JPEG", quality=jpeg_quality or 75)
+                    frames.append(output.getvalue())
+                else:
+                    frames.append(image.tobytes())
+
+        dataset = self._create_dataset(MULTIFRAME_TRUE_COLOR_SECONDARY_CAPTURE_IMAGE_STORAGE if samples_per_pixel == 3
+                                       else MULTIFRAME_GRAYSCALE_BYTE_SECONDARY_CAPTURE_IMAGE_STORAGE, sop_instance_uid,
+                                       JPEG_BASELINE_TRANSFER_SYNTAX if is_jpeg else
+                                       EXPLICIT_VR_LITTLE_ENDIAN_TRANSFER_SYNTAX)
+        dataset.BurnedInAnnotation = "YES"
+        dataset.NumberOfFrames = len(frames)
+        # the frames are the pages of the report
+        dataset.FrameIncrementPointer = pydicom.tag.Tag("PageNumberVector")
+        dataset.PageNumberVector = list(range(1, len(frames) + 1))
+        if samples_per_pixel == 1:
+            dataset.PresentationLUTShape = "IDENTITY"
+            dataset.RescaleIntercept = 0
+            dataset.RescaleSlope = 1
+            dataset.RescaleType = "US"
+        self._set_pixel_data(dataset, frames, rows, columns, samples_per_pixel, is_jpeg)
+        self._write(dataset, dcm_file, keys)
+        return dcm_file
+
+    @staticmethod
+    def _set_pixel_data(dataset, frames, rows, columns, samples_per_pixel, is_jpeg):
+        """ sets the 8 bit image pixel module for the jpeg frames or the uncompressed frame pixels """
+        import pydicom
+
+        dataset.PatientOrientation = None
+        dataset.SamplesPerPixel = samples_per_pixel
+        if samples_per_pixel == 3:
+            dataset.PhotometricInterpretation = "YBR_FULL_422" if is_jpeg else "RGB"
+            dataset.PlanarConfiguration = 0
+        else:
+            dataset.PhotometricInterpretation = "MONOCHROME2"
+        dataset.Rows = rows
+        dataset.Columns = columns
+        dataset.BitsAllocated = 8
+        dataset.BitsStored = 8
+        dataset.HighBit = 7
+        dataset.PixelRepresentation = 0
+        if is_jpeg:
+            dataset.LossyImageCompression = "01"
+            dataset.PixelData = pydicom.encaps.encapsulate(frames)
+        else:
+            dataset.LossyImageCompression = "00"
+            pixel_data = b"".join(frames)
+            dataset.PixelData = pixel_data + (b"\0" if len(pixel_data) % 2 else b"")
+        dataset["PixelData"].VR = "OB"
+
+    def write_encapsulated_pdf(self, pdf_file, dcm_file, sop_instance_uid, keys=()):
+        """ wraps the pdf file (or pdf bytes) like pdf2dcm does """
+        if isinstance(pdf_file, bytes):
+            pdf_data = pdf_file
+        else:
+            with open(pdf_file, "rb") as pdf:
+                pdf_data = pdf.read()
+
+        dataset = self._create_dataset(ENCAPSULATED_PDF_STORAGE, sop_instance_uid,
+                                       EXPLICIT_VR_LITTLE_ENDIAN_TRANSFER_SYNTAX)
+        # the modality of encapsulated documents, as pdf2dcm writes it
+        dataset.Modality = "DOC"
+        dataset.BurnedInAnnotation = "YES"
+        dataset.DocumentTitle = None
+        dataset.ConceptNameCodeSequence = []
+        dataset.AcquisitionDateTime = None
+        dataset.MIMETypeOfEncapsulatedDocument = "application/pdf"
+        dataset.EncapsulatedDocumentLength = len(pdf_data)
+        dataset.EncapsulatedDocument = pdf_data + (b"\0" if len(pdf_data) % 2 else b"")
+        self._write(dataset, dcm_file, keys)
+        return dcm_file
+
+
+def create_dicom_encoder(dcm_sr_path, additional_options):
+    """
+    :return the native encoder, warns about dcmtk options other than --key which it cannot apply
+    """
+    keys, other_options = parse_dcmtk_key_options(additional_options)
+    # the native encoder does not validate its input anyway
+    other_options = [option for option in other_options if option != "--no-checks"]
+    if other_options:
+        logging.getLogger(__name__).warning(
+            "the native DICOM encoder ignores these dcmtk options: {}".format(" ".join(other_options)))
+    return DicomEncoder(dcm_sr_path, keys)
+
+
+def run_pipeline(items, worker, worker_count=1, queue_size=2):
+    """
+    runs worker(idx, item) for every (idx, item) of the iterable items with worker_count threads while items are
+    still being produced by a separate thread. the queue between producer and workers holds at most queue_size items.
+    the first error stops the pipeline and is raised.
+    :return the worker results ordered by idx
+    """
+    item_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+    results = {}
+    sentinel = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                item_queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for entry in items:
+                if not put(entry):
+                    return
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+        finally:
+            for _ in range(worker_count):
+                put(sentinel)
+
+    def consume():
+        while not stop.is_set():
+            try:
+                entry = item_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if entry is sentinel:
+                return
+            idx, item = entry
+            try:
+                results[idx] = worker(idx, item)
+            except Exception as error:
+                errors.append(error)
+                stop.set()
+
+    # the threads keep attributing their work to the current report and stage
+    producer = threading.Thread(target=contextvars.copy_context().run, args=(produce,), name="pipeline-producer",
+                                daemon=True)
+    producer.start()
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="pipeline-worker") as executor:
+        for _ in range(worker_count):
+            executor.submit(contextvars.copy_context().run, consume)
+    producer.join()
+    if errors:
+        raise errors[0]
+    return [results[idx] for idx in sorted(results.keys())]
+
+
+# file format of the page images for each dcm_image_transfer_syntax, the lossless ones need lossless page images
+RASTER_FORMATS = {"jpeg": "jpg", "jpeg-ls": "png", "rle": "png"}
+# the dcmtk tools compressing the uncompressed page images for the lossless transfer syntaxes
+LOSSLESS_COMPRESSORS = {"jpeg-ls": "dcmcjpls", "rle": "dcmcrle"}
+
+
+def get_raster_options(config):
+    """ :return the keyword arguments of rasterize_pdf() and rasterize_pdf_data() for the raster options of config """
+    return {"dpi": config.raster_dpi, "fmt": RASTER_FORMATS[config.dcm_image_transfer_syntax],
+            "grayscale": config.raster_color != "color", "jpeg_quality": config.raster_jpeg_quality}
+
+
+def get_pdftoppm_options(dpi=200, fmt="jpg", grayscale=False, jpeg_quality=None):
+    """ :return the pdftoppm options for the keyword arguments of get_raster_options() """
+    options = ["-jpeg" if fmt == "jpg" else "-png", "-r", str(dpi)]
+    if grayscale:
+        options.append("-gray")
+    if jpeg_quality and fmt == "jpg":
+        options.extend(["-jpegopt", "quality={}".format(jpeg_quality)])
+    return options
+
+
+def rasterize_pdf(pdf_file, output_folder, pages_per_chunk=1, thread_count=1, dpi=200, fmt="jpg", grayscale=False,
+                  jpeg_quality=None):
+    """
+    converts the pdf into jpg or png files chunk by chunk
+    :return a generator of (page index, image path) in page order
+    """
+    start = time.perf_counter()
+    page_count = pdf2image.pdfinfo_from_path(pdf_file)["Pages"]
+    record_command("pdfinfo", time.perf_counter() - start)
+    for first_page in range(1, page_count + 1, pages_per_chunk):
+        last_page = min(first_page + pages_per_chunk - 1, page_count)
+        start = time.perf_counter()
+        child_cpu_start = get_child_cpu_time()
+        images = pdf2image.convert_from_path(pdf_file, dpi=dpi, paths_only=True, output_folder=output_folder,
+                                             fmt=fmt, grayscale=grayscale,
+                                             jpegopt={"quality": jpeg_quality} if jpeg_quality else None,
+                                             first_page=first_page, last_page=last_page, thread_count=thread_count)
+        record_command("pdftoppm", time.perf_counter() - start, get_child_cpu_time() - child_cpu_start)
+        for offset, image in enumerate(images):
+            yield first_page - 1 + offset, image
+
+
+JPEG_END_OF_IMAGE = b"\xff\xd9"
+JPEG_START_OF_IMAGE = b"\xff\xd8"
+PNG_END_CHUNK = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# format: (bytes between two concatenated images, length of the part which ends the first image)
+IMAGE_BOUNDARIES = {"jpg": (JPEG_END_OF_IMAGE + JPEG_START_OF_IMAGE, len(JPEG_END_OF_IMAGE)),
+                    "png": (PNG_END_CHUNK + PNG_SIGNATURE, len(PNG_END_CHUNK))}
+
+
+def rasterize_pdf_data(pdf_data, dpi=200, fmt="jpg", grayscale=False, jpeg_quality=None):
+    """
+    converts the pdf bytes into jpg or png bytes with one pdftoppm run reading stdin and writing all pages to stdout
+    (the call pdf2image makes, without files)
+    :return a generator of (page index, image bytes) yielding every page as soon as pdftoppm has written it
+    """
+    start = time.perf_counter()
+    child_cpu_start = get_child_cpu_time()
+    args = ["pdftoppm", *get_pdftoppm_options(dpi, fmt, grayscale, jpeg_quality)]
+    boundary_bytes, end_length = IMAGE_BOUNDARIES[fmt]
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    errors = []
+
+    def write_input():
+        try:
+            process.stdin.write(pdf_data)
+            process.stdin.close()
+        except OSError:
+            # pdftoppm failed, its return code tells why
+            pass
+
+    def read_errors():
+        errors.append(process.stderr.read())
+
+    threads = [threading.Thread(target=write_input, daemon=True), threading.Thread(target=read_errors, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        # the pages are concatenated, a page ends where the next one starts
+        buffer = bytearray()
+        idx = 0
+        while True:
+            chunk = process.stdout.read1(256 * 1024)
+            if not chunk:
+                break
+            search_start = max(0, len(buffer) - len(boundary_bytes))
+            buffer += chunk
+            while True:
+                boundary = buffer.find(boundary_bytes, search_start)
+                if boundary < 0:
+                    break
+                yield idx, bytes(buffer[:boundary + end_length])
+                idx += 1
+                del buffer[:boundary + end_length]
+                search_start = 0
+        return_code = process.wait()
+        for thread in threads:
+            thread.join()
+        record_command("pdftoppm", time.perf_counter() - start, get_child_cpu_time() - child_cpu_start, return_code)
+        if return_code != 0:
+            raise ReportGeneratorError("pdftoppm failed with code {}: {}".format(return_code, b"".join(errors)))
+        if buffer:
+            yield idx, bytes(buffer)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def get_img2dcm_args(config, dcm_sr_path, image, dcm_file, instance_number, sop_instance_uid):
+    return ["img2dcm", "--series-from", dcm_sr_path, *config.img2dcm_exe_additional_options, image, dcm_file,
+            "--key", "0008,0060=OT", "--key", "0020,0013={}".format(instance_number), "--key",
+            "0020,0013={}".format(instance_number), "--key", "0008,0018={}".format(sop_instance_uid)]
+
+
+def get_pdf2dcm_args(config, dcm_sr_path, pdf_file, dcm_file, sop_instance_uid):
+    return ["pdf2dcm", pdf_file, dcm_file, "--series-from", dcm_sr_path, *config.pdf2dcm_exe_additional_options,
+            "--key", "0008,0018={}".format(sop_instance_uid)]
+
+
+def get_dcmsend_args(config, dcm_files):
+    # a single dcmsend run sends all files over one association
+    return ["dcmsend", config.dcm_send_ip, str(config.dcm_send_port), *dcm_files,
+            *config.dcmsend_exe_additional_options]
+
+
+def convert_pdf_to_dcm_images(pdf_file, dcm_sr_path, config, temp_dir, output_dir, output_file_name, pages=None,
+                              stage_metrics: Optional[StageMetrics] = None):
+    """
+    rasterizes the pdf pages and converts each page image into a DICOM file in the series of the DICOM SR. pages
+    are encoded while later pages are still rasterized. with dcm_image_multiframe all pages become the frames of
+    a single DICOM file, written by the native encoder once the last page is rasterized
+    :param pdf_file the pdf file or its bytes
+    :param temp_dir receives the page images, only used for files and for the dcmtk encoder
+    :param pages (page index, image path or bytes) of the already rasterized pages, rasterize_pdf() or
+    rasterize_pdf_data() is used if None
+    :param stage_metrics receives the number of pages
+    :return the DICOM files in page order
+    """
     logger = logging.getLogger(__name__)
+    compressor = LOSSLESS_COMPRESSORS.get(config.dcm_image_transfer_syntax)
+
+    def encode_multiframe(images):
+        dcm_file = get_multiframe_dcm_file(output_dir, output_file_name)
+        logger.info("converting {} pages into multi-frame DICOM file {}".format(len(images), dcm_file))
+        sop_instance_uid = generate_dcm_uid(config.oid_root, hash_pages(images))
+        target_file = dcm_file + ".uncompressed" if compressor is not None else dcm_file
+        encoder.write_multiframe_secondary_capture(images, target_file, sop_instance_uid,
+                                                   bitonal=config.raster_color == "mono",
+                                                   jpeg_quality=config.raster_jpeg_quality)
+        if compressor is not None:
+            try:
+                run_cmd(compressor, target_file, dcm_file)
+            finally:
+                os.remove(target_file)
+        return dcm_file
+
+    def encode(idx, image):
+        dcm_file = os.path.join(output_dir, output_file_name + "_image" + str(idx + 1) + ".dcm")
+        if isinstance(image, bytes):
+            logger.info("converting page {} into DICOM file {}".format(idx + 1, dcm_file))
+            sop_instance_uid = generate_dcm_uid(config.oid_root, hashlib.sha256(image).hexdigest())
+        else:
+            logger.info("converting image {} into DICOM file {}".format(image, dcm_file))
+            sop_instance_uid = generate_dcm_uid(config.oid_root, sha256sum(image))
+
+        if compressor is not None:
+            uncompressed_file = dcm_file + ".uncompressed"
+            encoder.write_secondary_capture(image, uncompressed_file, idx + 1, sop_instance_uid,
+                                            bitonal=config.raster_color == "mono")
+            try:
+                run_cmd(compressor, uncompressed_file, dcm_file)
+            finally:
+                os.remove(uncompressed_file)
+            return dcm_file
+        if encoder is not None:
+            return encoder.write_secondary_capture(image, dcm_file, idx + 1, sop_instance_uid)
+        if isinstance(image, bytes):
+            # img2dcm reads files only
+            image_data = image
+            image = os.path.join(temp_dir, "{}_page{}.jpg".format(output_file_name, idx + 1))
+            with open(image, "wb") as image_file:
+                image_file.write(image_data)
+        run_cmd(*get_img2dcm_args(config, dcm_sr_path, image, dcm_file, idx + 1, sop_instance_uid),
+                print_stdout=True)
+        return dcm_file
+
+    encoder = None
+    # img2dcm reads jpeg and bmp only, so the native encoder writes the uncompressed pages for the lossless compressors,
+    # and it writes single-frame objects only
+    if config.dcm_encoder == "native" or compressor is not None or config.dcm_image_multiframe:
+        # the SR header is read once for all pages
+        encoder = create_dicom_encoder(dcm_sr_path, config.img2dcm_exe_additional_options)
+
+    if pages is None and isinstance(pdf_file, bytes):
+        pages = rasterize_pdf_data(pdf_file, **get_raster_options(config))
+    elif pages is None:
+        pages = rasterize_pdf(pdf_file, temp_dir, config.raster_pages_per_chunk, config.raster_thread_count,
+                              **get_raster_options(config))
+    if config.dcm_image_multiframe:
+        images = [image for _, image in sorted(pages, key=lambda page: page[0])]
+        if stage_metrics is not None:
+            stage_metrics.pages = len(images)
+        return [encode_multiframe(images)]
+    dcm_files = run_pipeline(pages, encode, config.dcm_image_workers, config.dcm_image_workers * 2)
+    if stage_metrics is not None:
+        stage_metrics.pages = len(dcm_files)
+    return dcm_files
+
+
+def get_multiframe_dcm_file(output_dir, output_file_name):
+    return os.path.join(output_dir, output_file_name + "_images.dcm")
+
+
+def hash_pages(images):
+    """ :return a sha256 over the page image files or bytes, the SOP Instance UID of a multi-frame object """
+    page_hashes = [hashlib.sha256(image).hexdigest() if isinstance(image, bytes) else sha256sum(image)
+                   for image in images]
+    return hashlib.sha256("".join(page_hashes).encode("ascii")).hexdigest()
+
+
+def measure_page_sizes(dcm_files, stage_metrics: StageMetrics):
+    """
+    logs the bytes every DICOM page image saves against its uncompressed pixel data and adds the uncompressed size to
+    the stage metrics
+    """
+    import pydicom
 
-    # files need to be deleted
+    logger = logging.getLogger(__name__)
+    for dcm_file in dcm_files:
+        try:
+            dataset = pydicom.dcmread(dcm_file, stop_before_pixels=True)
+            uncompressed_size = dataset.Rows * dataset.Columns * dataset.SamplesPerPixel * dataset.BitsAllocated // 8 \
+                * int(dataset.get("NumberOfFrames", 1))
+        except (pydicom.errors.InvalidDicomError, AttributeError) as error:
+            logger.warning("cannot read the image size of {}: {}".format(dcm_file, error))
+            continue
+        saved = uncompressed_size - os.path.getsize(dcm_file)
+        logger.info("{}: {} bytes saved against the uncompressed pixel data ({:.1%})".format(
+            dcm_file, saved, saved / uncompressed_size if uncompressed_size else 0.0))
+        stage_metrics.bytes_uncompressed += uncompressed_size
+
+
+# the SOP classes this tool writes or forwards, proposed once per association
+SEND_IMAGE_SOP_CLASSES = (SECONDARY_CAPTURE_IMAGE_STORAGE, "1.2.840.10008.5.1.4.1.1.7.1",
+                          MULTIFRAME_GRAYSCALE_BYTE_SECONDARY_CAPTURE_IMAGE_STORAGE, "1.2.840.10008.5.1.4.1.1.7.3",
+                          MULTIFRAME_TRUE_COLOR_SECONDARY_CAPTURE_IMAGE_STORAGE)
+SEND_DOCUMENT_SOP_CLASSES = (ENCAPSULATED_PDF_STORAGE, "1.2.840.10008.5.1.4.1.1.88.11", "1.2.840.10008.5.1.4.1.1.88.22",
+                             "1.2.840.10008.5.1.4.1.1.88.33", "1.2.840.10008.5.1.4.1.1.88.34")
+SEND_COMPRESSED_TRANSFER_SYNTAXES = (JPEG_BASELINE_TRANSFER_SYNTAX, "1.2.840.10008.1.2.4.80", "1.2.840.10008.1.2.5")
+SEND_UNCOMPRESSED_TRANSFER_SYNTAXES = (EXPLICIT_VR_LITTLE_ENDIAN_TRANSFER_SYNTAX, "1.2.840.10008.1.2")
+# success and warning statuses of a C-STORE
+SEND_SUCCESS_STATUSES = (0x0000, 0xB000, 0xB006, 0xB007)
+
+
+class DicomSender:
+    """
+    sends DICOM files over a small pool of long-lived associations instead of one dcmsend process (and
+    association) per file. failed sends are retried with exponential backoff on a fresh association
+    """
+
+    def __init__(self, ip, port, ae_title="REPORTGEN", called_ae_title="ANY-SCP", association_count=1, retries=3,
+                 retry_delay=1.0):
+        self.ip = ip
+        self.port = int(port)
+        self.ae_title = ae_title
+        self.called_ae_title = called_ae_title
+        self.association_count = association_count
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._ae = None
+        # one slot per association, a thread takes a slot for each file it sends
+        self._slots = queue.Queue()
+        for _ in range(association_count):
+            self._slots.put([None])
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._executor = ThreadPoolExecutor(max_workers=association_count, thread_name_prefix="dicom-sender")
+
+    def _create_ae(self):
+        from pynetdicom import AE
+
+        ae = AE(ae_title=self.ae_title)
+        for sop_class_uid in SEND_IMAGE_SOP_CLASSES:
+            for transfer_syntax_uid in SEND_COMPRESSED_TRANSFER_SYNTAXES:
+                ae.add_requested_context(sop_class_uid, transfer_syntax_uid)
+            ae.add_requested_context(sop_class_uid, list(SEND_UNCOMPRESSED_TRANSFER_SYNTAXES))
+        for sop_class_uid in SEND_DOCUMENT_SOP_CLASSES:
+            ae.add_requested_context(sop_class_uid, list(SEND_UNCOMPRESSED_TRANSFER_SYNTAXES))
+        return ae
+
+    def _associate(self):
+        if self._ae is None:
+            self._ae = self._create_ae()
+        association = self._ae.associate(self.ip, self.port, ae_title=self.called_ae_title)
+        if not association.is_established:
+            raise ReportGeneratorError("could not associate with dicom node {}:{}".format(self.ip, self.port))
+        return association
+
+    def _send_file(self, dcm_file):
+        logger = logging.getLogger(__name__)
+        slot = self._slots.get()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    if slot[0] is None or not slot[0].is_established:
+                        slot[0] = self._associate()
+                    status = slot[0].send_c_store(dcm_file)
+                    if status and status.Status in SEND_SUCCESS_STATUSES:
+                        logger.debug("sent file {} to dicom node".format(dcm_file))
+                        return dcm_file
+                    error = "status {}".format(hex(status.Status) if status else "none (connection lost)")
+                except (ReportGeneratorError, OSError, RuntimeError) as send_error:
+                    # pynetdicom raises OSError (e.g. ConnectionResetError) or RuntimeError if the association drops
+                    error = str(send_error) or type(send_error).__name__
+                if slot[0] is not None:
+                    slot[0].abort()
+                    slot[0] = None
+                if attempt < self.retries:
+                    delay = self.retry_delay * 2 ** attempt
+                    logger.warning("sending file {} failed ({}), retrying in {}s".format(dcm_file, error, delay))
+                    time.sleep(delay)
+            raise ReportGeneratorError("sending file {} to dicom node {}:{} failed: {}".format(dcm_file, self.ip,
+                                                                                             self.port, error))
+        finally:
+            self._slots.put(slot)
+
+    def send(self, dcm_files: List[str]):
+        """
+        sends all files with at most association_count files in flight, raises on the first failure
+        """
+        futures = [self._executor.submit(self._send_file, dcm_file) for dcm_file in dcm_files]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self._executor.shutdown()
+        while not self._slots.empty():
+            slot = self._slots.get()
+            if slot[0] is not None and slot[0].is_established:
+                slot[0].release()
+
+
+class FakeDicomSender:
+    """
+    pretends to send the files without any network traffic, for testing and benchmarking without a dicom node
+    """
+
+    def __init__(self, send_time=0.0):
+        self.send_time = send_time
+
+    def send(self, dcm_files: List[str]):
+        for dcm_file in dcm_files:
+            time.sleep(self.send_time)
+            logging.getLogger(__name__).debug("fake sent file {}".format(dcm_file))
+        return list(dcm_files)
+
+    def close(self):
+        pass
+
+
+_dicom_senders = {}
+_dicom_senders_lock = threading.Lock()
+
+
+def get_dicom_sender(config) -> DicomSender:
+    """
+    returns the process wide sender for the configured dicom node, so associations are reused across reports
+    """
+    key = (config.dcm_sender, config.dcm_send_ip, str(config.dcm_send_port), config.dcm_send_ae_title,
+           config.dcm_send_called_ae_title, config.dcm_send_associations, config.dcm_send_retries,
+           config.dcm_send_retry_delay)
+    with _dicom_senders_lock:
+        sender = _dicom_senders.get(key)
+        if sender is None:
+            if config.dcm_sender == "fake":
+                sender = FakeDicomSender()
+            else:
+                sender = DicomSender(config.dcm_send_ip, config.dcm_send_port, config.dcm_send_ae_title,
+                                     config.dcm_send_called_ae_title, config.dcm_send_associations,
+                                     config.dcm_send_retries, config.dcm_send_retry_delay)
+            _dicom_senders[key] = sender
+    return sender
+
+
+@atexit.register
+def close_dicom_senders():
+    with _dicom_senders_lock:
+        senders = list(_dicom_senders.values())
+        _dicom_senders.clear()
+    for sender in senders:
+        sender.close()
+
+
+def _clear_inherited_pools():
+    # a forked child process inherits the pools but not their threads and connections, and the locks possibly held by
+    # one of those threads
+    global _renderer_pools_lock, _dicom_senders_lock
+    _renderer_pools_lock = threading.Lock()
+    _dicom_senders_lock = threading.Lock()
+    _renderer_pools.clear()
+    _dicom_senders.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_clear_inherited_pools)
+
+
+# the cacheable stages in pipeline order and the last one each target needs
+CACHE_STAGES = ("xml", "data", "template", "pdf", "pages")
+TARGET_LAST_STAGES = {"xml": "xml", "template": "template", "pdf": "pdf", "dcm_pdf": "pdf", "dcm_images": "pages"}
+# change this whenever a stage produces different output for the same inputs
+CACHE_VERSION = 1
+# seconds after which a temporary entry is left over from a crashed writer, younger ones are being written
+CACHE_TMP_GRACE_SECONDS = 3600
+
+
+class ArtifactCache:
+    """
+    a persistent content-addressed cache for stage results. every entry is one file named after its key, entries
+    are evicted least recently used first when the total size exceeds max_size bytes. several processes may share
+    one cache directory
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = {}  # stage -> count
+        self.misses = {}  # stage -> count
+        # the report threads of a process share the instance
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[0:2], key)
+
+    def _entries(self):
+        """ :return (mtime, size, path) of the entries, without the temporary entries other processes are writing """
+        entries = []
+        stale_time = time.time() - CACHE_TMP_GRACE_SECONDS
+        for root, _, files in os.walk(self.cache_dir):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if file_name.endswith(".tmp") and stat.st_mtime > stale_time:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def count(self, stage, hit):
+        with self._lock:
+            counts = self.hits if hit else self.misses
+            counts[stage] = counts.get(stage, 0) + 1
+
+    def contains(self, key):
+        return os.path.exists(self._path(key))
+
+    def load(self, key, target_path):
+        """ copies the entry to target_path and marks it as recently used. :return False if it is not cached """
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, target_path)
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def load_bytes(self, key):
+        """ :return the entry and marks it as recently used, None if it is not cached """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as entry_file:
+                data = entry_file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def load_json(self, key):
+        data = self.load_bytes(key)
+        return json.loads(data.decode("utf-8")) if data is not None else None
+
+    def _store(self, key, write):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write under a temporary name first, so other processes never see half written entries
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        write(tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size += os.path.getsize(path)
+            if self._size > self.max_size:
+                self._evict()
+
+    def store(self, key, source_path):
+        self._store(key, lambda tmp_path: shutil.copyfile(source_path, tmp_path))
+
+    def store_bytes(self, key, data):
+        def write(tmp_path):
+            with open(tmp_path, "wb") as entry_file:
+                entry_file.write(data)
+
+        self._store(key, write)
+
+    def store_json(self, key, data):
+        self.store_bytes(key, json.dumps(data).encode("utf-8"))
+
+    def evict(self):
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        # evict down to 90% so not every store has to scan the directory
+        for _, size, path in entries:
+            if self._size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except FileNotFoundError:
+                pass
+        logging.getLogger(__name__).debug("cache size after eviction: {} bytes".format(self._size))
+
+    def find_deepest(self, stages, keys):
+        """ :return the deepest of stages whose result is cached or None """
+        for stage in reversed(stages):
+            if self.contains(keys[stage]):
+                return stage
+        return None
+
+
+_file_hashes = {}  # (path, mtime) -> sha256
+
+
+def sha256sum_cached(filename):
+    """ sha256sum for files that rarely change, like templates """
+    key = (os.path.realpath(filename), os.stat(filename).st_mtime_ns)
+    if key not in _file_hashes:
+        _file_hashes[key] = sha256sum(filename)
+    return _file_hashes[key]
+
+
+def compute_cache_keys(dcm_sr_path, config):
+    """
+    the cache key of every stage is derived from the key of the stage before and the options of the stage itself,
+    so the keys of all stages are known before running any of them
+    """
+
+    def key(*parts):
+        return hashlib.sha256("\0".join(str(part) for part in (CACHE_VERSION,) + parts).encode("utf-8")).hexdigest()
+
+    keys = {}
+    dsr2xml_options = config.dsr2xml_exe_additional_options if config.sr_xml_converter == "dsr2xml" else []
+    keys["xml"] = key("xml", sha256sum(dcm_sr_path), config.sr_xml_converter, *dsr2xml_options)
+    keys["data"] = key("data", keys["xml"], json.dumps([rule.to_dict() for rule in config.rules], sort_keys=True))
+    keys["template"] = key("template", keys["data"], config.template_path, sha256sum_cached(config.template_path))
+    _, template_file_extension = os.path.splitext(config.template_path)
+    keys["pdf"] = key("pdf", keys["template"], resolve_renderer_name(config, template_file_extension == ".docx"))
+    keys["pages"] = key("pages", keys["pdf"], *sorted(get_raster_options(config).items()))
+    return keys
+
+
+_artifact_caches = {}
+_artifact_caches_lock = threading.Lock()
+
+
+def get_artifact_cache(config) -> Optional[ArtifactCache]:
+    """ :return the process wide cache for config.cache_dir or None if caching is off """
+    if not config.cache_dir:
+        return None
+    # one instance per directory, its size and hit counts are shared by all report threads
+    with _artifact_caches_lock:
+        cache = _artifact_caches.get(config.cache_dir)
+        if cache is None:
+            cache = ArtifactCache(config.cache_dir, int(config.cache_max_size_mb * 1024 * 1024))
+            _artifact_caches[config.cache_dir] = cache
+    return cache
+
+
+def store_cached_pages(cache: ArtifactCache, key, pages):
+    """
+    passes the (page index, image path or bytes) items of pages through and stores them, then the page count
+    """
+    page_count = 0
+    for idx, image in pages:
+        if isinstance(image, bytes):
+            cache.store_bytes("{}-{}".format(key, idx), image)
+        else:
+            cache.store("{}-{}".format(key, idx), image)
+        page_count += 1
+        yield idx, image
+    cache.store_json(key, {"pages": page_count})
+
+
+def load_cached_pages(cache: ArtifactCache, key, temp_dir, file_name, image_format="jpg"):
+    """
+    :param temp_dir the cached pages are copied into temp_dir, if None they are loaded into memory
+    :return (page index, image path or bytes) of the cached pages, None if the entry or one of its pages has been
+    evicted
+    """
+    entry = cache.load_json(key)
+    if entry is None:
+        return None
+    pages = []
+    for idx in range(entry["pages"]):
+        if temp_dir is None:
+            image = cache.load_bytes("{}-{}".format(key, idx))
+            loaded = image is not None
+        else:
+            image = os.path.join(temp_dir, "{}_page{}.{}".format(file_name, idx + 1, image_format))
+            loaded = cache.load("{}-{}".format(key, idx), image)
+        if not loaded:
+            logging.getLogger(__name__).warning("cached page {} of {} has been evicted".format(idx + 1, file_name))
+            return None
+        pages.append((idx, image))
+    return pages
+
+
+class ReportResult(DataObject):
+
+    def __init__(self, dcm_sr_path=None):
+        super().__init__()
+        self.dcm_sr_path = dcm_sr_path
+        self.success = False
+        self.output_files = []  # type: List[str]
+        self.error = None  # type: Optional[str]
+        self.duration = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.metrics = None  # type: Optional[Dict]
+
+
+def load_config(config_file):
+    with open(config_file) as json_file:
+        data = json.load(json_file)
+        config = Config.create_from_dict(data)
+        error_str = config.validate()
+        if error_str:
+            raise ReportGeneratorError(error_str)
+    if config.sr_xml_converter == "native":
+        ignored_options = get_native_ignored_options(config.dsr2xml_exe_additional_options or [])
+        if ignored_options:
+            logging.getLogger(__name__).warning(
+                "the native sr_xml_converter ignores these dsr2xml options: {}".format(" ".join(ignored_options)))
+    return config
+
+
+def process_report(dcm_sr_path, config: Config, output_file_name=None, rule_program: Optional[RuleProgram] = None,
+                   metrics: Optional[ReportMetrics] = None):
+    """
+    runs all stages for one DICOM SR up to config.target
+    :param dcm_sr_path the DICOM SR file
+    :param config a validated config, config.add_paths() must have been called before
+    :param output_file_name overrides config.output_file_name if set
+    :param rule_program the compiled config.rules, compiled on the fly if not given
+    :param metrics receives the stage and command metrics of this report if set
+    :return the list of output files
+    """
+    if metrics is None:
+        return _process_report(dcm_sr_path, config, output_file_name, rule_program)
+    token = current_metrics.set(metrics)
+    start = time.perf_counter()
     try:
-        # LOAD CONFIG AND SETUP
-        with open(config_file) as json_file:
-            data = json.load(json_file)
-            config = Config.create_from_dict(data)
-            error_str = config.validate()
-            if error_str:
-                quit(error_str)
-        config.add_paths()
-        temp_dir_object = tempfile.TemporaryDirectory()
-        temp_dir = temp_dir_object.name if config.temp_dir is None else config.temp_dir
-        dcm_sr_filename = os.path.basename(os.path.splitext(dcm_sr_path)[0])
-        output_file_name = config.output_file_name if config.output_file_name is not None else dcm_sr_filename
-        output_dir = temp_dir_object.name if config.output_dir is None else config.output_dir
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        # GENERATE XML FILE
-        sr_xml_file = os.path.join(temp_dir, dcm_sr_filename + ".xml")
-        logger.info("converting DICOM SR {} to XML file {}".format(dcm_sr_path, sr_xml_file))
-        run_cmd("dsr2xml", *config.dsr2xml_exe_additional_options, dcm_sr_path, sr_xml_file)
-        if config.target == "xml":
-            sr_xml_file_output = os.path.join(output_dir, output_file_name + ".xml")
-            shutil.move(sr_xml_file, sr_xml_file_output)
-            logger.info("xml created in {}. quit requested.".format(sr_xml_file_output))
-            sys.exit(0)
-
-        # GENERATE TEMPLATE DATA: EXTRACT AND CONTENTS FROM XML USING XPATH
-        logger.info("retrieving contents from XML file {}".format(sr_xml_file))
-        root = ET.parse(sr_xml_file)
-        template_data = {}
-        for rule in config.rules:
-            text = ""
-            for rule_idx, xpath_expression in enumerate(rule.xpath_expressions):
-                xpath_result = root.xpath(xpath_expression)
-                if isinstance(xpath_result, List):
-                    xpath_result = rule.concat_string.join(xpath_result)
-
-                if not isinstance(xpath_result, str):
-                    quit("xpath did not produce text: \"{}\" in rule {}, index {}".format(xpath_expression, rule.name,
-                                                                                          str(rule_idx)))
-                elif len(xpath_result) == 0:
-                    logger.warning(
-                        "empty text for xpath \"{}\" in rule {}, index {}".format(xpath_expression, rule.name,
-                                                                                  str(rule_idx)))
+        output_files = _process_report(dcm_sr_path, config, output_file_name, rule_program)
+        metrics.success = True
+        return output_files
+    except Exception as error:
+        metrics.error = str(error)
+        raise
+    finally:
+        metrics.wall_time = time.perf_counter() - start
+        metrics.peak_rss, metrics.child_peak_rss = get_peak_rss()
+        current_metrics.reset(token)
 
-                else:
-                    logger.info("result for xpath {}: {}".format(xpath_expression, xpath_result))
-                    if text:
-                        text = text + rule.concat_string
-                    text = text + xpath_result
-                    for search, replace in rule.replacements.items():
-                        text = text.replace(search, replace)
-
-            template_data[rule.name] = text
-        logger.debug("template_data: {}".format(str(template_data)))
-
-        # GENERATE FILLED TEMPLATE: LOAD TEMPLATE AND SET CONTENTS ON NAMED PLACEHOLDERS
-        _, template_file_extension = os.path.splitext(config.template_path)
-        template_is_word = template_file_extension == ".docx"
-        filled_template_file = os.path.join(temp_dir, dcm_sr_filename + template_file_extension)
-        logger.info("replacing contents from template docx file {} into {}".format(config.template_path,
-                                                                                   filled_template_file))
-        if template_is_word:
-            replace_in_docx(config.template_path, template_data, filled_template_file)
+
+def _process_report(dcm_sr_path, config: Config, output_file_name, rule_program: Optional[RuleProgram]):
+    stages = create_report_stages(dcm_sr_path, config, output_file_name, rule_program)
+    try:
+        stages.resume()
+        for stage in stages.get_stages():
+            stages.run(stage)
+        return stages.finish()
+    finally:
+        stages.close()
+
+
+def resume_from_cache(cache: ArtifactCache, stages, cache_keys, load_stage):
+    """
+    loads the result of the deepest of stages which is cached and counts the cache hits and misses
+    :param load_stage(stage, key) loads the result of stage, returns False if it has been evicted in the meantime
+    (by another process, between contains() and loading it)
+    :return the index of the loaded stage in stages or -1
+    """
+    logger = logging.getLogger(__name__)
+    metrics = current_metrics.get()
+    resume_index = -1
+    for stage_index in reversed(range(len(stages))):
+        stage = stages[stage_index]
+        if not cache.contains(cache_keys[stage]):
+            continue
+        if load_stage(stage, cache_keys[stage]):
+            resume_index = stage_index
+            cache.count(stage, hit=True)
+            if metrics is not None:
+                metrics.cache_hits += 1
+            logger.info("resuming from cached {} stage".format(stage))
+            break
+    done_callback = stage_done_callback.get()
+    for stage in stages[:resume_index + 1]:
+        if metrics is not None:
+            cached_stage = StageMetrics(stage)
+            cached_stage.cached = True
+            metrics.stages.append(cached_stage)
+        if done_callback is not None:
+            done_callback(stage)
+    for stage in stages[resume_index + 1:]:
+        cache.count(stage, hit=False)
+    if metrics is not None:
+        metrics.cache_misses += len(stages) - resume_index - 1
+    return resume_index
+
+
+def get_stage_names(config: Config, rasterize_separately=False):
+    """
+    :param rasterize_separately adds a pages stage before dcm_images, otherwise dcm_images encodes the pages while
+    they are rasterized
+    :return the names of the stages up to config.target in processing order
+    """
+    stages = ["xml", "data", "template", "pdf"]
+    stages = stages[:{"xml": 1, "template": 3}.get(config.target, len(stages))]
+    if config.target == "dcm_pdf":
+        stages.append("dcm_pdf")
+    elif config.target == "dcm_images":
+        stages.extend(["pages", "dcm_images"] if rasterize_separately else ["dcm_images"])
+    if config.target in ("dcm_pdf", "dcm_images") and config.dcm_send_ip:
+        stages.append("send")
+    return stages
+
+
+class ReportStages:
+    """
+    the stages of one DICOM SR up to config.target. process_report() runs them one after the other, the
+    StageScheduler runs every stage in its own workers, overlapping with the stages of other reports. the stages
+    pass files in a temp dir, see InMemoryReportStages for bytes and trees
+    """
+
+    def __init__(self, dcm_sr_path, config: Config, output_file_name=None,
+                 rule_program: Optional[RuleProgram] = None):
+        self.dcm_sr_path = dcm_sr_path
+        self.config = config
+        self.rule_program = rule_program
+        self.name = os.path.basename(os.path.splitext(dcm_sr_path)[0])
+        if output_file_name is None:
+            output_file_name = config.output_file_name if config.output_file_name is not None else self.name
+        self.output_file_name = output_file_name
+        _, self.template_file_extension = os.path.splitext(config.template_path)
+        self.template_is_word = self.template_file_extension == ".docx"
+        self.cache = get_artifact_cache(config)
+        self.cache_keys = {}
+        self.resume_index = -1
+        self.root = None
+        self.template_data = None
+        self.pages = None
+        self.output_files = []
+        self._temp_dir_objects = []
+        self.temp_dir = config.temp_dir
+        self.output_dir = config.output_dir
+        self._create_dirs()
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def _create_temp_dir(self):
+        temp_dir_object = tempfile.TemporaryDirectory()
+        self._temp_dir_objects.append(temp_dir_object)
+        return temp_dir_object.name
+
+    def _create_dirs(self):
+        temp_dir = self._create_temp_dir()
+        self.temp_dir = temp_dir if self.temp_dir is None else self.temp_dir
+        self.output_dir = temp_dir if self.output_dir is None else self.output_dir
+        self.sr_xml_file = os.path.join(self.temp_dir, self.name + ".xml")
+        self.filled_template_file = os.path.join(self.temp_dir, self.name + self.template_file_extension)
+        self.pdf_file = os.path.join(self.temp_dir, self.name + ".pdf")
+
+    def close(self):
+        """ removes the temp dirs, with them the outputs if config.output_dir is not set """
+        for temp_dir_object in self._temp_dir_objects:
+            temp_dir_object.cleanup()
+
+    def get_stages(self, rasterize_separately=False):
+        """ :return the names of the stages left to run, without the ones resume() loaded from the artifact cache """
+        cached_stages = CACHE_STAGES[:self.resume_index + 1]
+        return [stage for stage in get_stage_names(self.config, rasterize_separately) if stage not in cached_stages]
+
+    def resume(self):
+        """ loads the result of the deepest stage whose result is in the artifact cache, if there is one """
+        if self.cache is None:
+            return
+        self.cache_keys = compute_cache_keys(self.dcm_sr_path, self.config)
+        stages = CACHE_STAGES[:CACHE_STAGES.index(TARGET_LAST_STAGES[self.config.target]) + 1]
+        self.resume_index = resume_from_cache(self.cache, stages, self.cache_keys, self._load_cached)
+
+    def _load_cached(self, stage, key):
+        if stage == "data":
+            self.template_data = self.cache.load_json(key)
+            return self.template_data is not None
+        if stage == "pages":
+            self.pages = load_cached_pages(self.cache, key, self.temp_dir, self.name,
+                                           RASTER_FORMATS[self.config.dcm_image_transfer_syntax])
+            return self.pages is not None
+        return self.cache.load(key, {"xml": self.sr_xml_file, "template": self.filled_template_file,
+                                     "pdf": self.pdf_file}[stage])
+
+    def run(self, stage):
+        """ runs the stage, one of get_stages(), under measure_stage() """
+        with measure_stage(stage) as stage_metrics:
+            getattr(self, "_run_" + stage)(stage_metrics)
+
+    def finish(self):
+        """ :return the output files, the result of an xml, template or pdf target is moved into the output dir """
+        extension = {"xml": ".xml", "template": self.template_file_extension, "pdf": ".pdf"}.get(self.config.target)
+        if extension is not None:
+            output_path = os.path.join(self.output_dir, self.output_file_name + extension)
+            self._write_output(self.config.target, output_path)
+            logging.getLogger(__name__).info("{} created in {}. quit requested.".format(self.config.target,
+                                                                                       output_path))
+            self.output_files = [output_path]
+        return self.output_files
+
+    def _write_output(self, stage, output_path):
+        shutil.move({"xml": self.sr_xml_file, "template": self.filled_template_file, "pdf": self.pdf_file}[stage],
+                    output_path)
+
+    def _get_pdf(self):
+        """ :return the pdf file or its bytes """
+        return self.pdf_file
+
+    def _get_encoder_temp_dir(self):
+        """ :return the dir receiving the page images the dcmtk encoder reads """
+        return self.temp_dir
+
+    def _run_xml(self, stage_metrics: StageMetrics):
+        logger = logging.getLogger(__name__)
+        if self.config.sr_xml_converter == "native":
+            logger.info("converting DICOM SR {} to XML in memory".format(self.dcm_sr_path))
+            self.root = sr_to_xml_tree(self.dcm_sr_path)
+            if self.cache is not None or self.config.target == "xml":
+                self.root.write(self.sr_xml_file, encoding="utf-8", xml_declaration=True, pretty_print=True)
+        else:
+            logger.info("converting DICOM SR {} to XML file {}".format(self.dcm_sr_path, self.sr_xml_file))
+            run_cmd("dsr2xml", *self.config.dsr2xml_exe_additional_options, self.dcm_sr_path, self.sr_xml_file)
+        stage_metrics.bytes_read = get_file_sizes(self.dcm_sr_path)
+        stage_metrics.bytes_written = get_file_sizes(self.sr_xml_file)
+        if self.cache is not None:
+            self.cache.store(self.cache_keys["xml"], self.sr_xml_file)
+
+    def _load_xml(self, stage_metrics: StageMetrics):
+        stage_metrics.bytes_read = get_file_sizes(self.sr_xml_file)
+        return load_sr_xml(self.sr_xml_file, self.config, self.rule_program)
+
+    def _run_data(self, stage_metrics: StageMetrics):
+        if self.rule_program is None:
+            self.rule_program = self.config.compile_rules()
+        root = self.root if self.root is not None else self._load_xml(stage_metrics)
+        # the tree is not needed anymore, it may be large
+        self.root = None
+        self.template_data = self.rule_program.extract(root)
+        if self.cache is not None:
+            self.cache.store_json(self.cache_keys["data"], self.template_data)
+        logging.getLogger(__name__).debug("template_data: {}".format(str(self.template_data)))
+
+    def _run_template(self, stage_metrics: StageMetrics):
+        logging.getLogger(__name__).info("replacing contents from template file {} into {}".format(
+            self.config.template_path, self.filled_template_file))
+        if self.template_is_word:
+            replace_in_docx(self.config.template_path, self.template_data, self.filled_template_file)
         else:
-            replace_in_text_file(config.template_path, template_data, filled_template_file)
-        if config.target == "template":
-            filled_template_file_output = os.path.join(output_dir, output_file_name + template_file_extension)
-            shutil.move(filled_template_file, filled_template_file_output)
-            logger.info("template created in {}. quit requested.".format(filled_template_file_output))
-            sys.exit(0)
-
-        # CONVERT TO PDF
-        pdf_tmp_file = os.path.join(temp_dir, dcm_sr_filename + ".pdf")
-        logger.info("converting file {} into pdf file {}".format(filled_template_file, pdf_tmp_file))
+            replace_in_text_file(self.config.template_path, self.template_data, self.filled_template_file)
+        stage_metrics.bytes_read = get_file_sizes(self.config.template_path)
+        stage_metrics.bytes_written = get_file_sizes(self.filled_template_file)
+        if self.cache is not None:
+            self.cache.store(self.cache_keys["template"], self.filled_template_file)
+
+    def _run_pdf(self, stage_metrics: StageMetrics):
+        logging.getLogger(__name__).info("converting file {} into pdf file {}".format(self.filled_template_file,
+                                                                                    self.pdf_file))
+        renderer_pool = get_renderer_pool(self.config, self.template_is_word)
         with suppress_stdout():
-            if template_is_word:
-                doc2pdf(filled_template_file, pdf_tmp_file)
+            renderer_pool.render(self.filled_template_file, self.pdf_file)
+        stage_metrics.bytes_read = get_file_sizes(self.filled_template_file)
+        stage_metrics.bytes_written = get_file_sizes(self.pdf_file)
+        if self.cache is not None:
+            self.cache.store(self.cache_keys["pdf"], self.pdf_file)
+
+    def rasterize(self):
+        """ :return a generator of (page index, image path or bytes) of the pdf, stored in the artifact cache """
+        pages = rasterize_pdf(self.pdf_file, self.temp_dir, self.config.raster_pages_per_chunk,
+                              self.config.raster_thread_count, **get_raster_options(self.config))
+        if self.cache is not None:
+            pages = store_cached_pages(self.cache, self.cache_keys["pages"], pages)
+        return pages
+
+    def _run_pages(self, stage_metrics: StageMetrics):
+        self.pages = list(self.rasterize())
+        stage_metrics.bytes_read = get_file_sizes(self._get_pdf())
+        stage_metrics.bytes_written = get_file_sizes(*(image for _, image in self.pages))
+        stage_metrics.pages = len(self.pages)
+
+    def _keep_pages(self, pages):
+        return pages
+
+    def _run_dcm_pdf(self, stage_metrics: StageMetrics):
+        dcm_file = os.path.join(self.output_dir, self.output_file_name + ".pdf.dcm")
+        sop_instance_uid = generate_dcm_uid(self.config.oid_root, sha256sum(self.dcm_sr_path))
+        logging.getLogger(__name__).info("converting pdf into DICOM pdf file {}".format(dcm_file))
+        pdf = self._get_pdf()
+        if self.config.dcm_encoder == "native":
+            encoder = create_dicom_encoder(self.dcm_sr_path, self.config.pdf2dcm_exe_additional_options)
+            encoder.write_encapsulated_pdf(pdf, dcm_file, sop_instance_uid)
+        else:
+            if isinstance(pdf, bytes):
+                # pdf2dcm reads files only
+                pdf_file = os.path.join(self._get_encoder_temp_dir(), self.name + ".pdf")
+                with open(pdf_file, "wb") as out_file:
+                    out_file.write(pdf)
             else:
-                wkhtmltopdf = "wkhtmltopdf"
-                if sys.platform == 'win32':
-                    wkhtmltopdf += ".exe"
-                pdfkit.from_file(filled_template_file, pdf_tmp_file,
-                                 configuration=pdfkit.pdfkit.Configuration(wkhtmltopdf=wkhtmltopdf))
-        if config.target == "pdf":
-            pdf_output_file_path = os.path.join(output_dir, output_file_name + ".pdf")
-            shutil.move(pdf_tmp_file, pdf_output_file_path)
-            logger.info("pdf file created in {}. quit requested.".format(pdf_output_file_path))
-            sys.exit(0)
-
-        # CONVERT TO DICOM
-        dcm_files = []
-        # GENERATE DICOM PDF
-        if config.target == "dcm_pdf":
-            # CONVERT TO DICOM PDF
-            dcm_pdf_tmp_file = os.path.join(output_dir, output_file_name + ".pdf.dcm")
-            sop_instance_uid = generate_dcm_uid(config.oid_root, sha256sum(dcm_sr_path))
-            logger.info("converting file {} into DICOM pdf file {}".format(pdf_tmp_file, dcm_pdf_tmp_file))
-            run_cmd("pdf2dcm", pdf_tmp_file, dcm_pdf_tmp_file, "--series-from", dcm_sr_path,
-                    *config.pdf2dcm_exe_additional_options, "--key", "0008,0018={}".format(sop_instance_uid))
-            dcm_files.append(dcm_pdf_tmp_file)
-        # GENERATE DICOM IMAGE STUDY (DEFAULT TARGET)
+                pdf_file = pdf
+            run_cmd(*get_pdf2dcm_args(self.config, self.dcm_sr_path, pdf_file, dcm_file, sop_instance_uid))
+        stage_metrics.bytes_read = get_file_sizes(pdf)
+        stage_metrics.bytes_written = get_file_sizes(dcm_file)
+        self.output_files = [dcm_file]
+
+    def _run_dcm_images(self, stage_metrics: StageMetrics):
+        pages = self.pages
+        if pages is None:
+            pages = self.rasterize()
+            stage_metrics.bytes_read = get_file_sizes(self._get_pdf())
+        dcm_files = convert_pdf_to_dcm_images(self._get_pdf(), self.dcm_sr_path, self.config,
+                                              self._get_encoder_temp_dir(), self.output_dir, self.output_file_name,
+                                              self._keep_pages(pages), stage_metrics)
+        stage_metrics.bytes_written = get_file_sizes(*dcm_files)
+        measure_page_sizes(dcm_files, stage_metrics)
+        self.output_files = dcm_files
+
+    def _run_send(self, stage_metrics: StageMetrics):
+        """ sends the DICOM files (and the SR if configured) to the DICOM node """
+        dcm_files = list(self.output_files)
+        if self.config.dcm_send_dcm_sr:
+            dcm_files.append(self.dcm_sr_path)
+        logging.getLogger(__name__).info("sending files {} to dicom node".format(", ".join(dcm_files)))
+        if self.config.dcm_sender in ("native", "fake"):
+            get_dicom_sender(self.config).send(dcm_files)
         else:
-            images = pdf2image.convert_from_path(pdf_tmp_file, paths_only=True, output_folder=temp_dir,
-                                                 fmt="jpg")
-            for idx, image in enumerate(images):
-                # Do something here
-                dcm_file = os.path.join(output_dir, output_file_name + "_image" + str(idx + 1) + ".dcm")
-                logger.info("converting image {} into DICOM file {}".format(image, dcm_file))
-                sop_instance_uid = generate_dcm_uid(config.oid_root, sha256sum(image))
-
-                run_cmd("img2dcm", "--series-from", dcm_sr_path, *config.img2dcm_exe_additional_options, image,
-                        dcm_file, "--key", "0008,0060=OT", "--key", "0020,0013={}".format(idx + 1), "--key",
-                        "0020,0013={}".format(idx + 1), "--key", "0008,0018={}".format(sop_instance_uid),
-                        print_stdout=True)
-                dcm_files.append(dcm_file)
-
-        # SEND TO DICOM NODE
-        if len(dcm_files) > 0 and config.dcm_send_ip:
-            if config.dcm_send_dcm_sr:
-                dcm_files.append(dcm_sr_path)
-            for dcm_file in dcm_files:
-                logger.info("sending file {} to dicom node".format(dcm_file))
-                # run_cmd("dcmsend", "localhost", "2727", dcm_sr_path)
-                run_cmd("dcmsend", config.dcm_send_ip, str(config.dcm_send_port), dcm_file,
-                        *config.dcmsend_exe_additional_options,
-                        print_stdout=False)
+            run_cmd(*get_dcmsend_args(self.config, dcm_files), print_stdout=False)
+        stage_metrics.bytes_read = get_file_sizes(*dcm_files)
 
+
+class InMemoryReportStages(ReportStages):
+    """
+    like ReportStages, but the stages pass bytes and trees instead of files. only the outputs are written and the
+    intermediate results only if config.temp_dir is set. Word, img2dcm and pdf2dcm can only read files and get
+    their input in a temp dir
+    """
+
+    def __init__(self, dcm_sr_path, config: Config, output_file_name=None,
+                 rule_program: Optional[RuleProgram] = None):
+        self.results = {}  # stage -> bytes of the xml, filled template and pdf
+        super().__init__(dcm_sr_path, config, output_file_name, rule_program)
+
+    def _create_dirs(self):
+        if self.output_dir is None:
+            self.output_dir = self._create_temp_dir()
+        self._encoder_temp_dir = self._create_temp_dir() if self.config.dcm_encoder != "native" else None
+
+    def _keep_intermediate(self, extension, data):
+        if self.config.temp_dir is not None:
+            with open(os.path.join(self.config.temp_dir, self.name + extension), "wb") as intermediate_file:
+                intermediate_file.write(data)
+
+    def _load_cached(self, stage, key):
+        if stage == "data":
+            return super()._load_cached(stage, key)
+        if stage == "pages":
+            self.pages = load_cached_pages(self.cache, key, None, self.name)
+            return self.pages is not None
+        self.results[stage] = self.cache.load_bytes(key)
+        return self.results[stage] is not None
+
+    def _write_output(self, stage, output_path):
+        with open(output_path, "wb") as output_file:
+            output_file.write(self.results[stage])
+
+    def _get_pdf(self):
+        return self.results.get("pdf")
+
+    def _get_encoder_temp_dir(self):
+        return self._encoder_temp_dir
+
+    def _run_xml(self, stage_metrics: StageMetrics):
+        logger = logging.getLogger(__name__)
+        if self.config.sr_xml_converter == "native":
+            logger.info("converting DICOM SR {} to XML in memory".format(self.dcm_sr_path))
+            self.root = sr_to_xml_tree(self.dcm_sr_path)
+            if self.cache is not None or self.config.target == "xml" or self.config.temp_dir is not None:
+                # the declaration ElementTree.write() gives the xml file of the other mode
+                self.results["xml"] = ET.tostring(self.root, encoding="UTF-8", xml_declaration=True,
+                                                  pretty_print=True)
+        else:
+            logger.info("converting DICOM SR {} to XML".format(self.dcm_sr_path))
+            # without an output file dsr2xml writes to stdout
+            self.results["xml"] = run_cmd_bytes("dsr2xml", *self.config.dsr2xml_exe_additional_options,
+                                                self.dcm_sr_path)
+        stage_metrics.bytes_read = get_file_sizes(self.dcm_sr_path)
+        if "xml" in self.results:
+            stage_metrics.bytes_written = len(self.results["xml"])
+            self._keep_intermediate(".xml", self.results["xml"])
+            if self.cache is not None:
+                self.cache.store_bytes(self.cache_keys["xml"], self.results["xml"])
+
+    def _load_xml(self, stage_metrics: StageMetrics):
+        logger = logging.getLogger(__name__)
+        stage_metrics.bytes_read = len(self.results["xml"])
+        if self.config.streaming_extraction and self.rule_program.stream_paths is not None:
+            logger.info("retrieving contents from XML (streaming)")
+            return parse_xml_pruned(io.BytesIO(self.results["xml"]), self.rule_program.stream_paths)
+        logger.info("retrieving contents from XML")
+        return ET.ElementTree(ET.fromstring(self.results["xml"]))
+
+    def _run_template(self, stage_metrics: StageMetrics):
+        logging.getLogger(__name__).info("replacing contents from template file {}".format(self.config.template_path))
+        if self.template_is_word:
+            filled_template = io.BytesIO()
+            replace_in_docx(self.config.template_path, self.template_data, filled_template)
+            self.results["template"] = filled_template.getvalue()
+        else:
+            self.results["template"] = fill_text_template(self.config.template_path, self.template_data)
+        stage_metrics.bytes_read = get_file_sizes(self.config.template_path)
+        stage_metrics.bytes_written = len(self.results["template"])
+        self._keep_intermediate(self.template_file_extension, self.results["template"])
+        if self.cache is not None:
+            self.cache.store_bytes(self.cache_keys["template"], self.results["template"])
+
+    def _run_pdf(self, stage_metrics: StageMetrics):
+        logging.getLogger(__name__).info("converting filled template into pdf")
+        renderer_pool = get_renderer_pool(self.config, self.template_is_word)
+        with suppress_stdout():
+            self.results["pdf"] = renderer_pool.render_data(self.results["template"], self.template_file_extension)
+        stage_metrics.bytes_read = len(self.results["template"])
+        stage_metrics.bytes_written = len(self.results["pdf"])
+        self._keep_intermediate(".pdf", self.results["pdf"])
+        if self.cache is not None:
+            self.cache.store_bytes(self.cache_keys["pdf"], self.results["pdf"])
+
+    def rasterize(self):
+        pages = rasterize_pdf_data(self.results["pdf"], **get_raster_options(self.config))
+        if self.cache is not None:
+            pages = store_cached_pages(self.cache, self.cache_keys["pages"], pages)
+        return pages
+
+    def _keep_pages(self, pages):
+        if self.config.temp_dir is None:
+            return pages
+        return self._keep_intermediate_pages(pages)
+
+    def _keep_intermediate_pages(self, pages):
+        for idx, image in pages:
+            self._keep_intermediate("_page{}.{}".format(
+                idx + 1, RASTER_FORMATS[self.config.dcm_image_transfer_syntax]), image)
+            yield idx, image
+
+
+def create_report_stages(dcm_sr_path, config: Config, output_file_name=None,
+                         rule_program: Optional[RuleProgram] = None) -> ReportStages:
+    """ :return the ReportStages of the DICOM SR, in memory if config.in_memory is set """
+    stages_class = InMemoryReportStages if config.in_memory else ReportStages
+    return stages_class(dcm_sr_path, config, output_file_name, rule_program)
+
+
+def generate_report(dcm_sr_path, config_file, log_level, log_file, profile_file=None):
+    """
+    :param profile_file if set, the python side of the report is profiled with cProfile and the stats are written
+    to this file
+    """
+    # logging
+    setup_logging(log_level, log_file)
+    logger = logging.getLogger(__name__)
+
+    # LOAD CONFIG AND SETUP
+    try:
+        config = load_config(config_file)
+    except ReportGeneratorError as error:
+        quit(str(error))
+    config.add_paths()
+    metrics = ReportMetrics(dcm_sr_path)
+    profiler = cProfile.Profile() if profile_file else None
+
+    # files need to be deleted
+    try:
+        if profiler is not None:
+            profiler.enable()
+        process_report(dcm_sr_path, config, metrics=metrics)
+        cache = get_artifact_cache(config)
+        if cache is not None:
+            logger.info("cache hits: {}, cache misses: {}".format(cache.hits, cache.misses))
+    except ReportGeneratorError as error:
+        quit(str(error))
     except Exception as error:
         logger.exception(error)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            logger.info("profile written to {}".format(profile_file))
+        exporter = create_metrics_exporter(config)
+        if exporter is not None:
+            exporter.export(metrics.to_dict())
+
+
+def collect_dcm_sr_paths(inputs: List[str], extensions=(".dcm",)):
+    """
+    expands directories, glob patterns and manifest files (prefixed with "@", one path per line) into a sorted list
+    of DICOM SR files
+    """
+    dcm_sr_paths = []
+    for input_ in inputs:
+        if input_.startswith("@"):
+            with open(input_[1:]) as manifest_file:
+                lines = [line.strip() for line in manifest_file]
+            dcm_sr_paths.extend(collect_dcm_sr_paths([line for line in lines if line and not line.startswith("#")],
+                                                     extensions))
+        elif os.path.isdir(input_):
+            for file_name in sorted(os.listdir(input_)):
+                file_path = os.path.join(input_, file_name)
+                if os.path.isfile(file_path) and file_name.lower().endswith(extensions):
+                    dcm_sr_paths.append(file_path)
+        elif glob.has_magic(input_):
+            dcm_sr_paths.extend(sorted(glob.glob(input_)))
+        else:
+            dcm_sr_paths.append(input_)
+    return dcm_sr_paths
+
+
+def get_required_backends(config: Config) -> List[LazyModule]:
+    """ :return the backends the stages up to config.target need """
+    backends = []
+    if config.target != "xml" or config.sr_xml_converter == "native":
+        backends.append(ET)
+    if config.target == "xml":
+        return backends
+    _, template_file_extension = os.path.splitext(config.template_path)
+    template_is_word = template_file_extension == ".docx"
+    if config.target == "template":
+        return backends
+    renderer_name = resolve_renderer_name(config, template_is_word)
+    if renderer_name == "word":
+        backends.append(client)
+    elif renderer_name == "wkhtmltopdf":
+        backends.append(pdfkit)
+    if config.target == "dcm_images":
+        backends.append(pdf2image)
+    return backends
+
+
+def measure_startup_time(module_name="api", runs=3):
+    """
+    :return the best wall time in seconds for starting a fresh interpreter and importing module_name from this
+    directory
+    """
+    src_dir = os.path.dirname(os.path.realpath(__file__))
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import " + module_name], cwd=src_dir, check=True)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+_batch_worker_state = {}
+
+
+def init_batch_worker(config: Config, log_level, log_file):
+    """ initializer of the worker processes of the batch and daemon modes """
+    setup_logging(log_level, log_file)
+    # the parent process decides about shutting down, e.g. on Ctrl+C it lets the workers finish their reports
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # each worker process compiles the rules and loads the backends once and reuses them for all its reports
+    _batch_worker_state["config"] = config
+    _batch_worker_state["rule_program"] = config.compile_rules()
+    for backend in get_required_backends(config):
+        backend.load()
+
+
+def process_batch_report(dcm_sr_path, output_file_name):
+    """ processes one report in a worker process set up by init_batch_worker, errors end up in the result """
+    logger = logging.getLogger(__name__)
+    result = ReportResult(dcm_sr_path)
+    start = time.perf_counter()
+    metrics = ReportMetrics(dcm_sr_path)
+    try:
+        result.output_files = process_report(dcm_sr_path, _batch_worker_state["config"], output_file_name,
+                                             _batch_worker_state["rule_program"], metrics)
+        result.success = True
+    except ReportGeneratorError as error:
+        logger.error(error)
+        result.error = str(error)
+    except Exception as error:
+        logger.exception(error)
+        result.error = str(error)
+    result.duration = time.perf_counter() - start
+    result.metrics = metrics.to_dict()
+    result.cache_hits = metrics.cache_hits
+    result.cache_misses = metrics.cache_misses
+    return result
+
+
+def process_batch_reports(reports):
+    """
+    processes a chunk of (dcm_sr_path, output_file_name) at the same time, so their pdf stages can share one renderer
+    invocation
+    """
+    if len(reports) == 1:
+        return [process_batch_report(*reports[0])]
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=len(reports), thread_name_prefix="batch-report") as executor:
+        return list(executor.map(lambda report: process_batch_report(*report), reports))
+
+
+def generate_reports(inputs: List[str], config_file, log_level, log_file, workers=None, summary_file=None,
+                     job_store=None, lease_time=300.0, stage_scheduler=False):
+    """
+    batch mode: loads the config once and processes all DICOM SR files found in inputs with a process pool
+    :param job_store path of a JobStore database. the DICOM SR files are added to it and the workers process its
+    jobs, including the ones left over by earlier runs or added by other hosts
+    :param stage_scheduler process the reports with the StageScheduler in this process instead of a process pool
+    :return the list of ReportResult objects in input order, with a job store in processing order
+    """
+    setup_logging(log_level, log_file)
+    logger = logging.getLogger(__name__)
+
+    try:
+        config = load_config(config_file)
+        # fail early on invalid xpath expressions
+        config.compile_rules()
+    except ReportGeneratorError as error:
+        quit(str(error))
+    config.add_paths()
+
+    dcm_sr_paths = collect_dcm_sr_paths(inputs)
+    if not dcm_sr_paths:
+        quit("no DICOM SR files found in {}".format(", ".join(inputs)))
+    # output file names are derived from the SR file names in batch mode, so they must be unique
+    output_file_names = [os.path.basename(os.path.splitext(path)[0]) for path in dcm_sr_paths]
+    if len(set(output_file_names)) != len(output_file_names):
+        quit("the DICOM SR file names in a batch must be unique")
+    if config.output_file_name is not None:
+        logger.warning("output_file_name {} is ignored in batch mode".format(config.output_file_name))
+
+    workers = workers if workers else os.cpu_count()
+    logger.info("processing {} DICOM SR files with {} workers".format(len(dcm_sr_paths), workers))
+    start = time.perf_counter()
+    store = None
+    if job_store:
+        from job_store import JobStore, process_job_store, schedule_job_store
+
+        store = JobStore(job_store, lease_time)
+        added = sum(1 for path in dcm_sr_paths if store.add(path))
+        logger.warning("{} of {} DICOM SR files added to the job store {}".format(added, len(dcm_sr_paths),
+                                                                                  job_store))
+    # with render batching every worker gets chunks of reports, one renderer invocation per chunk at best
+    reports = list(zip(dcm_sr_paths, output_file_names))
+    chunk_size = max(1, config.render_batch_size)
+    chunks = [reports[idx:idx + chunk_size] for idx in range(0, len(reports), chunk_size)]
+    if stage_scheduler:
+        # one process in which the stages of different reports overlap
+        for backend in get_required_backends(config):
+            backend.load()
+        import asyncio
+        from stage_scheduler import StageScheduler
+
+        scheduler = StageScheduler(config)
+        if store is not None:
+            results = asyncio.run(schedule_job_store(scheduler, job_store, lease_time))
+        else:
+            results = asyncio.run(scheduler.run(reports))
+        exporter = create_metrics_exporter(config)
+        for result in results:
+            if exporter is not None:
+                exporter.export(result.metrics)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker,
+                                 initargs=(config, log_level, log_file)) as executor:
+            if store is not None:
+                # every worker claims jobs until none is left
+                futures = [executor.submit(process_job_store, job_store, lease_time) for _ in range(workers)]
+                chunks = [[] for _ in futures]
+            else:
+                futures = [executor.submit(process_batch_reports, chunk) for chunk in chunks]
+            results = []
+            exporter = create_metrics_exporter(config)
+            for chunk, future in zip(chunks, futures):
+                try:
+                    chunk_results = future.result()
+                except Exception as error:
+                    # e.g. a crashed worker process
+                    if store is not None:
+                        logger.error("a worker failed: {}, its job is claimed again when the lease expired".format(
+                            error))
+                    chunk_results = []
+                    for path, _ in chunk:
+                        result = ReportResult(path)
+                        result.error = str(error)
+                        chunk_results.append(result)
+                for result in chunk_results:
+                    results.append(result)
+                    if exporter is not None:
+                        exporter.export(result.metrics)
+    if store is not None:
+        # a failed job is retried, only its last attempt counts
+        results = list({result.dcm_sr_path: result for result in results}.values())
+        logger.warning("job store: {}".format(", ".join("{} {}".format(count, status) for status, count in
+                                                         sorted(store.counts().items()))))
+
+    failed = [result for result in results if not result.success]
+    for result in failed:
+        logger.error("report for {} failed: {}".format(result.dcm_sr_path, result.error))
+    logger.warning("batch finished in {:.2f}s: {} succeeded, {} failed".format(time.perf_counter() - start,
+                                                                                len(results) - len(failed),
+                                                                                len(failed)))
+    if config.cache_dir:
+        logger.warning("cache: {} stage hits, {} stage misses".format(sum(result.cache_hits for result in results),
+                                                                      sum(result.cache_misses for result in results)))
+    if summary_file:
+        with open(summary_file, 'w') as out_file:
+            json.dump([result.to_dict() for result in results], out_file, indent=4)
+    return results
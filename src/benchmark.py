@@ -0,0 +1,316 @@
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import time
+
+import api
+
+# name: (content item count, characters per text item)
+SCALES = {
+    "small": (10, 200),
+    "medium": (100, 500),
+    "large": (1000, 1000),
+}
+
+WORDS = ("lesion", "contrast", "normal", "enhancement", "no", "evidence", "of", "focal", "left", "right", "lobe",
+         "unremarkable", "mild", "degenerative", "changes", "nodule", "mm", "stable", "compared", "to", "prior")
+
+TEMPLATE = """<!doctype html>
+<html lang="en">
+  <head><meta charset="utf-8"><title>Report</title></head>
+  <body>
+    <h1>Report</h1>
+    <p><b>Name:</b>$name$</p>
+    <p><b>Findings:</b>$findings$</p>
+  </body>
+</html>
+"""
+
+
+def create_text(rnd: random.Random, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rnd.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+
+def create_synthetic_sr(path, item_count, text_size, seed=0):
+    """
+    writes a Basic Text SR with a findings container of item_count text items with text_size characters each.
+    the same arguments always give the same file
+    """
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    rnd = random.Random(seed)
+
+    def uid(name):
+        return generate_uid(entropy_srcs=[str(seed), str(item_count), str(text_size), name])
+
+    def code(value, meaning):
+        item = Dataset()
+        item.CodeValue = value
+        item.CodingSchemeDesignator = "99BENCH"
+        item.CodeMeaning = meaning
+        return item
+
+    def text_item(meaning, text):
+        item = Dataset()
+        item.RelationshipType = "CONTAINS"
+        item.ValueType = "TEXT"
+        item.ConceptNameCodeSequence = [code("F" + str(len(meaning)), meaning)]
+        item.TextValue = text
+        return item
+
+    findings = Dataset()
+    findings.RelationshipType = "CONTAINS"
+    findings.ValueType = "CONTAINER"
+    findings.ContinuityOfContent = "SEPARATE"
+    findings.ConceptNameCodeSequence = [code("121070", "Findings")]
+    findings.ContentSequence = [text_item("Finding", create_text(rnd, text_size)) for _ in range(item_count)]
+
+    dataset = Dataset()
+    dataset.SOPClassUID = "1.2.840.10008.5.1.4.1.1.88.11"
+    dataset.SOPInstanceUID = uid("instance")
+    dataset.StudyInstanceUID = uid("study")
+    dataset.SeriesInstanceUID = uid("series")
+    dataset.SpecificCharacterSet = "ISO_IR 100"
+    dataset.Modality = "SR"
+    dataset.Manufacturer = "ReportGenerator benchmark"
+    dataset.PatientName = "Bench^Mark"
+    dataset.PatientID = "BENCH{}".format(seed)
+    dataset.PatientBirthDate = "19700101"
+    dataset.PatientSex = "O"
+    dataset.StudyDate = dataset.ContentDate = "20200101"
+    dataset.StudyTime = dataset.ContentTime = "120000"
+    dataset.StudyID = "1"
+    dataset.AccessionNumber = "BENCH"
+    dataset.ReferringPhysicianName = ""
+    dataset.SeriesNumber = 1
+    dataset.InstanceNumber = 1
+    dataset.CompletionFlag = "COMPLETE"
+    dataset.VerificationFlag = "UNVERIFIED"
+    dataset.ValueType = "CONTAINER"
+    dataset.ContinuityOfContent = "SEPARATE"
+    dataset.ConceptNameCodeSequence = [code("11528-7", "Radiology Report")]
+    dataset.ContentSequence = [findings]
+
+    dataset.file_meta = FileMetaDataset()
+    dataset.file_meta.MediaStorageSOPClassUID = dataset.SOPClassUID
+    dataset.file_meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+    dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset.save_as(path, enforce_file_format=True)
+    return path
+
+
+def select_backends():
+    """
+    :return the config options for the backends, the fake renderer and sender and the pydicom converter and encoder
+    stand in for the missing external tools
+    """
+    backends = {
+        "sr_xml_converter": "dsr2xml" if shutil.which("dsr2xml") else "native",
+        "renderer": "wkhtmltopdf" if shutil.which("wkhtmltopdf") else "fake",
+        "dcm_encoder": "dcmtk" if shutil.which("img2dcm") and shutil.which("pdf2dcm") else "native",
+        "dcm_sender": "fake",
+        # rasterizing needs poppler, without it the dicom pdf is benchmarked instead of the images
+        "target": "dcm_images" if shutil.which("pdftoppm") else "dcm_pdf",
+    }
+    return backends
+
+
+def create_benchmark_config(work_dir, backends, config_options=None):
+    config = api.Config()
+    config.from_dict(dict(backends))
+    if config_options:
+        config.from_dict(dict(config_options))
+    config.template_path = os.path.join(work_dir, "template.html")
+    config.output_dir = os.path.join(work_dir, "output")
+    config.rules = [api.Rule.create_from_dict({
+        "name": "$findings$", "concat_string": "<br>",
+        "xpath_expressions": [
+            "/report/document/content/container/container/text[concept/meaning[contains(text(), \"Finding\")]]"
+            "/value/text()"]}),
+        api.Rule.create_from_dict({
+            "name": "$name$", "concat_string": " ",
+            "xpath_expressions": ["/report/patient/name/first/text()", "/report/patient/name/last/text()"]})]
+    config.dcm_send_ip = "127.0.0.1"
+    config.dcm_send_port = 104
+    with open(config.template_path, "w") as template_file:
+        template_file.write(TEMPLATE)
+    config_file = os.path.join(work_dir, "config.json")
+    api.dump_config_to_file(config_file, config)
+    return config_file
+
+
+def median_stage_times(metrics_list):
+    stage_times = {}
+    for metrics in metrics_list:
+        for stage in metrics["stages"]:
+            stage_times.setdefault(stage["name"], []).append(stage["wall_time"])
+    return {name: statistics.median(times) for name, times in stage_times.items()}
+
+
+def run_scale(work_dir, scale, item_count, text_size, repeat, batch_reports, workers, config_file):
+    """
+    :return the results of one scale: median stage and report times of single runs, batch throughput, peak memory
+    """
+    logger = logging.getLogger(__name__)
+    scale_dir = os.path.join(work_dir, scale)
+    batch_dir = os.path.join(scale_dir, "batch")
+    shutil.rmtree(batch_dir, ignore_errors=True)
+    os.makedirs(batch_dir)
+    dcm_sr_path = create_synthetic_sr(os.path.join(scale_dir, "report.dcm"), item_count, text_size)
+    for idx in range(batch_reports):
+        shutil.copyfile(dcm_sr_path, os.path.join(batch_dir, "report{}.dcm".format(idx)))
+
+    # SINGLE REPORTS: THE FIRST RUN WARMS UP THE RENDERER AND THE IMPORTS AND IS NOT COUNTED
+    config = api.load_config(config_file)
+    config.add_paths()
+    rule_program = config.compile_rules()
+    metrics_list = []
+    for run in range(repeat + 1):
+        metrics = api.ReportMetrics(dcm_sr_path)
+        api.process_report(dcm_sr_path, config, "single", rule_program, metrics)
+        if run > 0:
+            metrics_list.append(metrics.to_dict())
+    report_times = [metrics["wall_time"] for metrics in metrics_list]
+    pages = max(stage["pages"] for stage in metrics_list[0]["stages"]) or None
+    image_stages = [stage for stage in metrics_list[0]["stages"] if stage["name"] == "dcm_images" and stage["pages"]]
+    image_bytes_per_page = image_stages[0]["bytes_written"] // image_stages[0]["pages"] if image_stages else None
+    logger.warning("{}: {} items x {} chars, median report time {:.3f}s".format(scale, item_count, text_size,
+                                                                                statistics.median(report_times)))
+
+    # BATCH: END TO END INCLUDING THE WORKER START
+    start = time.perf_counter()
+    results = api.generate_reports([batch_dir], config_file, logging.WARNING, None, workers)
+    batch_time = time.perf_counter() - start
+    failed = [result for result in results if not result.success]
+    if failed:
+        raise api.ReportGeneratorError("{} of {} batch reports failed: {}".format(len(failed), len(results),
+                                                                                 failed[0].error))
+    logger.warning("{}: batch of {} reports in {:.3f}s".format(scale, batch_reports, batch_time))
+
+    return {
+        "items": item_count,
+        "text_size": text_size,
+        "sr_bytes": os.path.getsize(dcm_sr_path),
+        "pages": pages,
+        "image_bytes_per_page": image_bytes_per_page,
+        "stage_seconds": median_stage_times(metrics_list),
+        "report_seconds": statistics.median(report_times),
+        "reports_per_second": 1.0 / statistics.median(report_times),
+        "batch_reports": batch_reports,
+        "batch_seconds": batch_time,
+        "batch_reports_per_second": batch_reports / batch_time,
+        "peak_rss": max(metrics["peak_rss"] or 0 for metrics in metrics_list) or None,
+        "batch_peak_rss": max(result.metrics["peak_rss"] or 0 for result in results) or None,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance, min_delta=0.005):
+    """
+    :return the regressions, i.e. the times which are more than tolerance (relative) and min_delta seconds slower
+    than in the baseline
+    """
+    regressions = []
+    if results["backends"] != baseline.get("backends"):
+        logging.getLogger(__name__).warning("the baseline was recorded with other backends: {}".format(
+            baseline.get("backends")))
+    # (scale, name, baseline time, time)
+    comparisons = []
+    if baseline.get("startup_seconds"):
+        comparisons.append(("", "startup", baseline["startup_seconds"], results["startup_seconds"]))
+    for scale, scale_results in results["scales"].items():
+        baseline_scale = baseline.get("scales", {}).get(scale)
+        if baseline_scale is None:
+            continue
+        times = dict(("stage " + name, value) for name, value in scale_results["stage_seconds"].items())
+        times["report"] = scale_results["report_seconds"]
+        times["batch"] = scale_results["batch_seconds"]
+        baseline_times = dict(("stage " + name, value) for name, value in baseline_scale["stage_seconds"].items())
+        baseline_times["report"] = baseline_scale["report_seconds"]
+        baseline_times["batch"] = baseline_scale["batch_seconds"]
+        if scale_results.get("image_bytes_per_page") and baseline_scale.get("image_bytes_per_page"):
+            # not a regression check, the size depends on the raster and transfer syntax options
+            print("{:8} {:20} {:10d}B {:10d}B {:+8.1%}".format(
+                scale, "image bytes per page", baseline_scale["image_bytes_per_page"],
+                scale_results["image_bytes_per_page"],
+                scale_results["image_bytes_per_page"] / baseline_scale["image_bytes_per_page"] - 1.0))
+        for name, value in times.items():
+            if baseline_times.get(name):
+                comparisons.append((scale, name, baseline_times[name], value))
+    for scale, name, baseline_value, value in comparisons:
+        change = value / baseline_value - 1.0
+        print("{:8} {:20} {:10.4f}s {:10.4f}s {:+8.1%}".format(scale, name, baseline_value, value, change))
+        if change > tolerance and value - baseline_value > min_delta:
+            regressions.append("{} {}: {:.4f}s -> {:.4f}s ({:+.1%})".format(scale, name, baseline_value, value,
+                                                                           change))
+    return regressions
+
+
+def run_benchmark(work_dir, scales, repeat=3, batch_reports=16, workers=None, baseline_file=None,
+                  save_baseline_file=None, tolerance=0.2, config_options=None):
+    """
+    :param config_options additional config options, e.g. the raster options to compare against a baseline
+    :return the list of regressions against the baseline (empty without a baseline)
+    """
+    logger = logging.getLogger(__name__)
+    os.makedirs(work_dir, exist_ok=True)
+    backends = select_backends()
+    logger.warning("backends: {}".format(backends))
+    config_file = create_benchmark_config(work_dir, backends, config_options)
+    results = {"python": sys.version.split()[0], "cpu_count": os.cpu_count(), "backends": backends,
+               "startup_seconds": api.measure_startup_time(), "scales": {}}
+    for scale in scales:
+        item_count, text_size = SCALES[scale]
+        results["scales"][scale] = run_scale(work_dir, scale, item_count, text_size, repeat, batch_reports, workers,
+                                             config_file)
+
+    results_file = os.path.join(work_dir, "results.json")
+    with open(results_file, "w") as out_file:
+        json.dump(results, out_file, indent=4)
+    logger.warning("results written to {}".format(results_file))
+    if save_baseline_file:
+        shutil.copyfile(results_file, save_baseline_file)
+    regressions = []
+    if baseline_file:
+        with open(baseline_file) as in_file:
+            regressions = compare_to_baseline(results, json.load(in_file), tolerance)
+        for regression in regressions:
+            logger.error("regression: {}".format(regression))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the report pipeline with synthetic DICOM SRs. Missing external tools are replaced'
+                    ' by the fake renderer and sender and the pydicom based converter and encoder')
+    parser.add_argument('work_dir', type=str, help='directory for the synthetic SRs, configs, outputs and results')
+    parser.add_argument('--scales', type=str, default=",".join(SCALES.keys()),
+                        help='comma separated scales, any of: ' + ", ".join(
+                            "{} ({} items x {} chars)".format(name, *SCALES[name]) for name in SCALES))
+    parser.add_argument('--repeat', type=int, default=3, help='timed single report runs per scale')
+    parser.add_argument('--batch_reports', type=int, default=16, help='reports per batch run')
+    parser.add_argument('--workers', type=int, default=None, help='batch workers (default: number of cores)')
+    parser.add_argument('--baseline', type=str, default=None, help='results.json of an earlier run to compare to')
+    parser.add_argument('--save_baseline', type=str, default=None, help='store the results as baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown against the baseline which counts as regression')
+    parser.add_argument('--config_options', type=str, default=None,
+                        help='json object with additional config options, e.g. {"raster_color": "gray"}')
+    args = parser.parse_args()
+
+    api.setup_logging(logging.WARNING)
+    regressions = run_benchmark(args.work_dir, args.scales.split(","), args.repeat, args.batch_reports,
+                                args.workers, args.baseline, args.save_baseline, args.tolerance,
+                                json.loads(args.config_options) if args.config_options else None)
+    sys.exit(-1 if regressions else 0)
@@ -0,0 +1,256 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import ExitStack, closing, contextmanager
+from typing import Dict, Optional
+
+from api import ReportResult, process_batch_report, sha256sum, stage_done_callback
+
+
+class JobStore:
+    """
+    a durable queue of report jobs in a SQLite database, on local disk or on a shared volume (with working file
+    locks) for several hosts. a job is identified by the sha256 of its DICOM SR, so adding the same SR twice is a no-op.
+    workers claim jobs under a lease which they renew while processing, jobs with an expired lease are claimed again
+    by the next worker. every job records its completed stages, its output files and its last error
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            dcm_sr_path TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            lease_expires REAL,
+            stages TEXT NOT NULL DEFAULT '[]',
+            output_files TEXT NOT NULL DEFAULT '[]',
+            error TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+    """
+
+    def __init__(self, path, lease_time=300.0, max_attempts=3):
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        with self._connect() as connection:
+            connection.executescript(self.SCHEMA)
+
+    def _connect(self):
+        """ a connection per call, so the store can be used from several threads and processes """
+        # autocommit, write transactions are started explicitly with BEGIN IMMEDIATE
+        connection = sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return closing(connection)
+
+    @staticmethod
+    def _to_job(row):
+        job = dict(row)
+        job["stages"] = json.loads(job["stages"])
+        job["output_files"] = json.loads(job["output_files"])
+        return job
+
+    def add(self, dcm_sr_path):
+        """ :return True if the DICOM SR was added, False if a job for the same SR exists already """
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO jobs (id, dcm_sr_path, status, created, updated) VALUES (?, ?, 'queued', ?, ?)",
+                (sha256sum(dcm_sr_path), dcm_sr_path, now, now))
+            return cursor.rowcount == 1
+
+    def claim(self, owner) -> Optional[Dict]:
+        """ :return the oldest queued job or job with an expired lease, leased to owner, or None """
+        logger = logging.getLogger(__name__)
+        with self._connect() as connection:
+            while True:
+                now = time.time()
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    row = connection.execute(
+                        "SELECT * FROM jobs WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?)"
+                        " ORDER BY created LIMIT 1", (now,)).fetchone()
+                    if row is None:
+                        connection.execute("COMMIT")
+                        return None
+                    if row["status"] == "running":
+                        logger.warning("the lease of {} on {} expired".format(row["owner"], row["dcm_sr_path"]))
+                    if row["attempts"] >= self.max_attempts:
+                        connection.execute(
+                            "UPDATE jobs SET status = 'failed', owner = NULL, lease_expires = NULL, error = ?,"
+                            " updated = ? WHERE id = ?",
+                            ("gave up after {} attempts, last error: {}".format(row["attempts"], row["error"]), now,
+                             row["id"]))
+                        connection.execute("COMMIT")
+                        continue
+                    connection.execute(
+                        "UPDATE jobs SET status = 'running', owner = ?, lease_expires = ?, attempts = attempts + 1,"
+                        " updated = ? WHERE id = ?", (owner, now + self.lease_time, now, row["id"]))
+                    connection.execute("COMMIT")
+                except BaseException:
+                    connection.execute("ROLLBACK")
+                    raise
+                job = self._to_job(row)
+                job.update(status="running", owner=owner, attempts=row["attempts"] + 1)
+                return job
+
+    def _update_leased(self, job_id, owner, assignments, values):
+        """ :return False if owner does not hold the lease anymore """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET {}, updated = ? WHERE id = ? AND owner = ? AND status = 'running'".format(assignments),
+                tuple(values) + (time.time(), job_id, owner))
+            return cursor.rowcount == 1
+
+    def renew(self, job_id, owner):
+        return self._update_leased(job_id, owner, "lease_expires = ?", (time.time() + self.lease_time,))
+
+    def complete_stage(self, job_id, owner, stage):
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute("SELECT stages FROM jobs WHERE id = ? AND owner = ?",
+                                         (job_id, owner)).fetchone()
+                if row is not None:
+                    stages = json.loads(row["stages"])
+                    if stage not in stages:
+                        stages.append(stage)
+                        connection.execute("UPDATE jobs SET stages = ?, updated = ? WHERE id = ?",
+                                           (json.dumps(stages), time.time(), job_id))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def finish(self, job_id, owner, output_files):
+        return self._update_leased(job_id, owner, "status = 'done', owner = NULL, lease_expires = NULL, output_files"
+                                                  " = ?, error = NULL", (json.dumps(output_files),))
+
+    def fail(self, job_id, owner, error):
+        """ queues the job again until it failed max_attempts times """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, owner = NULL,"
+                " lease_expires = NULL, error = ?, updated = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                (self.max_attempts, error, time.time(), job_id, owner))
+            return cursor.rowcount == 1
+
+    @contextmanager
+    def keep_lease(self, job_id, owner):
+        """ renews the lease of the job in a background thread until the enclosed block is left """
+        logger = logging.getLogger(__name__)
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease_time / 3):
+                if not self.renew(job_id, owner):
+                    logger.warning("lost the lease on job {}".format(job_id))
+                    return
+
+        thread = threading.Thread(target=renew, name="job-lease", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def counts(self):
+        """ :return status: number of jobs """
+        with self._connect() as connection:
+            return dict(tuple(row) for row in connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+
+def _skip_sent_job(store: JobStore, job, owner):
+    """ :return True if the job has been sent already and is finished without processing it again """
+    if "send" not in job["stages"]:
+        return False
+    # the worker holding the job before died after sending, do not send twice
+    logging.getLogger(__name__).warning("{} has been sent already".format(job["dcm_sr_path"]))
+    store.finish(job["id"], owner, job["output_files"])
+    return True
+
+
+def _record_result(store: JobStore, job, owner, result: ReportResult):
+    if result.success:
+        leased = store.finish(job["id"], owner, result.output_files)
+    else:
+        leased = store.fail(job["id"], owner, result.error)
+    if not leased:
+        logging.getLogger(__name__).warning("the lease on {} expired while processing it".format(job["dcm_sr_path"]))
+
+
+def process_job_store(job_store_path, lease_time):
+    """
+    claims and processes jobs of the job store until none is left
+    :return the ReportResult objects of the processed jobs
+    """
+    store = JobStore(job_store_path, lease_time)
+    owner = "{}:{}".format(socket.gethostname(), os.getpid())
+    results = []
+    while True:
+        job = store.claim(owner)
+        if job is None:
+            return results
+        if _skip_sent_job(store, job, owner):
+            continue
+        output_file_name = os.path.basename(os.path.splitext(job["dcm_sr_path"])[0])
+        token = stage_done_callback.set(lambda stage: store.complete_stage(job["id"], owner, stage))
+        try:
+            with store.keep_lease(job["id"], owner):
+                result = process_batch_report(job["dcm_sr_path"], output_file_name)
+        finally:
+            stage_done_callback.reset(token)
+        _record_result(store, job, owner, result)
+        results.append(result)
+
+
+async def schedule_job_store(scheduler, job_store_path, lease_time):
+    """
+    like process_job_store(), but the jobs go through the StageScheduler, so the stages of several jobs overlap. the
+    next job is claimed as soon as the first stage has room for it
+    :return the ReportResult objects of the processed jobs
+    """
+    loop = asyncio.get_running_loop()
+    store = JobStore(job_store_path, lease_time)
+    owner = "{}:{}".format(socket.gethostname(), os.getpid())
+
+    async def finish(job, lease: ExitStack, done):
+        try:
+            result = await done
+        finally:
+            # joins the renewal thread, which may be in the middle of a renewal waiting for the database
+            await loop.run_in_executor(None, lease.close)
+        await loop.run_in_executor(None, _record_result, store, job, owner, result)
+        return result
+
+    await scheduler.start()
+    try:
+        results = []
+        processing = set()
+        while True:
+            job = await loop.run_in_executor(None, store.claim, owner)
+            if job is None:
+                if not processing:
+                    return results
+                # a failed job is queued again
+                finished, processing = await asyncio.wait(processing, return_when=asyncio.FIRST_COMPLETED)
+                results.extend(task.result() for task in finished)
+                continue
+            if await loop.run_in_executor(None, _skip_sent_job, store, job, owner):
+                continue
+            output_file_name = os.path.basename(os.path.splitext(job["dcm_sr_path"])[0])
+            lease = ExitStack()
+            lease.enter_context(store.keep_lease(job["id"], owner))
+            done = await scheduler.submit(job["dcm_sr_path"], output_file_name,
+                                          lambda stage, job_id=job["id"]: store.complete_stage(job_id, owner, stage))
+            processing.add(asyncio.ensure_future(finish(job, lease, done)))
+    finally:
+        await scheduler.stop()
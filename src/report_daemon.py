@@ -0,0 +1,186 @@
+import logging
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from api import (Config, ReportGeneratorError, ReportResult, SEND_UNCOMPRESSED_TRANSFER_SYNTAXES,
+                 create_metrics_exporter, init_batch_worker, load_config, process_batch_reports, quit, setup_logging)
+
+
+class ReportDaemon:
+    """
+    keeps a pool of warm worker processes and feeds it with the DICOM SR files dropped into inbox_dir and, if
+    scp_port is set, with the SR objects received by an embedded C-STORE SCP. processed files are moved to
+    inbox_dir/done or inbox_dir/failed. at most max_pending reports are in flight, the rest waits in the inbox. with
+    render_batch_size > 1 the files found by one inbox scan go to the workers in chunks of that size, so their pdf
+    stages can share one renderer invocation
+    """
+
+    def __init__(self, config: Config, inbox_dir, workers=None, log_level=logging.INFO, log_file=None,
+                 scp_port=None, scp_ae_title="REPORTGEN", poll_interval=0.2, max_pending=None):
+        self.config = config
+        self.inbox_dir = inbox_dir
+        self.done_dir = os.path.join(inbox_dir, "done")
+        self.failed_dir = os.path.join(inbox_dir, "failed")
+        self.workers = workers if workers else os.cpu_count()
+        self.log_level = log_level
+        self.log_file = log_file
+        self.scp_port = scp_port
+        self.scp_ae_title = scp_ae_title
+        self.poll_interval = poll_interval
+        self.max_pending = max_pending if max_pending else self.workers * 2 * max(1, config.render_batch_size)
+        self._pending = set()
+        self._file_sizes = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._executor = None
+        self._scp = None
+        self._exporter = create_metrics_exporter(config)
+
+    def _create_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=init_batch_worker,
+                                   initargs=(self.config, self.log_level, self.log_file))
+
+    def submit(self, dcm_sr_paths):
+        """
+        submits the reports of dcm_sr_paths to one worker, which processes them at the same time
+        :return False if max_pending reports are in flight already
+        """
+        with self._lock:
+            # a file is moved out of the inbox before it is removed from the pending files
+            dcm_sr_paths = [path for path in dcm_sr_paths if path not in self._pending and os.path.exists(path)]
+            if not dcm_sr_paths:
+                return True
+            if len(self._pending) >= self.max_pending or self._stop.is_set():
+                return False
+            self._pending.update(dcm_sr_paths)
+            reports = [(path, os.path.basename(os.path.splitext(path)[0])) for path in dcm_sr_paths]
+            try:
+                future = self._executor.submit(process_batch_reports, reports)
+            except BrokenProcessPool:
+                logging.getLogger(__name__).error("worker pool broken, restarting it")
+                self._executor = self._create_executor()
+                future = self._executor.submit(process_batch_reports, reports)
+        future.add_done_callback(lambda done_future: self._on_done(dcm_sr_paths, done_future))
+        return True
+
+    def _on_done(self, dcm_sr_paths, future):
+        logger = logging.getLogger(__name__)
+        try:
+            results = future.result()
+        except Exception as error:
+            # e.g. a crashed worker process
+            results = []
+            for dcm_sr_path in dcm_sr_paths:
+                result = ReportResult(dcm_sr_path)
+                result.error = str(error)
+                results.append(result)
+        for dcm_sr_path, result in zip(dcm_sr_paths, results):
+            if result.success:
+                logger.info("report for {} done in {:.2f}s".format(dcm_sr_path, result.duration))
+            else:
+                logger.error("report for {} failed: {}".format(dcm_sr_path, result.error))
+            if self._exporter is not None:
+                self._exporter.export(result.metrics)
+            target_dir = self.done_dir if result.success else self.failed_dir
+            try:
+                os.replace(dcm_sr_path, os.path.join(target_dir, os.path.basename(dcm_sr_path)))
+            except OSError as error:
+                logger.error("could not move {} to {}: {}".format(dcm_sr_path, target_dir, error))
+            with self._lock:
+                self._pending.discard(dcm_sr_path)
+
+    def scan_inbox(self):
+        """ submits the files whose size did not change since the last scan, i.e. which are completely written """
+        file_sizes = {}
+        for file_name in sorted(os.listdir(self.inbox_dir)):
+            path = os.path.join(self.inbox_dir, file_name)
+            if file_name.endswith((".part", ".tmp")) or not os.path.isfile(path):
+                continue
+            try:
+                file_sizes[path] = os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+        ready = [path for path, size in file_sizes.items() if self._file_sizes.get(path) == size]
+        chunk_size = max(1, self.config.render_batch_size)
+        for idx in range(0, len(ready), chunk_size):
+            if not self.submit(ready[idx:idx + chunk_size]):
+                # backpressure: leave the rest in the inbox
+                break
+        self._file_sizes = file_sizes
+
+    def _on_c_store(self, event):
+        """ writes the received SR into the inbox under a temporary name and submits it """
+        dataset = event.dataset
+        dataset.file_meta = event.file_meta
+        path = os.path.join(self.inbox_dir, "{}.dcm".format(dataset.SOPInstanceUID))
+        try:
+            dataset.save_as(path + ".part", enforce_file_format=True)
+            os.replace(path + ".part", path)
+        except Exception as error:
+            logging.getLogger(__name__).error("could not store received object: {}".format(error))
+            return 0xA700
+        # if all workers are busy the inbox scan picks it up later
+        self.submit([path])
+        return 0x0000
+
+    def _start_scp(self):
+        from pynetdicom import AE, evt, AllStoragePresentationContexts
+
+        ae = AE(ae_title=self.scp_ae_title)
+        for context in AllStoragePresentationContexts:
+            ae.add_supported_context(context.abstract_syntax, list(SEND_UNCOMPRESSED_TRANSFER_SYNTAXES))
+        ae.add_supported_context("1.2.840.10008.1.1")  # verification
+        self._scp = ae.start_server(("0.0.0.0", int(self.scp_port)), block=False,
+                                    evt_handlers=[(evt.EVT_C_STORE, self._on_c_store)])
+        logging.getLogger(__name__).info("C-STORE SCP {} listening on port {}".format(self.scp_ae_title,
+                                                                                     self.scp_port))
+
+    def stop(self, *args):
+        logging.getLogger(__name__).warning("stop requested, finishing pending reports")
+        self._stop.set()
+
+    def run(self):
+        """ runs until stop() is called (or SIGINT/SIGTERM), then finishes the pending reports """
+        logger = logging.getLogger(__name__)
+        for directory in (self.inbox_dir, self.done_dir, self.failed_dir):
+            os.makedirs(directory, exist_ok=True)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+        self._executor = self._create_executor()
+        if self.scp_port:
+            self._start_scp()
+        logger.warning("watching {} with {} workers".format(self.inbox_dir, self.workers))
+        try:
+            while not self._stop.is_set():
+                self.scan_inbox()
+                self._stop.wait(self.poll_interval)
+        finally:
+            if self._scp is not None:
+                self._scp.shutdown()
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        break
+                time.sleep(self.poll_interval)
+            self._executor.shutdown()
+        logger.warning("daemon stopped")
+
+
+def run_daemon(inbox_dir, config_file, log_level, log_file, workers=None, scp_port=None, scp_ae_title="REPORTGEN"):
+    setup_logging(log_level, log_file)
+    logger = logging.getLogger(__name__)
+
+    try:
+        config = load_config(config_file)
+        config.compile_rules()
+    except ReportGeneratorError as error:
+        quit(str(error))
+    config.add_paths()
+    if config.output_file_name is not None:
+        logger.warning("output_file_name {} is ignored in daemon mode".format(config.output_file_name))
+    ReportDaemon(config, inbox_dir, workers, log_level, log_file, scp_port, scp_ae_title).run()
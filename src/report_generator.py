@@ -1,16 +1,74 @@
 import argparse
+import multiprocessing
+import sys
+
 import api
 import logging
 
-# args
-parser = argparse.ArgumentParser(
-    description='A utility to generate a nicely formatted DICOM PDF from a DICOM SR report using'
-                ' a template document (like word etc)')
-parser.add_argument('dicom_sr_file', type=str, help='actual DICOM SR report file')
-parser.add_argument('config_file', type=str, help='actual json config file being used to produce the sr. refer to the manual')
-parser.add_argument('--log_level', type=int, default=logging.WARN,
-                    help='log level (CRITICAL = 50, ERROR = 40, WARNING = 30, INFO = 20, DEBUG = 10, NOTSET = 0')
-parser.add_argument('--log_file', type=str, default=None, help='log file')
+if __name__ == "__main__":
+    # needed for the process pool of the batch mode in the pyinstaller one file build
+    multiprocessing.freeze_support()
+
+    # args
+    parser = argparse.ArgumentParser(
+        description='A utility to generate a nicely formatted DICOM PDF from a DICOM SR report using'
+                    ' a template document (like word etc)')
+    parser.add_argument('dicom_sr_file', type=str, help='actual DICOM SR report file. in batch mode a directory, a glob'
+                                                        ' pattern or a manifest file prefixed with @ (one path per line).'
+                                                        ' in daemon mode the inbox directory, with --serve the jobs'
+                                                        ' directory')
+    parser.add_argument('config_file', type=str, help='actual json config file being used to produce the sr. refer to the manual')
+    parser.add_argument('--log_level', type=int, default=logging.WARN,
+                        help='log level (CRITICAL = 50, ERROR = 40, WARNING = 30, INFO = 20, DEBUG = 10, NOTSET = 0')
+    parser.add_argument('--log_file', type=str, default=None, help='log file')
+    parser.add_argument('--batch', action='store_true', help='process multiple DICOM SR files with a process pool')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and process the DICOM SR files dropped into the inbox directory')
+    parser.add_argument('--scp_port', type=int, default=None,
+                        help='daemon mode: also receive DICOM SR files with a C-STORE SCP on this port')
+    parser.add_argument('--scp_ae_title', type=str, default="REPORTGEN", help='daemon mode: AE title of the SCP')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes in batch and daemon mode (default: number of cores)')
+    parser.add_argument('--summary_file', type=str, default=None,
+                        help='json file receiving the per report results in batch mode')
+    parser.add_argument('--job_store', type=str, default=None,
+                        help='batch mode: SQLite database of a durable job queue, finished SRs are skipped and SRs of'
+                             ' crashed runs are processed again. several hosts may share it on a shared volume')
+    parser.add_argument('--lease_time', type=float, default=300.0,
+                        help='batch mode with --job_store: seconds after which the job of a dead worker is claimed'
+                             ' again')
+    parser.add_argument('--stage_scheduler', action='store_true',
+                        help='batch mode: process the reports in one process whose stages overlap (asyncio), the'
+                             ' limits per stage are set with the stage_concurrency config option')
+    parser.add_argument('--serve', type=int, default=None, metavar='PORT',
+                        help='run the HTTP job API on this port. the first argument is the jobs directory, the config'
+                             ' file argument may list several config files or directories separated by commas, each'
+                             ' one is a profile named after its file')
+    parser.add_argument('--serve_host', type=str, default="0.0.0.0", help='HTTP job API: the listening address')
+    parser.add_argument('--cpu_stage_limit', type=int, default=None,
+                        help='HTTP job API: reports in the xml extraction and template filling stages at the same time'
+                             ' (default: number of cores)')
+    parser.add_argument('--tool_stage_limit', type=int, default=2,
+                        help='HTTP job API: reports in the external tool stages (dsr2xml, rendering, DICOM encoding,'
+                             ' sending) at the same time')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='single report mode: write cProfile stats of the python side stages to this file'
+                             ' (view with snakeviz, flameprof or python -m pstats)')
 
-args = parser.parse_args()
-api.generate_report(args.dicom_sr_file, args.config_file, args.log_level, args.log_file)
+    args = parser.parse_args()
+    # the modules of the long running modes are imported on use, the single report mode starts without them
+    if args.serve:
+        import report_server
+        report_server.run_server(args.dicom_sr_file, args.config_file.split(","), args.log_level, args.log_file,
+                                 args.serve, args.serve_host, args.cpu_stage_limit, args.tool_stage_limit)
+    elif args.daemon:
+        import report_daemon
+        report_daemon.run_daemon(args.dicom_sr_file, args.config_file, args.log_level, args.log_file, args.workers,
+                                 args.scp_port, args.scp_ae_title)
+    elif args.batch:
+        results = api.generate_reports([args.dicom_sr_file], args.config_file, args.log_level, args.log_file,
+                                       args.workers, args.summary_file, args.job_store, args.lease_time,
+                                       args.stage_scheduler)
+        sys.exit(0 if all(result.success for result in results) else -1)
+    else:
+        api.generate_report(args.dicom_sr_file, args.config_file, args.log_level, args.log_file, args.profile)
@@ -0,0 +1,368 @@
+import asyncio
+import contextvars
+import copy
+import glob
+import json
+import logging
+import os
+import shutil
+import signal
+import threading
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from api import (Config, DataObject, ReportGeneratorError, ReportMetrics, create_metrics_exporter,
+                 get_required_backends, load_config, process_report, quit, setup_logging, stage_limits)
+
+
+# the concurrency limit group of each stage: "cpu" for the python side, "tool" for the external tools
+STAGE_LIMIT_GROUPS = {"xml": "tool", "data": "cpu", "template": "cpu", "pdf": "tool", "dcm_pdf": "tool",
+                      "dcm_images": "tool", "send": "tool"}
+
+
+def get_stage_limit_groups(config: Config):
+    """ :return STAGE_LIMIT_GROUPS for config, the stages done in python instead of a tool are in the "cpu" group """
+    groups = dict(STAGE_LIMIT_GROUPS)
+    if config.sr_xml_converter == "native":
+        groups["xml"] = "cpu"
+    if config.dcm_encoder == "native":
+        # the pdf is encapsulated without pdf2dcm, the page images still come from pdftoppm
+        groups["dcm_pdf"] = "cpu"
+    return groups
+
+
+HTTP_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+CONTENT_TYPES = {".pdf": "application/pdf", ".dcm": "application/dicom", ".xml": "application/xml",
+                 ".html": "text/html", ".json": "application/json",
+                 ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"}
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ReportJob(DataObject):
+
+    def __init__(self, job_id=None, profile=None):
+        super().__init__()
+        self.id = job_id
+        self.profile = profile
+        self.status = "queued"  # one of "queued", "running", "done", "failed"
+        self.error = None  # type: Optional[str]
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.output_files = []  # type: List[str]
+        self.metrics = None  # type: Optional[Dict]
+
+
+class ReportServer:
+    """
+    an asyncio HTTP API around process_report(). the config profiles are loaded once and selected per job, uploads
+    and downloads are streamed from and to the jobs directory. the reports run in threads, at most cpu_limit of them
+    in the python stages (xml extraction, template filling) and at most tool_limit in the external tool stages
+    (dsr2xml, rendering, rasterizing and encoding, sending) at the same time. with the native converter or encoder
+    the xml or dcm_pdf stage counts as a python stage (get_stage_limit_groups())
+
+        GET    /profiles                     the config profiles
+        POST   /jobs?profile=<name>          body: the DICOM SR, returns the job (202)
+        GET    /jobs/<id>                    the job status, output_files is filled when the status is "done"
+        GET    /jobs/<id>/files/<file name>  an output file
+        DELETE /jobs/<id>                    removes a finished job and its files
+    """
+
+    def __init__(self, profiles: Dict[str, Config], jobs_dir, cpu_limit=None, tool_limit=2, queue_size=100,
+                 max_upload_size=512 * 1024 * 1024, job_ttl=3600.0):
+        self.profiles = profiles
+        self.rule_programs = {name: config.compile_rules() for name, config in profiles.items()}
+        self.exporters = {name: create_metrics_exporter(config) for name, config in profiles.items()}
+        self.jobs_dir = jobs_dir
+        self.cpu_limit = cpu_limit if cpu_limit else os.cpu_count()
+        self.tool_limit = tool_limit
+        self.queue_size = queue_size
+        self.max_upload_size = max_upload_size
+        self.job_ttl = job_ttl
+        semaphores = {"cpu": threading.Semaphore(self.cpu_limit), "tool": threading.Semaphore(self.tool_limit)}
+        # profile name -> stage name -> semaphore of its group, the groups depend on the converters of the profile
+        self.stage_limits = {name: {stage: semaphores[group] for stage, group in get_stage_limit_groups(config).items()}
+                             for name, config in profiles.items()}
+        self.jobs = {}  # type: Dict[str, ReportJob]
+        # enough reports in flight to keep both kinds of stages busy
+        self.runner_count = self.cpu_limit + self.tool_limit
+        self._executor = ThreadPoolExecutor(max_workers=self.runner_count, thread_name_prefix="report-job")
+        self._queue = None
+        self._stop = None
+
+    def _job_dir(self, job: ReportJob):
+        return os.path.join(self.jobs_dir, job.id)
+
+    def _process_job(self, job: ReportJob):
+        # a shallow copy shares the rules, only the output location differs per job
+        config = copy.copy(self.profiles[job.profile])
+        config.output_dir = self._job_dir(job)
+        dcm_sr_path = os.path.join(self._job_dir(job), job.id + ".dcm")
+        metrics = ReportMetrics(dcm_sr_path)
+        try:
+            return process_report(dcm_sr_path, config, "report", self.rule_programs[job.profile], metrics)
+        finally:
+            job.metrics = metrics.to_dict()
+            if self.exporters[job.profile] is not None:
+                self.exporters[job.profile].export(job.metrics)
+
+    async def _run_jobs(self):
+        logger = logging.getLogger(__name__)
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started = time.time()
+            context = contextvars.copy_context()
+            context.run(stage_limits.set, self.stage_limits[job.profile])
+            try:
+                output_files = await loop.run_in_executor(self._executor, context.run, self._process_job, job)
+                job.output_files = [os.path.basename(output_file) for output_file in output_files]
+                job.status = "done"
+                logger.info("job {} done in {:.2f}s".format(job.id, time.time() - job.started))
+            except Exception as error:
+                job.status = "failed"
+                job.error = str(error)
+                logger.error("job {} failed: {}".format(job.id, error))
+            finally:
+                job.finished = time.time()
+                self._queue.task_done()
+
+    async def _remove_expired_jobs(self):
+        while True:
+            await asyncio.sleep(min(60.0, self.job_ttl))
+            now = time.time()
+            for job in list(self.jobs.values()):
+                if job.finished is not None and now - job.finished > self.job_ttl:
+                    self._remove_job(job)
+
+    def _remove_job(self, job: ReportJob):
+        self.jobs.pop(job.id, None)
+        shutil.rmtree(self._job_dir(job), ignore_errors=True)
+
+    async def _receive_body(self, reader, writer, headers, path):
+        """ streams the request body into path """
+        chunked = headers.get("transfer-encoding", "").lower() == "chunked"
+        remaining = None if chunked else int(headers.get("content-length", "0"))
+        if remaining is not None and remaining > self.max_upload_size:
+            # before the client was asked to send the body
+            raise HttpError(413, "the upload exceeds {} bytes".format(self.max_upload_size))
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
+        size = 0
+        with open(path, "wb") as out_file:
+            while True:
+                if chunked:
+                    chunk_size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+                    if chunk_size == 0:
+                        # skip the trailer
+                        while (await reader.readline()).strip():
+                            pass
+                        break
+                    data = await reader.readexactly(chunk_size)
+                    await reader.readexactly(2)
+                elif remaining > 0:
+                    data = await reader.read(min(remaining, 256 * 1024))
+                    if not data:
+                        raise HttpError(400, "incomplete request body")
+                    remaining -= len(data)
+                else:
+                    break
+                size += len(data)
+                if size > self.max_upload_size:
+                    raise HttpError(413, "the upload exceeds {} bytes".format(self.max_upload_size))
+                out_file.write(data)
+        return size
+
+    @staticmethod
+    async def _send(writer, status, body=b"", content_type="application/json", headers=None):
+        head = ["HTTP/1.1 {} {}".format(status, HTTP_REASONS.get(status, "")), "Content-Type: " + content_type,
+                "Content-Length: {}".format(len(body)), "Connection: close"]
+        head.extend("{}: {}".format(key, value) for key, value in (headers or {}).items())
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def _send_json(self, writer, status, data, headers=None):
+        await self._send(writer, status, json.dumps(data).encode("utf-8"), headers=headers)
+
+    @staticmethod
+    async def _send_file(writer, path):
+        _, extension = os.path.splitext(path)
+        head = ["HTTP/1.1 200 OK", "Content-Type: " + CONTENT_TYPES.get(extension, "application/octet-stream"),
+                "Content-Length: {}".format(os.path.getsize(path)),
+                "Content-Disposition: attachment; filename=\"{}\"".format(os.path.basename(path)),
+                "Connection: close"]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        with open(path, "rb") as in_file:
+            while True:
+                data = in_file.read(256 * 1024)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+
+    async def _create_job(self, reader, writer, headers, query):
+        profile = query.get("profile", [next(iter(self.profiles))])[0]
+        if profile not in self.profiles:
+            raise HttpError(404, "unknown profile {}".format(profile))
+        if self._queue.full():
+            raise HttpError(503, "too many queued jobs")
+        job = ReportJob(uuid.uuid4().hex, profile)
+        os.makedirs(self._job_dir(job))
+        try:
+            size = await self._receive_body(reader, writer, headers, os.path.join(self._job_dir(job), job.id + ".dcm"))
+            if size == 0:
+                raise HttpError(400, "the request body must be a DICOM SR")
+        except BaseException:
+            shutil.rmtree(self._job_dir(job), ignore_errors=True)
+            raise
+        self.jobs[job.id] = job
+        self._queue.put_nowait(job)
+        logging.getLogger(__name__).info("job {} queued with profile {} ({} bytes)".format(job.id, profile, size))
+        await self._send_json(writer, 202, job.to_dict(), {"Location": "/jobs/" + job.id})
+
+    async def _handle(self, reader, writer):
+        logger = logging.getLogger(__name__)
+        try:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            lines = head.decode("latin-1").split("\r\n")
+            request_line = lines[0].split(" ")
+            if len(request_line) != 3:
+                raise HttpError(400, "invalid request line")
+            method, target = request_line[0], request_line[1]
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+            url = urllib.parse.urlsplit(target)
+            parts = [urllib.parse.unquote(part) for part in url.path.split("/") if part]
+            query = urllib.parse.parse_qs(url.query)
+            logger.debug("{} {}".format(method, target))
+
+            if parts == ["profiles"] and method == "GET":
+                await self._send_json(writer, 200, {
+                    name: {"target": config.target, "template_path": config.template_path}
+                    for name, config in self.profiles.items()})
+            elif parts == ["jobs"] and method == "POST":
+                await self._create_job(reader, writer, headers, query)
+            elif parts == ["jobs"] and method == "GET":
+                await self._send_json(writer, 200, [job.to_dict() for job in self.jobs.values()])
+            elif len(parts) >= 2 and parts[0] == "jobs":
+                job = self.jobs.get(parts[1])
+                if job is None:
+                    raise HttpError(404, "unknown job {}".format(parts[1]))
+                if len(parts) == 2 and method == "GET":
+                    await self._send_json(writer, 200, job.to_dict())
+                elif len(parts) == 2 and method == "DELETE":
+                    if job.finished is None:
+                        raise HttpError(409, "job {} is {}".format(job.id, job.status))
+                    self._remove_job(job)
+                    await self._send_json(writer, 200, job.to_dict())
+                elif len(parts) == 4 and parts[2] == "files" and method == "GET":
+                    if parts[3] not in job.output_files:
+                        raise HttpError(404, "job {} has no output file {}".format(job.id, parts[3]))
+                    await self._send_file(writer, os.path.join(self._job_dir(job), parts[3]))
+                else:
+                    raise HttpError(405, "{} {} is not supported".format(method, url.path))
+            else:
+                raise HttpError(404, "{} not found".format(url.path))
+        except HttpError as error:
+            await self._send_json(writer, error.status, {"error": str(error)})
+        except (ConnectionError, asyncio.IncompleteReadError) as error:
+            logger.debug("connection lost: {}".format(error))
+        except Exception as error:
+            logger.exception(error)
+            await self._send_json(writer, 500, {"error": str(error)})
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def stop(self):
+        logging.getLogger(__name__).warning("stop requested, finishing running jobs")
+        self._stop.set()
+
+    async def serve(self, host="0.0.0.0", port=8080):
+        """ runs until stop() is called (or SIGINT/SIGTERM) """
+        logger = logging.getLogger(__name__)
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._stop = asyncio.Event()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(stop_signal, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # windows or not the main thread, Ctrl+C raises KeyboardInterrupt there
+                pass
+        tasks = [asyncio.ensure_future(self._run_jobs()) for _ in range(self.runner_count)]
+        tasks.append(asyncio.ensure_future(self._remove_expired_jobs()))
+        server = await asyncio.start_server(self._handle, host, port)
+        logger.warning("serving on {}:{} with profiles {}".format(host, port, ", ".join(self.profiles.keys())))
+        try:
+            await self._stop.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            # the reports in the threads cannot be cancelled, queued jobs are dropped
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._executor.shutdown()
+        logger.warning("server stopped")
+
+
+def load_profiles(config_paths: List[str]) -> Dict[str, Config]:
+    """
+    :param config_paths config files or directories of config files, a profile is named after its file
+    :return the validated configs by profile name
+    """
+    config_files = []
+    for config_path in config_paths:
+        if os.path.isdir(config_path):
+            config_files.extend(sorted(glob.glob(os.path.join(config_path, "*.json"))))
+        else:
+            config_files.append(config_path)
+    profiles = {}
+    for config_file in config_files:
+        config = load_config(config_file)
+        config.compile_rules()
+        config.add_paths()
+        for backend in get_required_backends(config):
+            backend.load()
+        profiles[os.path.basename(os.path.splitext(config_file)[0])] = config
+    if not profiles:
+        raise ReportGeneratorError("no config files found in {}".format(", ".join(config_paths)))
+    return profiles
+
+
+def run_server(jobs_dir, config_paths: List[str], log_level, log_file, port=8080, host="0.0.0.0", cpu_limit=None,
+               tool_limit=2):
+    setup_logging(log_level, log_file)
+    try:
+        profiles = load_profiles(config_paths)
+    except ReportGeneratorError as error:
+        quit(str(error))
+    server = ReportServer(profiles, jobs_dir, cpu_limit, tool_limit)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,180 @@
+import asyncio
+import contextvars
+import logging
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from api import (Config, ReportGeneratorError, ReportMetrics, ReportResult, ReportStages, RuleProgram,
+                 command_runner, create_report_stages, current_metrics, get_peak_rss, get_stage_names,
+                 stage_done_callback)
+
+
+async def run_cmd_async(args, input_data=None):
+    """
+    runs the command with asyncio.create_subprocess_exec, the event loop waits for it instead of a thread
+    :return the return code, stdout and stderr
+    """
+    process = await asyncio.create_subprocess_exec(*args, stdin=subprocess.PIPE if input_data is not None else None,
+                                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error_output = await process.communicate(input_data)
+    return process.returncode, output, error_output
+
+
+def get_stage_concurrency(config: Config):
+    """ :return stage name: concurrency limit of the stage scheduler, config.stage_concurrency over the defaults """
+    cpu_count = os.cpu_count() or 1
+    # the renderer pool renders renderer_pool_size batches at the same time, more reports just wait in it
+    concurrency = {"xml": cpu_count, "data": 2, "template": 2,
+                   "pdf": config.renderer_pool_size * max(1, config.render_batch_size), "pages": cpu_count,
+                   "dcm_pdf": 2, "dcm_images": 2, "send": config.dcm_send_associations}
+    concurrency.update(config.stage_concurrency)
+    return concurrency
+
+
+class _ScheduledReport:
+
+    def __init__(self, dcm_sr_path, stage_done=None):
+        self.dcm_sr_path = dcm_sr_path
+        self.stage_done = stage_done
+        self.stages: Optional[ReportStages] = None
+        self.remaining = []  # the stages left to run
+        self.result = ReportResult(dcm_sr_path)
+        self.metrics = ReportMetrics(dcm_sr_path)
+        self.start = time.perf_counter()
+        self.done = asyncio.get_running_loop().create_future()
+
+
+class StageScheduler:
+    """
+    runs many reports through the stages at the same time: every stage has its own workers (get_stage_concurrency())
+    and a bounded queue in front of it (config.stage_queue_size), so report A is rendered while report B is converted
+    and report C is sent. the stages are the ones of process_report() (ReportStages), each one runs in a thread of
+    the scheduler. their external commands (run_cmd()) are started with run_cmd_async() in the event loop of the
+    scheduler. a report resumed from the artifact cache starts at its first uncached stage
+    """
+
+    def __init__(self, config: Config, rule_program: Optional[RuleProgram] = None):
+        self.config = config
+        self.rule_program = rule_program if rule_program is not None else config.compile_rules()
+        self.concurrency = get_stage_concurrency(config)
+        self.stages = get_stage_names(config, rasterize_separately=True)
+        self._executor = None
+        self._loop = None
+        self._queues = {}
+        self._workers = []
+
+    async def _in_thread(self, report: _ScheduledReport, function, *args):
+        def run():
+            # the thread attributes its work to the report and reports its completed stages
+            current_metrics.set(report.metrics)
+            stage_done_callback.set(report.stage_done)
+            command_runner.set(self._run_command)
+            return function(*args)
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, contextvars.copy_context().run, run)
+
+    def _run_command(self, args, input_data=None):
+        """ the command_runner of the stage threads, waits for run_cmd_async() in the event loop """
+        return asyncio.run_coroutine_threadsafe(run_cmd_async(args, input_data), self._loop).result()
+
+    async def start(self):
+        """ starts the workers of every stage """
+        self._loop = asyncio.get_running_loop()
+        python_workers = sum(self.concurrency[stage] for stage in self.stages)
+        self._executor = ThreadPoolExecutor(max_workers=python_workers, thread_name_prefix="stage")
+        self._queues = {stage: asyncio.Queue(maxsize=self.config.stage_queue_size) for stage in self.stages}
+        for stage in self.stages:
+            for _ in range(max(1, self.concurrency[stage])):
+                self._workers.append(asyncio.create_task(self._work(stage)))
+
+    async def stop(self):
+        """ stops the workers, the submitted reports must be done """
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._executor.shutdown()
+
+    async def submit(self, dcm_sr_path, output_file_name=None, stage_done=None) -> asyncio.Future:
+        """
+        resumes the report from the artifact cache and queues it in front of its first stage, waits while that stage
+        is busy and its queue is full
+        :param stage_done called with the stage name after every completed or cached stage, see stage_done_callback
+        :return a future of the ReportResult
+        """
+        report = _ScheduledReport(dcm_sr_path, stage_done)
+
+        def resume():
+            stages = create_report_stages(dcm_sr_path, self.config, output_file_name, self.rule_program)
+            stages.resume()
+            return stages
+
+        try:
+            report.stages = await self._in_thread(report, resume)
+        except Exception as error:
+            self._finish(report, error)
+            return report.done
+        report.remaining = report.stages.get_stages(rasterize_separately=True)
+        await self._forward(report)
+        return report.done
+
+    async def run(self, reports) -> List[ReportResult]:
+        """
+        :param reports (dcm_sr_path, output_file_name or None)
+        :return the ReportResult objects in input order
+        """
+        await self.start()
+        try:
+            done = [await self.submit(dcm_sr_path, output_file_name) for dcm_sr_path, output_file_name in reports]
+            return list(await asyncio.gather(*done))
+        finally:
+            await self.stop()
+
+    async def _work(self, stage):
+        while True:
+            report = await self._queues[stage].get()
+            try:
+                await self._in_thread(report, report.stages.run, stage)
+            except Exception as error:
+                self._finish(report, error)
+                continue
+            await self._forward(report)
+
+    async def _forward(self, report: _ScheduledReport):
+        """ queues the report in front of its next stage, or finishes it after the last one """
+        if report.remaining:
+            # waits while the next stage is busy and its queue is full
+            await self._queues[report.remaining.pop(0)].put(report)
+            return
+        try:
+            output_files = await self._in_thread(report, report.stages.finish)
+        except Exception as error:
+            self._finish(report, error)
+            return
+        self._finish(report, output_files=output_files)
+
+    def _finish(self, report: _ScheduledReport, error=None, output_files=()):
+        if error is not None:
+            logger = logging.getLogger(__name__)
+            if isinstance(error, ReportGeneratorError):
+                logger.error(error)
+            else:
+                logger.exception(error)
+        metrics = report.metrics
+        metrics.success = error is None
+        metrics.error = str(error) if error is not None else None
+        metrics.wall_time = time.perf_counter() - report.start
+        metrics.peak_rss, metrics.child_peak_rss = get_peak_rss()
+        report.result.success = error is None
+        report.result.error = metrics.error
+        report.result.output_files = list(output_files)
+        report.result.duration = metrics.wall_time
+        report.result.metrics = metrics.to_dict()
+        report.result.cache_hits = metrics.cache_hits
+        report.result.cache_misses = metrics.cache_misses
+        if report.stages is not None:
+            report.stages.close()
+        report.done.set_result(report.result)
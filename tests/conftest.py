@@ -0,0 +1,40 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+# the modules in src are imported by their names, as report_generator.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from api import load_config  # noqa: E402
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "base")
+
+
+@pytest.fixture
+def config(tmp_path):
+    """ the report10 config of base without external tools: native converter and encoder, fake renderer """
+    config = load_config(os.path.join(BASE_DIR, "report10_config.json"))
+    config.template_path = os.path.join(BASE_DIR, config.template_path)
+    config.sr_xml_converter = "native"
+    config.renderer = "fake"
+    config.dcm_encoder = "native"
+    config.target = "dcm_pdf"
+    config.temp_dir = None
+    config.output_dir = str(tmp_path / "output")
+    config.output_file_name = None
+    return config
+
+
+@pytest.fixture
+def dcm_sr_paths(tmp_path):
+    """ three copies of report10.dcm with different names """
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    paths = []
+    for idx in range(3):
+        path = str(input_dir / "report{}.dcm".format(idx + 1))
+        shutil.copy(os.path.join(BASE_DIR, "report10.dcm"), path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,124 @@
+import copy
+import os
+import shutil
+import time
+
+from api import ArtifactCache, ReportMetrics, Rule, compute_cache_keys, process_report
+
+
+def run_report(dcm_sr_path, config):
+    """ :return the metrics of processing the report """
+    metrics = ReportMetrics(dcm_sr_path)
+    process_report(dcm_sr_path, config, metrics=metrics)
+    return metrics
+
+
+def stage_runs(metrics):
+    """ :return the names of the stages which were cached and of the ones which ran """
+    return ([stage.name for stage in metrics.stages if stage.cached],
+            [stage.name for stage in metrics.stages if not stage.cached])
+
+
+def test_stage_keys_are_chained(config, dcm_sr_paths, tmp_path):
+    keys = compute_cache_keys(dcm_sr_paths[0], config)
+    assert compute_cache_keys(dcm_sr_paths[1], config) == keys
+
+    changed_rules = copy.deepcopy(config)
+    changed_rules.rules = config.rules + [Rule.create_from_dict({
+        "name": "$last$", "concat_string": " ", "xpath_expressions": ["/report/patient/name/last/text()"]})]
+    changed_keys = compute_cache_keys(dcm_sr_paths[0], changed_rules)
+    assert changed_keys["xml"] == keys["xml"]
+    assert all(changed_keys[stage] != keys[stage] for stage in ("data", "template", "pdf", "pages"))
+
+    changed_template = copy.deepcopy(config)
+    changed_template.template_path = str(tmp_path / "template.html")
+    with open(config.template_path, encoding="utf-8") as template_file:
+        template = template_file.read()
+    with open(changed_template.template_path, "w", encoding="utf-8") as template_file:
+        template_file.write(template.replace("</body>", "<p>changed</p></body>"))
+    changed_keys = compute_cache_keys(dcm_sr_paths[0], changed_template)
+    assert [changed_keys[stage] == keys[stage] for stage in ("xml", "data", "template", "pdf", "pages")] == [
+        True, True, False, False, False]
+
+    changed_raster = copy.deepcopy(config)
+    changed_raster.raster_dpi = config.raster_dpi + 100
+    changed_keys = compute_cache_keys(dcm_sr_paths[0], changed_raster)
+    assert [changed_keys[stage] == keys[stage] for stage in ("xml", "data", "template", "pdf", "pages")] == [
+        True, True, True, True, False]
+
+
+def test_second_run_is_a_hit_and_a_changed_input_a_miss(config, dcm_sr_paths, tmp_path):
+    config.cache_dir = str(tmp_path / "cache")
+    first = run_report(dcm_sr_paths[0], config)
+    assert (first.cache_hits, first.cache_misses) == (0, 4)
+    assert stage_runs(first) == ([], ["xml", "data", "template", "pdf", "dcm_pdf"])
+
+    # the deepest cached stage is loaded, the ones before it are not needed anymore
+    second = run_report(dcm_sr_paths[0], config)
+    assert (second.cache_hits, second.cache_misses) == (1, 0)
+    assert stage_runs(second) == (["xml", "data", "template", "pdf"], ["dcm_pdf"])
+
+    # another SR misses from the first stage on
+    changed_sr = str(tmp_path / "changed.dcm")
+    shutil.copy(dcm_sr_paths[0], changed_sr)
+    with open(changed_sr, "ab") as sr_file:
+        sr_file.write(b"\0\0")
+    third = run_report(changed_sr, config)
+    assert (third.cache_hits, third.cache_misses) == (0, 4)
+
+
+def test_resume_from_the_deepest_cached_stage(config, dcm_sr_paths, tmp_path):
+    config.cache_dir = str(tmp_path / "cache")
+    config.target = "template"
+    run_report(dcm_sr_paths[0], config)
+
+    config.target = "dcm_pdf"
+    metrics = run_report(dcm_sr_paths[0], config)
+    assert stage_runs(metrics) == (["xml", "data", "template"], ["pdf", "dcm_pdf"])
+    output_file = os.path.join(config.output_dir, "report1.pdf.dcm")
+    assert os.path.exists(output_file)
+
+    # without the pdf entry the report resumes from the template again
+    keys = compute_cache_keys(dcm_sr_paths[0], config)
+    os.remove(os.path.join(config.cache_dir, keys["pdf"][0:2], keys["pdf"]))
+    metrics = run_report(dcm_sr_paths[0], config)
+    assert stage_runs(metrics) == (["xml", "data", "template"], ["pdf", "dcm_pdf"])
+
+
+def store_entries(cache, count, size):
+    """ stores count entries of size bytes, each one used a second before the next one """
+    keys = ["{:02x}".format(idx) * 32 for idx in range(count)]
+    for idx, key in enumerate(keys):
+        cache.store_bytes(key, b"x" * size)
+        used = time.time() - (count - idx)
+        os.utime(cache._path(key), (used, used))
+    return keys
+
+
+def test_eviction_removes_the_least_recently_used_entries(tmp_path):
+    cache = ArtifactCache(str(tmp_path / "cache"), max_size=1000)
+    keys = store_entries(cache, 3, 300)
+    assert all(cache.contains(key) for key in keys)
+    # the oldest entry was used last
+    assert cache.load_bytes(keys[0]) == b"x" * 300
+    cache.store_bytes("ff" * 32, b"x" * 300)
+    # 1200 bytes, down to 90% of max_size: the least recently used entry is gone
+    assert [cache.contains(key) for key in keys] == [True, False, True]
+    assert cache.contains("ff" * 32)
+    assert sum(size for _, size, _ in cache._entries()) <= 900
+
+
+def test_eviction_keeps_the_entries_being_written(tmp_path):
+    cache = ArtifactCache(str(tmp_path / "cache"), max_size=1000)
+    entry_dir = tmp_path / "cache" / "ee"
+    entry_dir.mkdir()
+    # another process writing an entry for ten minutes, and the leftover of a writer which crashed two hours ago
+    writing = entry_dir / ("ee" * 32 + ".1.tmp")
+    writing.write_bytes(b"x" * 300)
+    os.utime(str(writing), (time.time() - 600, time.time() - 600))
+    crashed = entry_dir / ("ee" * 32 + ".2.tmp")
+    crashed.write_bytes(b"x" * 300)
+    os.utime(str(crashed), (time.time() - 7200, time.time() - 7200))
+    store_entries(cache, 4, 300)
+    assert writing.exists()
+    assert not crashed.exists()
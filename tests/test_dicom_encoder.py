@@ -0,0 +1,199 @@
+import io
+import os
+
+import pydicom
+import pytest
+from PIL import Image
+
+import api
+from api import (ENCAPSULATED_PDF_STORAGE, JPEG_BASELINE_TRANSFER_SYNTAX,
+                 MULTIFRAME_GRAYSCALE_BYTE_SECONDARY_CAPTURE_IMAGE_STORAGE,
+                 MULTIFRAME_TRUE_COLOR_SECONDARY_CAPTURE_IMAGE_STORAGE, SECONDARY_CAPTURE_IMAGE_STORAGE,
+                 convert_pdf_to_dcm_images, create_dicom_encoder, create_pdf, get_pdftoppm_options,
+                 get_raster_options)
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "base")
+SR_PATH = os.path.join(BASE_DIR, "report10.dcm")
+SOP_INSTANCE_UID = "1.2.826.0.1.3680043.10.1234.1"
+
+
+def create_image(fmt, mode="RGB", size=(64, 48)):
+    """ :return the bytes of an image with a black left half and a white right half """
+    image = Image.new(mode, size, "white")
+    image.paste("black", (0, 0, size[0] // 2, size[1]))
+    output = io.BytesIO()
+    image.save(output, format=fmt)
+    return output.getvalue()
+
+
+@pytest.fixture
+def encoder():
+    return create_dicom_encoder(SR_PATH, ["--no-checks", "--key", "0008,103E=report pages", "-k", "StationName=RG"])
+
+
+def assert_in_sr_series(dataset):
+    sr_dataset = pydicom.dcmread(SR_PATH, stop_before_pixels=True)
+    for keyword in ("PatientName", "PatientID", "StudyInstanceUID", "SeriesInstanceUID"):
+        assert dataset[keyword].value == sr_dataset[keyword].value
+    # the --key options of img2dcm and pdf2dcm
+    assert dataset.SeriesDescription == "report pages"
+    assert dataset.StationName == "RG"
+    assert dataset.SOPInstanceUID == dataset.file_meta.MediaStorageSOPInstanceUID == SOP_INSTANCE_UID
+
+
+def test_jpeg_page_is_wrapped_as_is(encoder, tmp_path):
+    jpeg_data = create_image("JPEG")
+    dcm_file = encoder.write_secondary_capture(jpeg_data, str(tmp_path / "page.dcm"), 2, SOP_INSTANCE_UID)
+    dataset = pydicom.dcmread(dcm_file)
+    assert_in_sr_series(dataset)
+    assert dataset.SOPClassUID == SECONDARY_CAPTURE_IMAGE_STORAGE
+    assert dataset.file_meta.TransferSyntaxUID == JPEG_BASELINE_TRANSFER_SYNTAX
+    assert (dataset.Modality, dataset.InstanceNumber) == ("OT", 2)
+    assert (dataset.Rows, dataset.Columns, dataset.SamplesPerPixel) == (48, 64, 3)
+    assert next(pydicom.encaps.generate_frames(dataset.PixelData, number_of_frames=1)) == jpeg_data
+    pixels = dataset.pixel_array
+    assert pixels.shape == (48, 64, 3)
+
+
+def test_png_page_is_stored_uncompressed(encoder, tmp_path):
+    dcm_file = encoder.write_secondary_capture(create_image("PNG", "L"), str(tmp_path / "page.dcm"), 1,
+                                               SOP_INSTANCE_UID)
+    dataset = pydicom.dcmread(dcm_file)
+    assert dataset.file_meta.TransferSyntaxUID == pydicom.uid.ExplicitVRLittleEndian
+    assert (dataset.PhotometricInterpretation, dataset.LossyImageCompression) == ("MONOCHROME2", "00")
+    pixels = dataset.pixel_array
+    assert pixels.shape == (48, 64)
+    assert (pixels[:, :32] == 0).all() and (pixels[:, 32:] == 255).all()
+
+
+def test_pdf_is_encapsulated(encoder, tmp_path):
+    pdf_data = create_pdf(page_count=3)
+    pdf_file = tmp_path / "report.pdf"
+    pdf_file.write_bytes(pdf_data)
+    dcm_file = encoder.write_encapsulated_pdf(str(pdf_file), str(tmp_path / "report.pdf.dcm"), SOP_INSTANCE_UID)
+    dataset = pydicom.dcmread(dcm_file)
+    assert_in_sr_series(dataset)
+    assert dataset.SOPClassUID == ENCAPSULATED_PDF_STORAGE
+    assert dataset.MIMETypeOfEncapsulatedDocument == "application/pdf"
+    # the pdf is padded to an even length
+    assert dataset.EncapsulatedDocumentLength == len(pdf_data)
+    assert dataset.EncapsulatedDocument[:len(pdf_data)] == pdf_data
+    pypdf = pytest.importorskip("pypdf")
+    assert len(pypdf.PdfReader(io.BytesIO(dataset.EncapsulatedDocument)).pages) == 3
+
+
+def test_encapsulated_pdf_matches_pdf2dcm(tmp_path):
+    # report09.pdf.dcm was written by pdf2dcm
+    pdf2dcm_dataset = pydicom.dcmread(os.path.join(BASE_DIR, "report09.pdf.dcm"))
+    encoder = create_dicom_encoder(os.path.join(BASE_DIR, "report09.dcm"), [])
+    dataset = pydicom.dcmread(encoder.write_encapsulated_pdf(pdf2dcm_dataset.EncapsulatedDocument,
+                                                             str(tmp_path / "report.pdf.dcm"),
+                                                             SOP_INSTANCE_UID))
+    for keyword in ("SOPClassUID", "Modality", "ConversionType", "BurnedInAnnotation", "PatientName",
+                    "StudyInstanceUID", "SeriesInstanceUID", "MIMETypeOfEncapsulatedDocument",
+                    "EncapsulatedDocument"):
+        assert dataset[keyword].value == pdf2dcm_dataset[keyword].value, keyword
+
+
+def test_mono_needs_a_lossless_transfer_syntax(config):
+    config.raster_color = "mono"
+    assert "raster_color mono needs a lossless dcm_image_transfer_syntax" in config.validate()
+    config.dcm_image_transfer_syntax = "rle"
+    assert config.validate() is None
+    config.dcm_image_transfer_syntax = "jpeg2000"
+    assert "dcm_image_transfer_syntax must be one of" in config.validate()
+
+
+def test_raster_options(config):
+    config.raster_dpi = 150
+    config.raster_color = "gray"
+    config.raster_jpeg_quality = 60
+    assert get_pdftoppm_options(**get_raster_options(config)) == ["-jpeg", "-r", "150", "-gray", "-jpegopt",
+                                                                  "quality=60"]
+    # the lossless syntaxes get png pages, the jpeg quality does not apply to them
+    config.raster_color = "mono"
+    config.dcm_image_transfer_syntax = "jpeg-ls"
+    assert get_pdftoppm_options(**get_raster_options(config)) == ["-png", "-r", "150", "-gray"]
+
+
+def test_bitonal_page_has_black_and_white_pixels_only(encoder, tmp_path):
+    gradient = Image.linear_gradient("L").resize((64, 48))
+    output = io.BytesIO()
+    gradient.save(output, format="PNG")
+    dcm_file = encoder.write_secondary_capture(output.getvalue(), str(tmp_path / "page.dcm"), 1, SOP_INSTANCE_UID,
+                                               bitonal=True)
+    assert set(pydicom.dcmread(dcm_file).pixel_array.flatten().tolist()) == {0, 255}
+
+
+def test_lossless_pages_are_compressed_after_encoding(config, tmp_path, monkeypatch):
+    compressions = []
+
+    def compress(compressor, uncompressed_file, dcm_file):
+        # dcmcrle, with the rle encoder of pydicom
+        compressions.append(compressor)
+        dataset = pydicom.dcmread(uncompressed_file)
+        dataset.compress(pydicom.uid.RLELossless)
+        dataset.save_as(dcm_file, enforce_file_format=True)
+
+    monkeypatch.setattr(api, "run_cmd", compress)
+    config.dcm_image_transfer_syntax = "rle"
+    config.raster_color = "mono"
+    output_dir = str(tmp_path / "output")
+    os.makedirs(output_dir)
+    pages = [(idx, create_image("PNG", "L", (64, 48 + idx))) for idx in range(2)]
+    dcm_files = convert_pdf_to_dcm_images(None, SR_PATH, config, str(tmp_path), output_dir, "report", pages)
+    assert compressions == ["dcmcrle", "dcmcrle"]
+    assert sorted(os.listdir(output_dir)) == ["report_image1.dcm", "report_image2.dcm"]
+    for idx, dcm_file in enumerate(dcm_files):
+        dataset = pydicom.dcmread(dcm_file)
+        assert dataset.file_meta.TransferSyntaxUID == pydicom.uid.RLELossless
+        assert dataset.InstanceNumber == idx + 1
+        assert dataset.pixel_array.shape == (48 + idx, 64)
+
+
+def test_jpeg_pages_become_the_frames_as_they_are(encoder, tmp_path):
+    pages = [create_image("JPEG") for _ in range(3)]
+    dcm_file = encoder.write_multiframe_secondary_capture(pages, str(tmp_path / "images.dcm"), SOP_INSTANCE_UID)
+    dataset = pydicom.dcmread(dcm_file)
+    assert_in_sr_series(dataset)
+    assert dataset.SOPClassUID == MULTIFRAME_TRUE_COLOR_SECONDARY_CAPTURE_IMAGE_STORAGE
+    assert dataset.file_meta.TransferSyntaxUID == JPEG_BASELINE_TRANSFER_SYNTAX
+    assert (dataset.NumberOfFrames, dataset.PageNumberVector) == (3, [1, 2, 3])
+    assert list(pydicom.encaps.generate_frames(dataset.PixelData, number_of_frames=3)) == pages
+    assert dataset.pixel_array.shape == (3, 48, 64, 3)
+
+
+def test_smaller_pages_are_padded_with_white(encoder, tmp_path):
+    pages = [create_image("PNG", "L", (64, 48)), create_image("PNG", "L", (32, 24))]
+    dcm_file = encoder.write_multiframe_secondary_capture(pages, str(tmp_path / "images.dcm"), SOP_INSTANCE_UID)
+    dataset = pydicom.dcmread(dcm_file)
+    assert dataset.SOPClassUID == MULTIFRAME_GRAYSCALE_BYTE_SECONDARY_CAPTURE_IMAGE_STORAGE
+    assert dataset.file_meta.TransferSyntaxUID == pydicom.uid.ExplicitVRLittleEndian
+    pixels = dataset.pixel_array
+    assert pixels.shape == (2, 48, 64)
+    assert (pixels[1, :24, :16] == 0).all() and (pixels[1, :24, 16:32] == 255).all()
+    assert (pixels[1, 24:, :] == 255).all() and (pixels[1, :, 32:] == 255).all()
+
+
+def test_jpeg_pages_of_different_sizes_are_encoded_again(encoder, tmp_path):
+    pages = [create_image("JPEG", size=(64, 48)), create_image("JPEG", size=(64, 40))]
+    dcm_file = encoder.write_multiframe_secondary_capture(pages, str(tmp_path / "images.dcm"), SOP_INSTANCE_UID,
+                                                          jpeg_quality=90)
+    dataset = pydicom.dcmread(dcm_file)
+    frames = list(pydicom.encaps.generate_frames(dataset.PixelData, number_of_frames=2))
+    assert frames[0] == pages[0] and frames[1] != pages[1]
+    assert dataset.pixel_array.shape == (2, 48, 64, 3)
+
+
+def test_multiframe_option_writes_one_object(config, tmp_path):
+    config.dcm_image_multiframe = True
+    output_dir = str(tmp_path / "output")
+    os.makedirs(output_dir)
+    pages = [(idx, create_image("JPEG")) for idx in (1, 0, 2)]
+    dcm_files = convert_pdf_to_dcm_images(None, SR_PATH, config, str(tmp_path), output_dir, "report", pages)
+    assert dcm_files == [os.path.join(output_dir, "report_images.dcm")]
+    dataset = pydicom.dcmread(dcm_files[0])
+    assert dataset.NumberOfFrames == 3
+    # the SOP Instance UID is derived from the pages
+    assert convert_pdf_to_dcm_images(None, SR_PATH, config, str(tmp_path), output_dir, "report", pages) == dcm_files
+    assert pydicom.dcmread(dcm_files[0]).SOPInstanceUID == dataset.SOPInstanceUID
@@ -0,0 +1,117 @@
+import os
+import shutil
+import threading
+import time
+
+import pytest
+from pynetdicom import AE, AllStoragePresentationContexts, evt
+from pynetdicom.association import Association
+
+from api import DicomSender, ReportGeneratorError
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "base")
+
+
+class StoreScp:
+    """ a C-STORE SCP on localhost which records the stores and answers with the given statuses, then success """
+
+    def __init__(self, statuses=(), store_time=0.0):
+        self.statuses = list(statuses)
+        self.store_time = store_time
+        self.stores = []  # (association, status)
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        ae = AE()
+        ae.supported_contexts = AllStoragePresentationContexts
+        self.server = ae.start_server(("127.0.0.1", 0), block=False, evt_handlers=[(evt.EVT_C_STORE, self._store)])
+        self.port = self.server.server_address[1]
+
+    def _store(self, event):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            status = self.statuses.pop(0) if self.statuses else 0x0000
+        time.sleep(self.store_time)
+        with self._lock:
+            self.active -= 1
+            self.stores.append((event.assoc, status))
+        return status
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+@pytest.fixture
+def dcm_files(tmp_path):
+    paths = []
+    for idx in range(6):
+        path = str(tmp_path / "report{}.pdf.dcm".format(idx + 1))
+        shutil.copy(os.path.join(BASE_DIR, "report09.pdf.dcm"), path)
+        paths.append(path)
+    return paths
+
+
+def test_failed_status_is_retried_on_a_new_association(dcm_files):
+    scp = StoreScp(statuses=[0xA700])
+    sender = DicomSender("127.0.0.1", scp.port, retries=2, retry_delay=0.01)
+    try:
+        assert sender.send(dcm_files[:1]) == dcm_files[:1]
+    finally:
+        sender.close()
+        scp.shutdown()
+    assert [status for _, status in scp.stores] == [0xA700, 0x0000]
+    assert scp.stores[0][0] is not scp.stores[1][0]
+
+
+@pytest.mark.parametrize("error", [ConnectionResetError("connection reset by peer"),
+                                   RuntimeError("the association with a peer SCP must be established")])
+def test_dropped_association_is_retried(dcm_files, monkeypatch, error):
+    scp = StoreScp()
+    send_c_store = Association.send_c_store
+    calls = []
+
+    def dropping_send_c_store(association, *args, **kwargs):
+        calls.append(association)
+        if len(calls) == 1:
+            # the association drops while the file is sent
+            association.abort()
+            raise error
+        return send_c_store(association, *args, **kwargs)
+
+    monkeypatch.setattr(Association, "send_c_store", dropping_send_c_store)
+    sender = DicomSender("127.0.0.1", scp.port, retries=1, retry_delay=0.01)
+    try:
+        assert sender.send(dcm_files[:1]) == dcm_files[:1]
+    finally:
+        sender.close()
+        scp.shutdown()
+    assert len(calls) == 2
+    assert calls[0] is not calls[1]
+    assert len(scp.stores) == 1
+
+
+def test_send_fails_after_the_retries(dcm_files):
+    scp = StoreScp(statuses=[0xA700] * 3)
+    sender = DicomSender("127.0.0.1", scp.port, retries=2, retry_delay=0.01)
+    try:
+        with pytest.raises(ReportGeneratorError, match="status 0xa700"):
+            sender.send(dcm_files[:1])
+    finally:
+        sender.close()
+        scp.shutdown()
+    assert len(scp.stores) == 3
+
+
+def test_files_are_sent_over_at_most_association_count_associations(dcm_files):
+    scp = StoreScp(store_time=0.1)
+    sender = DicomSender("127.0.0.1", scp.port, association_count=2)
+    try:
+        assert sender.send(dcm_files) == dcm_files
+    finally:
+        sender.close()
+        scp.shutdown()
+    assert len(scp.stores) == len(dcm_files)
+    assert scp.max_active == 2
+    # the associations are reused for the following files
+    assert len(set(association for association, _ in scp.stores)) == 2
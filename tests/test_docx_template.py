@@ -0,0 +1,78 @@
+import os
+import zipfile
+
+from lxml import etree
+
+from api import replace_in_docx
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "base")
+TEMPLATE_PATH = os.path.join(BASE_DIR, "report09_template.docx")
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+FINDINGS = "first finding\nsecond <finding> & more"
+
+
+def paragraph_texts(docx_path, part="word/document.xml"):
+    """ :return the text of each paragraph of part, line breaks as newlines """
+    with zipfile.ZipFile(docx_path) as docx:
+        assert docx.testzip() is None
+        root = etree.fromstring(docx.read(part))
+    texts = []
+    for paragraph in root.iter(W + "p"):
+        texts.append("".join(element.text or "" if element.tag == W + "t" else "\n"
+                             for element in paragraph.iter(W + "t", W + "br")))
+    return texts
+
+
+def copy_template(path, replace_parts):
+    """ copies report09_template.docx to path, with the xml of the parts in replace_parts changed by their function """
+    with zipfile.ZipFile(TEMPLATE_PATH) as template, zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as docx:
+        for info in template.infolist():
+            data = template.read(info)
+            if info.filename in replace_parts:
+                data = replace_parts[info.filename](data.decode("utf-8")).encode("utf-8")
+            docx.writestr(info, data)
+
+
+def test_report09_template_is_filled(tmp_path):
+    output_path = str(tmp_path / "filled.docx")
+    replace_in_docx(TEMPLATE_PATH, {"$findings$": FINDINGS}, output_path)
+    texts = paragraph_texts(output_path)
+    assert not any("$" in text for text in texts)
+    assert texts.count(FINDINGS) == 3
+    # the parts without placeholders are copied as they are
+    with zipfile.ZipFile(TEMPLATE_PATH) as template, zipfile.ZipFile(output_path) as filled:
+        assert filled.namelist() == template.namelist()
+        for name in template.namelist():
+            if name != "word/document.xml":
+                assert filled.read(name) == template.read(name)
+
+
+def test_placeholders_split_across_runs_are_filled(tmp_path):
+    def split_findings(xml):
+        # a bold run in the middle of the placeholder, as word writes it after editing part of the text
+        return xml.replace("<w:t>$findings$</w:t>", '<w:t>$fin</w:t></w:r><w:r><w:rPr><w:b/></w:rPr><w:t>di</w:t>'
+                           '</w:r><w:r><w:t xml:space="preserve">ngs$ </w:t>', 1)
+
+    def add_name(xml):
+        return xml.replace("</w:body>", '<w:p><w:r><w:t xml:space="preserve">Patient: $na</w:t></w:r><w:r>'
+                           '<w:t>me$</w:t></w:r><w:r><w:t>, $name$</w:t></w:r></w:p></w:body>')
+
+    template_path = str(tmp_path / "template.docx")
+    copy_template(template_path, {"word/document.xml": lambda xml: add_name(split_findings(xml))})
+    output_path = str(tmp_path / "filled.docx")
+    replace_in_docx(template_path, {"$findings$": FINDINGS, "$name$": "John Walz"}, output_path)
+    texts = paragraph_texts(output_path)
+    assert not any("$" in text for text in texts)
+    assert FINDINGS + " " in texts
+    assert texts.count(FINDINGS) == 2
+    assert "Patient: John Walz, John Walz" in texts
+
+
+def test_placeholders_in_headers_are_filled(tmp_path):
+    template_path = str(tmp_path / "template.docx")
+    copy_template(template_path, {"word/header1.xml": lambda xml: xml.replace(
+        "</w:hdr>", "<w:p><w:r><w:t>$name$</w:t></w:r></w:p></w:hdr>")})
+    output_path = str(tmp_path / "filled.docx")
+    replace_in_docx(template_path, {"$findings$": FINDINGS, "$name$": "John Walz"}, output_path)
+    assert "John Walz" in paragraph_texts(output_path, "word/header1.xml")
+    assert not any("$" in text for text in paragraph_texts(output_path))
@@ -0,0 +1,81 @@
+import io
+import os
+
+import pydicom
+import pytest
+from PIL import Image
+
+import api
+from api import ReportMetrics, ReportStages, process_report
+
+
+def run_report(dcm_sr_path, config, in_memory):
+    config.in_memory = in_memory
+    config.output_dir = os.path.join(os.path.dirname(config.output_dir), "memory" if in_memory else "files")
+    os.makedirs(config.output_dir, exist_ok=True)
+    return process_report(dcm_sr_path, config)
+
+
+def read_output(path):
+    """ :return the bytes of an output file, the content of a DICOM file without its creation time """
+    if not path.endswith(".dcm"):
+        with open(path, "rb") as output_file:
+            return output_file.read()
+    dataset = pydicom.dcmread(path)
+    for keyword in ("InstanceCreationDate", "InstanceCreationTime", "ContentDate", "ContentTime"):
+        del dataset[keyword]
+    output = io.BytesIO()
+    dataset.save_as(output, enforce_file_format=True)
+    return output.getvalue()
+
+
+@pytest.mark.parametrize("target", ["xml", "template", "pdf", "dcm_pdf"])
+def test_in_memory_outputs_are_the_file_outputs(config, dcm_sr_paths, target):
+    config.target = target
+    file_outputs = run_report(dcm_sr_paths[0], config, False)
+    memory_outputs = run_report(dcm_sr_paths[0], config, True)
+    assert [os.path.basename(path) for path in memory_outputs] == [os.path.basename(path) for path in file_outputs]
+    assert [read_output(path) for path in memory_outputs] == [read_output(path) for path in file_outputs]
+
+
+def test_no_intermediate_files_without_temp_dir(config, dcm_sr_paths, monkeypatch):
+    temp_dirs = []
+    create_temp_dir = ReportStages._create_temp_dir
+
+    def recording_create_temp_dir(stages):
+        temp_dirs.append(create_temp_dir(stages))
+        return temp_dirs[-1]
+
+    monkeypatch.setattr(ReportStages, "_create_temp_dir", recording_create_temp_dir)
+    output_files = run_report(dcm_sr_paths[0], config, True)
+    # the native encoder reads the pdf from memory, so nothing needs a temp dir
+    assert temp_dirs == []
+    assert sorted(os.listdir(config.output_dir)) == [os.path.basename(path) for path in output_files]
+
+
+def test_intermediate_results_are_kept_in_temp_dir(config, dcm_sr_paths, tmp_path):
+    config.temp_dir = str(tmp_path / "temp")
+    os.makedirs(config.temp_dir)
+    run_report(dcm_sr_paths[0], config, True)
+    assert sorted(os.listdir(config.temp_dir)) == ["report1.html", "report1.pdf", "report1.xml"]
+
+
+def test_pages_are_passed_in_memory(config, dcm_sr_paths, monkeypatch):
+    rasterized = []
+
+    def rasterize_pdf_data(pdf_data, **raster_options):
+        # pdftoppm, with two pages for every pdf
+        rasterized.append((pdf_data, raster_options))
+        for idx in range(2):
+            output = io.BytesIO()
+            Image.new("RGB", (64, 48), "white").save(output, format="JPEG")
+            yield idx, output.getvalue()
+
+    monkeypatch.setattr(api, "rasterize_pdf_data", rasterize_pdf_data)
+    config.target = "dcm_images"
+    metrics = ReportMetrics(dcm_sr_paths[0])
+    config.in_memory = True
+    output_files = process_report(dcm_sr_paths[0], config, metrics=metrics)
+    assert [os.path.basename(path) for path in output_files] == ["report1_image1.dcm", "report1_image2.dcm"]
+    assert rasterized[0][0].startswith(b"%PDF")
+    assert [pydicom.dcmread(path).InstanceNumber for path in output_files] == [1, 2]
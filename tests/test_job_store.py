@@ -0,0 +1,85 @@
+import asyncio
+import shutil
+import time
+
+from job_store import JobStore, schedule_job_store
+from stage_scheduler import StageScheduler
+
+
+def test_same_sr_is_added_once(dcm_sr_paths, tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"))
+    assert store.add(dcm_sr_paths[0])
+    assert not store.add(dcm_sr_paths[0])
+    # the job is identified by the content, not the path
+    copy_path = str(tmp_path / "copy.dcm")
+    shutil.copy(dcm_sr_paths[0], copy_path)
+    assert not store.add(copy_path)
+    assert store.counts() == {"queued": 1}
+
+
+def test_expired_lease_is_claimed_by_another_worker(dcm_sr_paths, tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"), lease_time=0.2)
+    store.add(dcm_sr_paths[0])
+    job = store.claim("worker-a")
+    assert (job["owner"], job["attempts"]) == ("worker-a", 1)
+    assert store.claim("worker-b") is None
+    time.sleep(0.3)
+    reclaimed = store.claim("worker-b")
+    assert (reclaimed["id"], reclaimed["owner"], reclaimed["attempts"]) == (job["id"], "worker-b", 2)
+    # the first worker lost the job
+    assert not store.finish(job["id"], "worker-a", [])
+    assert not store.renew(job["id"], "worker-a")
+    assert store.finish(job["id"], "worker-b", ["report1.pdf.dcm"])
+    assert store.counts() == {"done": 1}
+
+
+def test_kept_lease_does_not_expire(dcm_sr_paths, tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"), lease_time=0.3)
+    store.add(dcm_sr_paths[0])
+    job = store.claim("worker-a")
+    with store.keep_lease(job["id"], "worker-a"):
+        time.sleep(0.6)
+        assert store.claim("worker-b") is None
+    assert store.finish(job["id"], "worker-a", [])
+
+
+def test_failed_job_is_retried_until_max_attempts(dcm_sr_paths, tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"), max_attempts=2)
+    store.add(dcm_sr_paths[0])
+    job = store.claim("worker-a")
+    assert store.fail(job["id"], "worker-a", "first error")
+    assert store.counts() == {"queued": 1}
+    job = store.claim("worker-a")
+    assert job["attempts"] == 2
+    assert job["error"] == "first error"
+    assert store.fail(job["id"], "worker-a", "second error")
+    assert store.claim("worker-a") is None
+    assert store.counts() == {"failed": 1}
+
+
+def test_expired_leases_count_as_attempts(dcm_sr_paths, tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"), lease_time=0.05, max_attempts=2)
+    store.add(dcm_sr_paths[0])
+    assert store.claim("worker-a")["attempts"] == 1
+    time.sleep(0.1)
+    assert store.claim("worker-b")["attempts"] == 2
+    time.sleep(0.1)
+    # the worker dying on the job every time does not keep it forever
+    assert store.claim("worker-c") is None
+    assert store.counts() == {"failed": 1}
+
+
+def test_scheduled_jobs_are_done_once(config, dcm_sr_paths, tmp_path):
+    job_store_path = str(tmp_path / "jobs.db")
+    store = JobStore(job_store_path)
+    # the copies are the same SR, made different to be three jobs
+    for idx, path in enumerate(dcm_sr_paths):
+        with open(path, "ab") as sr_file:
+            sr_file.write(b"\0\0" * idx)
+        assert store.add(path)
+    results = asyncio.run(schedule_job_store(StageScheduler(config), job_store_path, 30.0))
+    assert sorted(result.dcm_sr_path for result in results if result.success) == dcm_sr_paths
+    assert store.counts() == {"done": 3}
+    assert store.claim("worker-a") is None
+    # a second run finds nothing to do
+    assert asyncio.run(schedule_job_store(StageScheduler(config), job_store_path, 30.0)) == []
@@ -0,0 +1,91 @@
+import io
+import json
+import logging
+import os
+import shutil
+
+import pytest
+
+from api import (ET, ReportGeneratorError, get_native_ignored_options, load_config, parse_xml_pruned, run_cmd,
+                 sr_to_xml_tree)
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "base")
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+REPORTS = ["report09", "report10"]
+
+
+def load_report(report):
+    """ :return the config of the report in base and the template data dsr2xml -Ee -Ec gives for its rules """
+    config = load_config(os.path.join(BASE_DIR, report + "_config.json"))
+    with open(os.path.join(DATA_DIR, report + "_data.json"), encoding="utf-8") as data_file:
+        return config, json.load(data_file)
+
+
+@pytest.mark.parametrize("report", REPORTS)
+def test_native_converter_gives_the_dsr2xml_data(report):
+    config, expected_data = load_report(report)
+    root = sr_to_xml_tree(os.path.join(BASE_DIR, report + ".dcm"))
+    assert config.compile_rules().extract(root) == expected_data
+
+
+@pytest.mark.parametrize("report", REPORTS)
+def test_native_converter_gives_the_dsr2xml_data_streamed(report, tmp_path):
+    config, expected_data = load_report(report)
+    rule_program = config.compile_rules()
+    assert rule_program.stream_paths is not None
+    xml_file = str(tmp_path / (report + ".xml"))
+    sr_to_xml_tree(os.path.join(BASE_DIR, report + ".dcm")).write(xml_file, encoding="utf-8", xml_declaration=True)
+    assert rule_program.extract(parse_xml_pruned(xml_file, rule_program.stream_paths)) == expected_data
+
+
+def test_stored_data_is_the_text_of_the_dsr2xml_report():
+    # report09.pdf.dcm was generated with dsr2xml, its text holds the findings of the stored data
+    pydicom = pytest.importorskip("pydicom")
+    pypdf = pytest.importorskip("pypdf")
+    _, expected_data = load_report("report09")
+    dataset = pydicom.dcmread(os.path.join(BASE_DIR, "report09.pdf.dcm"))
+    reader = pypdf.PdfReader(io.BytesIO(dataset.EncapsulatedDocument))
+    # the extracted pdf text breaks words at arbitrary places
+    text = "".join("".join(page.extract_text() for page in reader.pages).split())
+    assert "".join(expected_data["$findings$"].split()) in text
+
+
+@pytest.mark.skipif(shutil.which("dsr2xml") is None, reason="dsr2xml is not on the PATH")
+@pytest.mark.parametrize("report", REPORTS)
+def test_native_converter_matches_dsr2xml(report, tmp_path):
+    config, _ = load_report(report)
+    rule_program = config.compile_rules()
+    dcm_sr_path = os.path.join(BASE_DIR, report + ".dcm")
+    xml_file = str(tmp_path / (report + ".xml"))
+    # a failing dsr2xml raises, it does not leave a missing or stale xml file to compare with
+    run_cmd("dsr2xml", *config.dsr2xml_exe_additional_options, dcm_sr_path, xml_file)
+    assert rule_program.extract(sr_to_xml_tree(dcm_sr_path)) == rule_program.extract(ET.parse(xml_file))
+
+
+def test_layout_options_are_rejected_for_the_native_converter():
+    config, _ = load_report("report09")
+    config.dsr2xml_exe_additional_options = ["-Ee", "+Ea", "--write-item-id"]
+    assert config.validate() is None
+    config.sr_xml_converter = "native"
+    assert "+Ea --write-item-id" in config.validate()
+
+
+def test_native_ignored_options():
+    assert get_native_ignored_options(["-Ee", "-Ec", "+Ca", "latin-1", "-ll", "info", "+Wi"]) == []
+    assert get_native_ignored_options(["-Ee", "--unknown-option"]) == ["--unknown-option"]
+
+
+def test_load_config_warns_about_ignored_options(tmp_path, caplog):
+    with open(os.path.join(BASE_DIR, "report10_config.json")) as json_file:
+        data = json.load(json_file)
+    data["sr_xml_converter"] = "native"
+    data["dsr2xml_exe_additional_options"] = ["-Ee", "--unknown-option"]
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps(data))
+    with caplog.at_level(logging.WARNING):
+        load_config(str(config_file))
+    assert "ignores these dsr2xml options: --unknown-option" in caplog.text
+    data["dsr2xml_exe_additional_options"] = ["+Xs"]
+    config_file.write_text(json.dumps(data))
+    with pytest.raises(ReportGeneratorError, match=r"\+Xs"):
+        load_config(str(config_file))
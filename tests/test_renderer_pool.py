@@ -0,0 +1,143 @@
+import threading
+import time
+
+import pytest
+
+from api import FakeRenderer, RendererPool, ReportGeneratorError
+
+
+class RecordingRenderer(FakeRenderer):
+    """ a FakeRenderer which records its lifecycle and calls in the shared list events """
+
+    def __init__(self, events, block=None, delay=0.0):
+        super().__init__()
+        self.events = events
+        self.block = block
+        self.delay = delay
+        self.number = len([event for event in events if event[0] == "created"])
+        events.append(("created", self.number))
+
+    def render(self, input_path, pdf_path):
+        self.events.append(("render", self.number))
+        if self.block is not None and self.number == 0:
+            # the first renderer hangs until the test releases it
+            self.block.wait()
+        time.sleep(self.delay)
+        if input_path.endswith("fail.html"):
+            raise ReportGeneratorError("render failed")
+        super().render(input_path, pdf_path)
+
+    def render_batch(self, documents):
+        self.events.append(("batch", self.number, len(documents)))
+        super().render_batch(documents)
+
+    def close(self):
+        self.events.append(("closed", self.number))
+
+
+def write_input(tmp_path, name):
+    input_path = tmp_path / name
+    input_path.write_text("<html><body>{}</body></html>".format(name))
+    return str(input_path), str(tmp_path / (name + ".pdf"))
+
+
+def test_timed_out_worker_is_replaced(tmp_path):
+    events = []
+    block = threading.Event()
+    pool = RendererPool(lambda: RecordingRenderer(events, block), size=1, job_timeout=0.5)
+    try:
+        with pytest.raises(ReportGeneratorError, match="timed out"):
+            pool.render(*write_input(tmp_path, "stuck.html"))
+        # the replacement worker renders with a new renderer while the first one still hangs
+        input_path, pdf_path = write_input(tmp_path, "next.html")
+        assert pool.render(input_path, pdf_path) == pdf_path
+        assert ("render", 1) in events
+    finally:
+        block.set()
+        pool.close()
+    # the abandoned worker closes its renderer and leaves once the render returned
+    assert ("closed", 0) in events
+    assert ("closed", 1) in events
+
+
+def test_timeout_starts_when_a_worker_takes_the_job(tmp_path):
+    events = []
+    # both renders together take longer than the timeout, each one alone does not
+    pool = RendererPool(lambda: RecordingRenderer(events, delay=0.4), size=1, job_timeout=0.6)
+    documents = [write_input(tmp_path, "report{}.html".format(idx)) for idx in range(2)]
+    errors = []
+
+    def render(input_path, pdf_path):
+        try:
+            pool.render(input_path, pdf_path)
+        except ReportGeneratorError as error:
+            errors.append(error)
+
+    try:
+        threads = [threading.Thread(target=render, args=document) for document in documents]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        pool.close()
+    assert errors == []
+    # the queued job neither timed out nor caused a replacement renderer
+    assert [event for event in events if event[0] == "render"] == [("render", 0), ("render", 0)]
+
+
+def test_renderer_is_recycled_after_max_jobs(tmp_path):
+    events = []
+    pool = RendererPool(lambda: RecordingRenderer(events), size=1, max_jobs_per_renderer=2)
+    try:
+        for idx in range(5):
+            pool.render(*write_input(tmp_path, "report{}.html".format(idx)))
+    finally:
+        pool.close()
+    renders = [number for event, number, *_ in events if event == "render"]
+    assert renders == [0, 0, 1, 1, 2]
+    assert [event for event in events if event[0] == "closed"] == [("closed", 0), ("closed", 1), ("closed", 2)]
+
+
+def test_failed_render_replaces_the_renderer(tmp_path):
+    events = []
+    pool = RendererPool(lambda: RecordingRenderer(events), size=1)
+    try:
+        with pytest.raises(ReportGeneratorError, match="render failed"):
+            pool.render(*write_input(tmp_path, "fail.html"))
+        pool.render(*write_input(tmp_path, "ok.html"))
+    finally:
+        pool.close()
+    assert events.index(("closed", 0)) < events.index(("render", 1))
+
+
+def test_concurrent_jobs_are_rendered_in_one_batch(tmp_path):
+    events = []
+    pool = RendererPool(lambda: RecordingRenderer(events), size=1, batch_size=3, batch_wait=2.0)
+    documents = [write_input(tmp_path, "report{}.html".format(idx)) for idx in range(3)]
+    try:
+        threads = [threading.Thread(target=pool.render, args=document) for document in documents]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        pool.close()
+    assert ("batch", 0, 3) in events
+    for _, pdf_path in documents:
+        with open(pdf_path, "rb") as pdf_file:
+            assert pdf_file.read(5) == b"%PDF-"
+
+
+def test_in_memory_jobs_are_not_batched(tmp_path):
+    events = []
+    pool = RendererPool(lambda: RecordingRenderer(events), size=1, batch_size=3, batch_wait=0.5)
+    document = write_input(tmp_path, "report.html")
+    try:
+        thread = threading.Thread(target=pool.render, args=document)
+        thread.start()
+        assert pool.render_data(b"<html></html>", ".html").startswith(b"%PDF-")
+        thread.join()
+    finally:
+        pool.close()
+    assert not [event for event in events if event[0] == "batch"]
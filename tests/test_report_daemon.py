@@ -0,0 +1,110 @@
+import os
+import shutil
+import socket
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from api import DicomSender, ReportResult
+from report_daemon import ReportDaemon
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "base")
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for(condition, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def run_daemon():
+    """ starts a daemon in a thread, stops it and waits for its pending reports at the end of the test """
+    daemons = []
+
+    def start(daemon):
+        thread = threading.Thread(target=daemon.run)
+        thread.start()
+        daemons.append((daemon, thread))
+        return daemon
+
+    yield start
+    for daemon, thread in daemons:
+        daemon.stop()
+        thread.join(60)
+
+
+def test_inbox_files_are_processed_and_moved(config, tmp_path, run_daemon):
+    inbox_dir = str(tmp_path / "inbox")
+    os.makedirs(inbox_dir)
+    for name in ("report1.dcm", "report2.dcm", "report3.dcm.part"):
+        shutil.copy(os.path.join(BASE_DIR, "report10.dcm"), os.path.join(inbox_dir, name))
+    with open(os.path.join(inbox_dir, "broken.dcm"), "wb") as broken_file:
+        broken_file.write(b"no DICOM file")
+    run_daemon(ReportDaemon(config, inbox_dir, workers=2, poll_interval=0.05))
+    done_dir, failed_dir = os.path.join(inbox_dir, "done"), os.path.join(inbox_dir, "failed")
+    wait_for(lambda: os.path.isdir(failed_dir) and len(os.listdir(done_dir)) + len(os.listdir(failed_dir)) == 3)
+    assert sorted(os.listdir(done_dir)) == ["report1.dcm", "report2.dcm"]
+    assert os.listdir(failed_dir) == ["broken.dcm"]
+    assert sorted(os.listdir(config.output_dir)) == ["report1.pdf.dcm", "report2.pdf.dcm"]
+    # a file still being written waits until it is renamed
+    assert sorted(os.listdir(inbox_dir)) == ["done", "failed", "report3.dcm.part"]
+    os.replace(os.path.join(inbox_dir, "report3.dcm.part"), os.path.join(inbox_dir, "report3.dcm"))
+    wait_for(lambda: len(os.listdir(done_dir)) == 3)
+
+
+def test_received_srs_are_processed(config, tmp_path, run_daemon):
+    inbox_dir = str(tmp_path / "inbox")
+    port = free_port()
+    daemon = run_daemon(ReportDaemon(config, inbox_dir, workers=1, scp_port=port, poll_interval=0.05))
+    wait_for(lambda: daemon._scp is not None)
+    sender = DicomSender("127.0.0.1", port, called_ae_title="REPORTGEN")
+    try:
+        sender.send([os.path.join(BASE_DIR, "report10.dcm")])
+    finally:
+        sender.close()
+    done_dir = os.path.join(inbox_dir, "done")
+    wait_for(lambda: len(os.listdir(done_dir)) == 1)
+    # the received SR is named after its SOP Instance UID, and so is the report
+    name = os.path.splitext(os.listdir(done_dir)[0])[0]
+    assert os.listdir(config.output_dir) == [name + ".pdf.dcm"]
+
+
+class RecordingExecutor:
+    """ completes every submitted chunk of reports at once """
+
+    def __init__(self):
+        self.chunks = []
+
+    def submit(self, function, reports):
+        self.chunks.append([os.path.basename(path) for path, _ in reports])
+        future = Future()
+        future.set_result([ReportResult(path) for path, _ in reports])
+        return future
+
+
+def test_inbox_scan_submits_chunks_of_render_batch_size(config, tmp_path):
+    inbox_dir = str(tmp_path / "inbox")
+    for directory in ("", "done", "failed"):
+        os.makedirs(os.path.join(inbox_dir, directory))
+    for idx in range(5):
+        shutil.copy(os.path.join(BASE_DIR, "report10.dcm"), os.path.join(inbox_dir, "report{}.dcm".format(idx + 1)))
+    config.render_batch_size = 2
+    daemon = ReportDaemon(config, inbox_dir, workers=1)
+    daemon._executor = RecordingExecutor()
+    # the first scan only records the file sizes
+    daemon.scan_inbox()
+    assert daemon._executor.chunks == []
+    daemon.scan_inbox()
+    assert daemon._executor.chunks == [["report1.dcm", "report2.dcm"], ["report3.dcm", "report4.dcm"],
+                                       ["report5.dcm"]]
+    assert len(os.listdir(os.path.join(inbox_dir, "failed"))) == 5
@@ -0,0 +1,144 @@
+import asyncio
+import http.client
+import io
+import json
+import os
+import socket
+import threading
+import time
+
+import pydicom
+import pytest
+
+from report_server import ReportServer
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "base")
+
+
+class ServerThread:
+    """ runs a ReportServer on a free localhost port in a thread with its own event loop """
+
+    def __init__(self, server):
+        self.server = server
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.port = probe.getsockname()[1]
+        self.loop = None
+        self.thread = threading.Thread(target=asyncio.run, args=(self._serve(),))
+        self.thread.start()
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port)).close()
+                break
+            except ConnectionRefusedError:
+                assert time.monotonic() < deadline, "the server did not start"
+                time.sleep(0.05)
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        await self.server.serve("127.0.0.1", self.port)
+
+    def request(self, method, path, body=None, headers=None, encode_chunked=False):
+        """ :return the status, headers and body of the response """
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        try:
+            connection.request(method, path, body, headers or {}, encode_chunked=encode_chunked)
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            connection.close()
+
+    def request_json(self, method, path, body=None, headers=None, encode_chunked=False):
+        status, _, data = self.request(method, path, body, headers, encode_chunked)
+        return status, json.loads(data)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.server.stop)
+        self.thread.join(30)
+
+
+@pytest.fixture
+def server(config, tmp_path):
+    server_thread = ServerThread(ReportServer({"report10": config}, str(tmp_path / "jobs"),
+                                              max_upload_size=1024 * 1024))
+    yield server_thread
+    server_thread.stop()
+
+
+@pytest.fixture
+def sr_data():
+    with open(os.path.join(BASE_DIR, "report10.dcm"), "rb") as sr_file:
+        return sr_file.read()
+
+
+def wait_for_job(server, job_id):
+    deadline = time.monotonic() + 60
+    while True:
+        status, job = server.request_json("GET", "/jobs/" + job_id)
+        assert status == 200
+        if job["status"] in ("done", "failed"):
+            return job
+        assert time.monotonic() < deadline, "the job did not finish"
+        time.sleep(0.05)
+
+
+def test_profiles(server, config):
+    assert server.request_json("GET", "/profiles") == (200, {"report10": {"target": "dcm_pdf",
+                                                                          "template_path": config.template_path}})
+
+
+def test_job_is_processed_downloaded_and_deleted(server, sr_data):
+    status, headers, data = server.request("POST", "/jobs?profile=report10", sr_data)
+    assert status == 202
+    job = json.loads(data)
+    assert headers["Location"] == "/jobs/" + job["id"]
+    job = wait_for_job(server, job["id"])
+    assert job["status"] == "done", job
+    assert job["output_files"] == ["report.pdf.dcm"]
+
+    status, headers, data = server.request("GET", "/jobs/{}/files/{}".format(job["id"], job["output_files"][0]))
+    assert status == 200
+    assert headers["Content-Type"] == "application/dicom"
+    dataset = pydicom.dcmread(io.BytesIO(data))
+    assert dataset.EncapsulatedDocument.startswith(b"%PDF")
+    assert server.request_json("GET", "/jobs")[1] == [job]
+
+    assert server.request_json("DELETE", "/jobs/" + job["id"])[0] == 200
+    assert server.request_json("GET", "/jobs/" + job["id"])[0] == 404
+    assert server.request_json("GET", "/jobs") == (200, [])
+
+
+def test_chunked_upload(server, sr_data):
+    chunks = (sr_data[idx:idx + 4096] for idx in range(0, len(sr_data), 4096))
+    status, job = server.request_json("POST", "/jobs", chunks, {"Transfer-Encoding": "chunked"}, True)
+    assert status == 202
+    assert job["profile"] == "report10"
+    assert wait_for_job(server, job["id"])["status"] == "done"
+
+
+@pytest.mark.parametrize("method, path, body, status, error", [
+    ("POST", "/jobs?profile=report11", b"DICM", 404, "unknown profile report11"),
+    ("POST", "/jobs", b"", 400, "the request body must be a DICOM SR"),
+    ("GET", "/jobs/unknown", None, 404, "unknown job unknown"),
+    ("GET", "/reports", None, 404, "/reports not found"),
+])
+def test_request_errors(server, method, path, body, status, error):
+    assert server.request_json(method, path, body) == (status, {"error": error})
+
+
+def test_too_large_upload_is_rejected_before_the_body_is_sent(server):
+    with socket.create_connection(("127.0.0.1", server.port), timeout=30) as client:
+        client.sendall(b"POST /jobs HTTP/1.1\r\nHost: localhost\r\nContent-Length: 1048577\r\n"
+                       b"Expect: 100-continue\r\n\r\n")
+        response = client.makefile("rb").read()
+    assert response.startswith(b"HTTP/1.1 413 ")
+    assert response.endswith(b'{"error": "the upload exceeds 1048576 bytes"}')
+
+
+def test_job_request_errors(server, sr_data):
+    job = wait_for_job(server, server.request_json("POST", "/jobs", sr_data)[1]["id"])
+    assert server.request_json("GET", "/jobs/{}/files/report.pdf".format(job["id"])) == (
+        404, {"error": "job {} has no output file report.pdf".format(job["id"])})
+    assert server.request_json("PUT", "/jobs/" + job["id"], b"") == (
+        405, {"error": "PUT /jobs/{} is not supported".format(job["id"])})
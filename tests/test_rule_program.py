@@ -0,0 +1,130 @@
+import pytest
+
+from api import (CONCEPT_STREAM_PATH, ET, ConceptIndex, ConceptSelector, ReportGeneratorError, Rule, RuleProgram,
+                 get_xpath_stream_paths, parse_xml_pruned)
+
+SR_XML = """<report>
+  <patient><name><last>Walz</last><first>John</first></name></patient>
+  <document>
+    <content>
+      <container>
+        <concept><value>121070</value><scheme><designator>DCM</designator></scheme><meaning>Findings</meaning></concept>
+        <text>
+          <concept><value>121071</value><scheme><designator>DCM</designator></scheme><meaning>Finding</meaning></concept>
+          <value>first finding&lt;BR&gt;second line</value>
+        </text>
+        <text>
+          <concept><value>121073</value><scheme><designator>DCM</designator></scheme><meaning>Impression</meaning></concept>
+          <value>impression</value>
+        </text>
+        <text>
+          <concept><value>121071</value><scheme><designator>99X</designator></scheme><meaning>Finding</meaning></concept>
+          <value>third finding</value>
+        </text>
+      </container>
+    </content>
+  </document>
+</report>"""
+FINDINGS_XPATH = '/report/document/content/container/text[concept/meaning[contains(text(), "Finding")]]/value/text()'
+
+
+def create_rule(name, *xpath_expressions, concat_string="\n", replacements=None):
+    return Rule.create_from_dict({"name": name, "concat_string": concat_string,
+                                  "xpath_expressions": list(xpath_expressions), "replacements": replacements or {}})
+
+
+def test_rules_extract_the_concatenated_texts():
+    program = RuleProgram([
+        create_rule("$findings$", FINDINGS_XPATH, replacements={"<BR>": "\n"}),
+        create_rule("$name$", "/report/patient/name/first/text()", "/report/patient/name/last/text()",
+                    concat_string=" ")])
+    assert program.extract(ET.ElementTree(ET.fromstring(SR_XML))) == {
+        "$findings$": "first finding\nsecond line\nthird finding", "$name$": "John Walz"}
+
+
+def test_one_program_serves_any_number_of_srs():
+    program = RuleProgram([create_rule("$name$", "/report/patient/name/last/text()")])
+    for last_name in ("Walz", "Miller"):
+        root = ET.ElementTree(ET.fromstring(SR_XML.replace("Walz", last_name)))
+        assert program.extract(root) == {"$name$": last_name}
+
+
+def test_replacements_are_applied_in_one_pass_longest_first():
+    rule = create_rule("$text$", "/report/document/content/container/text[2]/value/text()",
+                       replacements={"impression": "<BR>", "<BR>": "never", "im": "no"}).compile()
+    # the longest search string wins and a replaced text is not replaced again
+    assert rule.extract(ET.fromstring(SR_XML)) == "<BR>"
+
+
+def test_empty_results_are_left_out(caplog):
+    rule = create_rule("$text$", "/report/missing/text()", "/report/patient/name/last/text()").compile()
+    assert rule.extract(ET.fromstring(SR_XML)) == "Walz"
+    assert "empty text for xpath \"/report/missing/text()\"" in caplog.text
+
+
+def test_invalid_xpath_is_rejected_when_compiling():
+    with pytest.raises(ReportGeneratorError, match=r"invalid xpath \"/report/\[\" in rule \$text\$, index 1"):
+        RuleProgram([create_rule("$text$", "/report/patient/name/last/text()", "/report/[")])
+
+
+def test_xpath_without_text_is_an_error():
+    rule = create_rule("$count$", "count(/report/document/content/container/text)").compile()
+    with pytest.raises(ReportGeneratorError, match="xpath did not produce text"):
+        rule.extract(ET.fromstring(SR_XML))
+
+
+@pytest.mark.parametrize("xpath_expression, stream_paths", [
+    (FINDINGS_XPATH, [("report", "document", "content", "container", "text")]),
+    ("/report/patient/name/last/text() | /report/patient/name/first/text()",
+     [("report", "patient", "name", "last"), ("report", "patient", "name", "first")]),
+    ("/report/document//text/value/text()", [("report", "document")]),
+    ("//text/value/text()", None),
+    ("count(/report/document)", None),
+    ("/report/document/content/container/text[../concept/meaning = \"Findings\"]/value/text()", None),
+    ("/report/document/content/container/text[/report/patient]/value/text()", None),
+])
+def test_stream_paths_of_xpaths(xpath_expression, stream_paths):
+    assert get_xpath_stream_paths(xpath_expression) == stream_paths
+
+
+def test_pruned_tree_only_holds_the_streamed_subtrees(tmp_path):
+    xml_file = str(tmp_path / "report.xml")
+    with open(xml_file, "w", encoding="utf-8") as file:
+        file.write(SR_XML)
+    program = RuleProgram([create_rule("$findings$", FINDINGS_XPATH),
+                           create_rule("$name$", "/report/patient/name/last/text()")])
+    root = parse_xml_pruned(xml_file, program.stream_paths)
+    # the ancestors of the streamed paths stay, without their other children
+    assert [element.tag for element in root.getroot()] == ["patient", "document"]
+    assert [element.tag for element in root.find("patient/name")] == ["last"]
+    assert [element.tag for element in root.find("document/content/container")] == ["text", "text", "text"]
+    assert program.extract(root) == program.extract(ET.parse(xml_file))
+
+
+@pytest.mark.parametrize("expression, texts", [
+    ("concept:meaning=Finding", ["first finding<BR>second line", "third finding"]),
+    ("concept: meaning~Find; path=container/text", ["first finding<BR>second line", "third finding"]),
+    ("concept:code=121071; scheme=DCM", ["first finding<BR>second line"]),
+    ("concept:scheme=99X", ["third finding"]),
+    ("concept:meaning=Impression; code=121071", []),
+    # the container has a concept but no value of its own
+    ("concept:path=/container/", []),
+])
+def test_concept_selectors(expression, texts):
+    assert ConceptIndex(ET.fromstring(SR_XML)).select(ConceptSelector(expression)) == texts
+
+
+def test_concept_selector_selects_what_the_xpath_does():
+    root = ET.ElementTree(ET.fromstring(SR_XML))
+    program = RuleProgram([create_rule("$xpath$", FINDINGS_XPATH),
+                           create_rule("$concept$", "concept:meaning~Finding; path=container/text")])
+    assert program.uses_concepts
+    assert program.stream_paths == {CONCEPT_STREAM_PATH, ("report", "document", "content", "container", "text")}
+    data = program.extract(root)
+    assert data["$concept$"] == data["$xpath$"]
+
+
+@pytest.mark.parametrize("expression", ["concept:", "concept:code~121", "concept:unit=mm", "concept:meaning"])
+def test_invalid_concept_selector_is_rejected_when_compiling(expression):
+    with pytest.raises(ReportGeneratorError, match="invalid concept selector"):
+        RuleProgram([create_rule("$text$", expression)])
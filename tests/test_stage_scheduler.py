@@ -0,0 +1,115 @@
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+import api
+from api import process_report
+from stage_scheduler import StageScheduler
+
+STAGES = ["xml", "data", "template", "pdf", "dcm_pdf"]
+
+
+async def run_reports(scheduler, dcm_sr_paths, events):
+    """ runs the reports through the started scheduler, events receives (report name, stage) of every done stage """
+    await scheduler.start()
+    try:
+        done = []
+        for path in dcm_sr_paths:
+            name = os.path.basename(path)
+            done.append(await scheduler.submit(path, stage_done=lambda stage, name=name: events.append((name, stage))))
+        return await asyncio.gather(*done)
+    finally:
+        await scheduler.stop()
+
+
+def test_every_report_runs_the_stages_in_order(config, dcm_sr_paths):
+    events = []
+    results = asyncio.run(run_reports(StageScheduler(config), dcm_sr_paths, events))
+    assert [result.success for result in results] == [True, True, True]
+    for path, result in zip(dcm_sr_paths, results):
+        name = os.path.basename(path)
+        assert [stage for report, stage in events if report == name] == STAGES
+        assert [os.path.basename(output_file) for output_file in result.output_files] == [
+            os.path.splitext(name)[0] + ".pdf.dcm"]
+        assert os.path.exists(result.output_files[0])
+
+
+def test_submit_waits_while_the_queue_of_the_first_stage_is_full(config, dcm_sr_paths, monkeypatch):
+    config.stage_concurrency = {"xml": 1}
+    config.stage_queue_size = 1
+    started = threading.Event()
+    release = threading.Event()
+    sr_to_xml_tree = api.sr_to_xml_tree
+
+    def blocking_sr_to_xml_tree(dcm_sr_path):
+        started.set()
+        release.wait(10)
+        return sr_to_xml_tree(dcm_sr_path)
+
+    monkeypatch.setattr(api, "sr_to_xml_tree", blocking_sr_to_xml_tree)
+
+    async def run():
+        scheduler = StageScheduler(config)
+        await scheduler.start()
+        try:
+            # the only xml worker takes the first report and blocks, the second one fills the queue
+            first = await scheduler.submit(dcm_sr_paths[0])
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 10)
+            second = await scheduler.submit(dcm_sr_paths[1])
+            third = asyncio.ensure_future(scheduler.submit(dcm_sr_paths[2]))
+            await asyncio.sleep(0.3)
+            assert not third.done()
+            release.set()
+            return await asyncio.gather(first, second, await third)
+        finally:
+            release.set()
+            await scheduler.stop()
+
+    results = asyncio.run(run())
+    assert [result.success for result in results] == [True, True, True]
+
+
+def test_resumed_report_enters_at_its_first_uncached_stage(config, dcm_sr_paths, tmp_path):
+    config.cache_dir = str(tmp_path / "cache")
+    config.target = "template"
+    process_report(dcm_sr_paths[0], config)
+    config.target = "dcm_pdf"
+    events = []
+    result, = asyncio.run(run_reports(StageScheduler(config), dcm_sr_paths[:1], events))
+    assert result.success
+    # the cached stages are reported done without running
+    assert [stage for _, stage in events] == STAGES
+    assert [stage["name"] for stage in result.metrics["stages"] if stage["cached"]] == ["xml", "data", "template"]
+    assert [stage["name"] for stage in result.metrics["stages"] if not stage["cached"]] == ["pdf", "dcm_pdf"]
+
+
+@pytest.mark.skipif(os.name == "nt", reason="the fake dsr2xml is a script")
+def test_external_commands_run_as_asyncio_subprocesses(config, dcm_sr_paths, tmp_path, monkeypatch):
+    # a dsr2xml which writes the xml of the native converter
+    tool_dir = tmp_path / "tools"
+    tool_dir.mkdir()
+    dsr2xml = tool_dir / "dsr2xml"
+    dsr2xml.write_text("#!{}\nimport sys\nsys.path.insert(0, {!r})\nimport api\n"
+                       "api.sr_to_xml_tree(sys.argv[-2]).write(sys.argv[-1], encoding='utf-8')\n".format(
+                           sys.executable, os.path.dirname(api.__file__)))
+    dsr2xml.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tool_dir) + os.pathsep + os.environ["PATH"])
+    commands = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def recording_create_subprocess_exec(*args, **kwargs):
+        commands.append(os.path.basename(args[0]))
+        return await create_subprocess_exec(*args, **kwargs)
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", recording_create_subprocess_exec)
+    config.sr_xml_converter = "dsr2xml"
+    config.target = "template"
+    results = asyncio.run(StageScheduler(config).run([(path, None) for path in dcm_sr_paths]))
+    assert [result.success for result in results] == [True, True, True]
+    assert commands == ["dsr2xml"] * 3
+    assert [command["command"] for command in results[0].metrics["commands"]] == ["dsr2xml"]
+    with open(results[0].output_files[0], encoding="utf-8") as template_file:
+        assert "John Walz" in template_file.read()
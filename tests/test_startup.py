@@ -0,0 +1,15 @@
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+def test_import_api_defers_the_heavy_modules():
+    # a fresh interpreter, the modules imported by the other tests do not count
+    deferred_modules = ["asyncio", "concurrent.futures", "ssl", "lxml", "pydicom", "pdfkit", "pdf2image", "psutil",
+                        "win32com"]
+    script = "import sys, api; print(' '.join(name for name in {!r} if name in sys.modules))".format(deferred_modules)
+    completed = subprocess.run([sys.executable, "-c", script], cwd=SRC_DIR, check=True, capture_output=True,
+                               text=True)
+    assert completed.stdout.split() == []
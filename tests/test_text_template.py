@@ -0,0 +1,45 @@
+import os
+
+from api import TextTemplate, load_text_template, replace_in_text_file
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "base")
+
+
+def test_template_is_filled_in_one_pass():
+    template = TextTemplate("<p>$name$</p><p>$name_last$</p><p>$findings$</p>", ["$name$", "$name_last$",
+                                                                                 "$findings$", "$unused$"])
+    # values containing placeholders are not filled again, the longest placeholder wins
+    assert template.fill({"$name$": "$findings$", "$name_last$": "Walz", "$findings$": "none"}) == \
+        "<p>$findings$</p><p>Walz</p><p>none</p>"
+    # placeholders without a value stay as they are
+    assert template.fill({"$name$": "John"}) == "<p>John</p><p>$name_last$</p><p>$findings$</p>"
+
+
+def test_template_without_placeholders_is_one_segment():
+    template = TextTemplate("<p>static</p>", ["", "$missing$"])
+    assert template.segments == ["<p>static</p>"]
+    assert template.fill({"$missing$": "value"}) == "<p>static</p>"
+
+
+def test_template_is_compiled_once_until_it_changes(tmp_path):
+    path = tmp_path / "template.html"
+    path.write_text("<p>$name$</p>")
+    first = load_text_template(str(path), ["$name$"])
+    assert load_text_template(str(path), ["$name$"]) is first
+    # other placeholders compile it again
+    assert load_text_template(str(path), ["$name$", "$findings$"]) is not first
+
+    path.write_text("<p>$findings$ $name$</p>")
+    os.utime(str(path), ns=(os.stat(str(path)).st_mtime_ns + 10 ** 9,) * 2)
+    changed = load_text_template(str(path), ["$name$", "$findings$"])
+    assert changed.fill({"$name$": "John", "$findings$": "none"}) == "<p>none John</p>"
+
+
+def test_report10_template_is_filled(tmp_path):
+    out_file = str(tmp_path / "report10.html")
+    replace_in_text_file(os.path.join(BASE_DIR, "report10_template.html"),
+                         {"$findings$": "first finding", "$name$": "John Walz"}, out_file)
+    with open(out_file) as file:
+        text = file.read()
+    assert "first finding" in text and "John Walz" in text
+    assert "$findings$" not in text and "$name$" not in text